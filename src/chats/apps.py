@@ -1,6 +1,12 @@
+from importlib import import_module
+
 from django.apps import AppConfig
 
 
 class ChatsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "src.chats"
+
+    def ready(self):
+        # connects the model signal receivers
+        import_module(f"{self.name}.signals")
@@ -0,0 +1,106 @@
+"""Async reads for the chat consumer (CHAT_DB_SERVICES = "async").
+
+The thread services (ChatReadServiceMixin in src.chats.consumers) run every
+read on a DBExecutor thread. These read Redis on the event loop instead,
+with redis.asyncio (the user's room ids, a room's seq counter). Postgres
+reads, writes, and rebuilding a missing Redis index still go to a
+DBExecutor thread.
+
+Postgres is not read with Django's async queryset API (afirst, async
+iteration): in Django 4.2 it runs every query through sync_to_async with
+thread_sensitive=True, i.e. on one thread per process, which would queue
+all reads of the worker behind each other instead of using the DBExecutor
+pool. Revisit once the database backend has an async driver.
+(The per-message membership check is answered by the worker's role cache,
+src.chats.membership, so it has no version here.)
+"""
+import asyncio
+import weakref
+
+import redis.asyncio as aioredis
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+from .executor import db_sync_to_async
+from .singleflight import single_flight
+from .serializers import MessageSerializer
+from .services import (
+    ChatChangeLog,
+    ChatHistoryService,
+    ChatMembershipIndex,
+    ChatMessageService,
+    is_read_seq,
+    read_seq_query,
+)
+
+# redis.asyncio clients can't be shared across event loops
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_redis(loop) -> aioredis.Redis:
+    """redis.asyncio client for the cache's Redis (django_redis "default")"""
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = aioredis.Redis.from_url(settings.CACHES["default"]["LOCATION"])
+    return client
+
+
+class AsyncChatReadServiceMixin:
+    """Async counterpart of ChatReadServiceMixin, same method names and results.
+    Redis is read on the event loop, Postgres on a DBExecutor thread."""
+
+    __slots__ = ()
+
+    @staticmethod
+    def _redis():
+        return get_async_redis(asyncio.get_running_loop())
+
+    @single_flight()
+    async def db_get_room_ids(self, user_id) -> list:
+        members = await self._redis().smembers(ChatMembershipIndex._key(user_id))
+        if members:
+            return [member.decode() for member in members if member.decode() != ChatMembershipIndex.SENTINEL]
+        # miss: read Postgres and rebuild the set, on a thread
+        return await db_sync_to_async(ChatMembershipIndex.get_room_ids)(user_id)
+
+    @single_flight()
+    async def db_get_history_page(self, room_id, before, limit) -> dict:
+        messages, next_cursor = await db_sync_to_async(ChatHistoryService.get_page)(
+            room_id, before=before, limit=int(limit) if limit else None
+        )
+        return {
+            "messages": MessageSerializer(messages, many=True).data,
+            "next_cursor": next_cursor,
+        }
+
+    @single_flight()
+    async def db_resolve_read_seq(self, room_id, payload: dict):
+        seq = payload.get("seq")
+        if seq is not None:
+            if not is_read_seq(seq):
+                return None
+            current_seq = await self._redis().get(ChatMessageService._seq_key(room_id))
+            if current_seq is None:
+                current_seq = await db_sync_to_async(ChatMessageService.current_seq)(room_id)
+            return min(seq, int(current_seq))
+
+        message_id = payload.get("message_id")
+        if not message_id:
+            return None
+        try:
+            return await db_sync_to_async(read_seq_query(room_id, message_id).first)()
+        except (ValueError, ValidationError):
+            return None
+
+    @single_flight(ttl=settings.CHAT_SINGLE_FLIGHT_TTL)
+    async def db_get_sync_head(self) -> int:
+        return await db_sync_to_async(ChatChangeLog.head)()
+
+    @single_flight(ttl=settings.CHAT_SINGLE_FLIGHT_TTL)
+    async def db_get_sync_floor(self) -> int:
+        return await db_sync_to_async(ChatChangeLog.floor)()
+
+    @single_flight()
+    async def db_get_changes(self, user_id, after: int, limit: int) -> list:
+        room_ids = await self.db_get_room_ids(user_id)
+        return await db_sync_to_async(ChatChangeLog.changes)(room_ids, user_id, after, limit)
@@ -0,0 +1,79 @@
+"""Bulk group membership helpers for the channel layer.
+
+channels' group_add/group_discard touch one group per call, which with
+channels_redis is one Redis round trip per group. A user in a few hundred
+product chats pays that on every connect and disconnect.
+
+These helpers send the whole batch as one pipeline per Redis shard, writing the
+same keys channels_redis itself writes. Other layers (e.g. InMemoryChannelLayer in
+tests) fall back to the per-group calls.
+"""
+import asyncio
+import time
+from collections import defaultdict
+from typing import Iterable
+
+from channels_redis.core import RedisChannelLayer
+
+
+def _is_redis_layer(channel_layer) -> bool:
+    return isinstance(channel_layer, RedisChannelLayer)
+
+
+def _keys_by_shard(channel_layer: RedisChannelLayer, groups: Iterable[str]):
+    keys_by_shard = defaultdict(list)
+    for group in groups:
+        assert channel_layer.require_valid_group_name(group), "Group name not valid"
+        keys_by_shard[channel_layer.consistent_hash(group)].append(
+            channel_layer._group_key(group)
+        )
+    return keys_by_shard
+
+
+async def group_add_many(channel_layer, groups: Iterable[str], channel: str):
+    """Add a channel to many groups at once."""
+    groups = list(dict.fromkeys(groups))
+    if not groups:
+        return
+
+    if not _is_redis_layer(channel_layer):
+        await asyncio.gather(*(channel_layer.group_add(group, channel) for group in groups))
+        return
+
+    assert channel_layer.require_valid_channel_name(channel), "Channel name not valid"
+    now = time.time()
+
+    async def add_on_shard(index, keys):
+        pipe = channel_layer.connection(index).pipeline(transaction=False)
+        for key in keys:
+            # same as RedisChannelLayer.group_add
+            pipe.zadd(key, {channel: now})
+            pipe.expire(key, channel_layer.group_expiry)
+        await pipe.execute()
+
+    await asyncio.gather(
+        *(add_on_shard(index, keys) for index, keys in _keys_by_shard(channel_layer, groups).items())
+    )
+
+
+async def group_discard_many(channel_layer, groups: Iterable[str], channel: str):
+    """Remove a channel from many groups at once."""
+    groups = list(dict.fromkeys(groups))
+    if not groups:
+        return
+
+    if not _is_redis_layer(channel_layer):
+        await asyncio.gather(*(channel_layer.group_discard(group, channel) for group in groups))
+        return
+
+    assert channel_layer.require_valid_channel_name(channel), "Channel name not valid"
+
+    async def discard_on_shard(index, keys):
+        pipe = channel_layer.connection(index).pipeline(transaction=False)
+        for key in keys:
+            pipe.zrem(key, channel)
+        await pipe.execute()
+
+    await asyncio.gather(
+        *(discard_on_shard(index, keys) for index, keys in _keys_by_shard(channel_layer, groups).items())
+    )
@@ -0,0 +1,92 @@
+"""Wire codecs for the chat WebSocket.
+
+A client picks the frame encoding with the WebSocket subprotocol it offers on connect:
+```
+new WebSocket(url, ["msgpack"])   // binary MessagePack frames
+new WebSocket(url)                // text JSON frames (default)
+```
+Text frames are always decoded as JSON and binary frames as MessagePack, so a
+client can still send the odd JSON frame on a msgpack connection. Outbound frames
+use the negotiated codec.
+"""
+import json
+from typing import Any, Iterable, Optional, Tuple
+
+import msgpack
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class FrameDecodeError(ValueError):
+    pass
+
+
+# Same fallbacks for both codecs (datetime, UUID, Decimal ... -> str)
+_json_encoder = DjangoJSONEncoder()
+
+
+class JSONCodec:
+    subprotocol = "json"
+    binary = False
+
+    def encode(self, data: Any) -> str:
+        # ASCII only, so a frame's len() is its size on the wire
+        return json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=True)
+
+    def decode(self, frame) -> Any:
+        try:
+            return json.loads(frame)
+        except ValueError as e:
+            raise FrameDecodeError(str(e)) from e
+
+
+class MsgPackCodec:
+    subprotocol = "msgpack"
+    binary = True
+
+    def encode(self, data: Any) -> bytes:
+        return msgpack.packb(data, default=_json_encoder.default, use_bin_type=True)
+
+    def decode(self, frame) -> Any:
+        try:
+            return msgpack.unpackb(frame, raw=False)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise FrameDecodeError(str(e)) from e
+
+
+JSON_CODEC = JSONCodec()
+MSGPACK_CODEC = MsgPackCodec()
+DEFAULT_CODEC = JSON_CODEC
+
+# In order of preference when a client offers more than one
+CODECS = {codec.subprotocol: codec for codec in (MSGPACK_CODEC, JSON_CODEC)}
+
+
+def negotiate_codec(subprotocols: Iterable[str]) -> Tuple[Any, Optional[str]]:
+    """Pick a codec from the subprotocols offered by the client.
+
+    Returns the codec and the subprotocol to accept with (None when the client
+    did not offer one we know, in which case it gets plain JSON).
+    """
+    offered = set(subprotocols or ())
+    for subprotocol, codec in CODECS.items():
+        if subprotocol in offered:
+            return codec, subprotocol
+    return DEFAULT_CODEC, None
+
+
+def encode_broadcast(data: Any, ephemeral: bool = False) -> dict:
+    """
+    Channel layer event for group_broadcast_dispatch with the data already
+    encoded once per codec. Recipients forward the frame for their codec as is,
+    so a broadcast to N members costs one encode per codec instead of N.
+
+    Ephemeral events (typing, presence) are the first to be dropped for a
+    client that can't keep up.
+    """
+    event = {
+        "type": "group_broadcast_dispatch",
+        "frames": {subprotocol: codec.encode(data) for subprotocol, codec in CODECS.items()},
+    }
+    if ephemeral:
+        event["ephemeral"] = True
+    return event
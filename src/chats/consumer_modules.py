@@ -1,74 +1,105 @@
 import logging
 import enum
-import json
 import asyncio
-from typing import Dict, Any, Optional
+import uuid
+from typing import Dict, Any, List, Optional
 
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.core.cache import cache
 from django.utils import timezone
 
 from .enums import ERR, BroadCastAction
 from .consumers import AppConsumer # for type hints :)
+from .consumers import ModuleRegistryMeta
+from .presence import presence_heartbeats
+from .typing import typing_indicators
+from .persistence import message_write_behind
+from .metrics import chat_metrics
+from .executor import db_sync_to_async
+from .membership import membership_roles
+from .notifications import chat_notifier
+from .read_receipts import read_watermarks
+from .services import ChatMessageService, InvalidCursor, UnreadCounters
 
 
 logger = logging.getLogger(__name__)
 
+MAX_PRESENCE_LOOKUP = 200  # user ids per PRESENCE:IS_USERS_ONLINE request
+MAX_PRESENCE_WATCH = 200  # user ids one connection can watch with PRESENCE:WATCH
 
 
+def presence_group(user_id) -> str:
+    """Channel layer group of the connections watching a user's presence"""
+    return f"presence_{user_id}"
 
-class BaseModule:
-    """Base class for all WebSocket modules"""
-    
-    def __init__(self, consumer: AppConsumer):
-        self.consumer = consumer
-        self.user = consumer.scope.get('user')
-        self._current_action = ""  # Trust the calling scope to always set this.
-    
 
-    async def on_connect(self):
-        pass
+def parse_user_ids(user_ids) -> Optional[List[str]]:
+    """
+    The user ids of a list as clients send it, as canonical UUID strings
+    (safe in group names). None unless it is a list of at most
+    MAX_PRESENCE_WATCH UUIDs.
+    """
+    if not isinstance(user_ids, list) or len(user_ids) > MAX_PRESENCE_WATCH:
+        return None
+    try:
+        return [str(uuid.UUID(user_id)) for user_id in user_ids]
+    except (AttributeError, TypeError, ValueError):
+        return None
 
 
-    async def on_disconnect(self):
-        pass
+class BaseModule(metaclass=ModuleRegistryMeta):
+    """Base class for all WebSocket modules
 
+    Set `module_name` on a subclass to expose its ACTION_* handlers as
+    WS:<module_name>:<ACTION> (see ModuleRegistryMeta).
 
-    async def on_pong(self):
-        pass
+    Modules are built the first time a connection uses them. The lifecycle
+    hooks are optional, define `async def on_connect/on_disconnect/on_pong(self)`
+    only where needed: a module with an on_connect hook is built on every connect.
+
+    Modules are slotted (ModuleRegistryMeta adds an empty `__slots__` to
+    subclasses that don't declare one), so per connection state must be
+    listed in the subclass' `__slots__`.
+    """
+
+    __slots__ = ("consumer", "user", "_current_action")
+
+    module_name: Optional[str] = None
+    
+    def __init__(self, consumer: AppConsumer):
+        self.consumer = consumer
+        self.user = consumer.scope.get('user')
+        self._current_action = ""  # Trust the calling scope to always set this.
 
     
     async def send_error(self, message: str, code: str = "ERROR"):
         """Send error message to client"""
-        await self.consumer.send(json.dumps({
+        chat_metrics.action_errors[self._current_action] += 1
+        await self.consumer.send_json({
             "type": "error",
             "code": code,
             "message": message,
             "timestamp": timezone.now().isoformat()
-        }))
+        })
     
     async def send_success(self, data: Dict[str, Any]):
         """Send success response to client"""
-        user = getattr(self.user, 'user', None)
         await self.consumer.send_json({
             "type": "success",
             "broadcast": False,
             "action": self._current_action,
             "data": data,
             "timestamp": timezone.now().isoformat(),
-            "sender": {
-                "id": user.id,
-                "username": user.username,
-                "full_name": user.get_name(),
-                "picture_url": user.picture_url,
-            } if user else None,
+            "sender": self.consumer.sender_envelope,
         })
 
 
 class GroupChatModule(BaseModule):
     """Handles all group chat related actions"""
 
+    module_name = "GROUP_CHAT"
+
     async def on_connect(self):
         await self.join_all_group_chat_broadcast()
         
@@ -77,19 +108,13 @@ class GroupChatModule(BaseModule):
 
     async def join_all_group_chat_broadcast(self):
         """Join all group channels user is member of"""
-        # Implementation: Get user's groups and join their channels
-        groups = await self.db_services.db_fetch_groups_for_user()
-        await asyncio.gather(
-            *(self.join_broadcast_group(f"group_{group.id}") for group in groups)
-        )
+        group_ids = await self.consumer.db_services.db_fetch_group_ids_for_user()
+        await self.consumer.join_broadcast_groups(f"group_{group_id}" for group_id in group_ids)
     
     async def leave_all_group_chat_broadcast(self):
         """Leave all group channels"""
-        # Implementation: Leave all group channels
-        groups = await self.db_services.db_fetch_groups_for_user()
-        await asyncio.gather(
-            *(self.leave_broadcast_group(f"group_{group.id}") for group in groups)
-        )
+        group_ids = await self.consumer.db_services.db_fetch_group_ids_for_user()
+        await self.consumer.leave_broadcast_groups(f"group_{group_id}" for group_id in group_ids)
     
     
     async def ACTION_create(self, payload: Dict[str, Any]):
@@ -107,7 +132,7 @@ class GroupChatModule(BaseModule):
             
             # Add creator to group channel
             group_channel = f"group_{group['id']}"
-            await self.consumer.channel_layer.group_add(group_channel, self.consumer.channel_name)
+            await self.consumer.join_broadcast_group(group_channel)
             
             # Notify all members
             await self.consumer.send_group(
@@ -140,8 +165,12 @@ class GroupChatModule(BaseModule):
             if not is_member:
                 return await self.send_error("Not a group member", "UNAUTHORIZED")
             
-            # Save message to database
-            msg_data = await self._save_group_message(group_id, message, message_type, reply_to)
+            # Save message to database, or journal it for a batched write (CHAT_WRITE_BEHIND)
+            if settings.CHAT_WRITE_BEHIND:
+                msg_data = await self._journal_group_message(group_id, message, message_type, reply_to)
+                message_write_behind.schedule_flush()
+            else:
+                msg_data = await self._save_group_message(group_id, message, message_type, reply_to)
             
             # Broadcast to group
             await self.consumer.send_group(
@@ -173,33 +202,65 @@ class GroupChatModule(BaseModule):
         if not group_id:
             return
         
-        # Broadcast to group
-        await self.consumer.send_group(
+        # Coalesced with other typing events and broadcast at a fixed cadence
+        typing_indicators.touch(
             f"group_{group_id}",
-            {
-                "is_typing": is_typing
-            },
-            BroadCastAction.GROUP_TYPING
+            self.user.id,
+            bool(is_typing),
+            BroadCastAction.GROUP_TYPING,
+            {"group_id": group_id},
         )
     
+    async def ACTION_history(self, payload: Dict[str, Any]):
+        """
+        Page backwards through the group's messages.
+        Send the returned next_cursor as `before` for the next (older) page.
+        """
+        group_id = payload.get('group_id')
+        if not group_id:
+            return await self.send_error("Group ID required", ERR.INVALID_INPUT)
+
+        is_member = await self._verify_group_membership(group_id, self.user.id)
+        if not is_member:
+            return await self.send_error("Not a group member", ERR.UNAUTHORIZED)
+
+        try:
+            page = await self._get_group_history(group_id, payload.get('before'), payload.get('limit'))
+        except (InvalidCursor, ValueError, TypeError):
+            return await self.send_error("Invalid cursor or limit", ERR.INVALID_INPUT)
+
+        await self.send_success({"group_id": group_id, **page})
+
     async def ACTION_mark_read(self, payload: Dict[str, Any]):
-        """Mark messages as read"""
+        """
+        Move the user's read watermark in a group.
+        `seq` is the seq of the newest message the client has seen
+        (or send `message_id` and the server looks the seq up).
+        """
         group_id = payload.get('group_id')
-        message_ids = payload.get('message_ids', [])
-        
-        await self._mark_messages_read(group_id, message_ids, self.user.id)
-        
-        # Notify group of read receipts
-        await self.consumer.send_group(
-            f"group_{group_id}",
-            {
-                "user_id": self.user.id,
-                "message_ids": message_ids
-            },
-            BroadCastAction.GROUP_READ_RECIEPT
-        )
+        if not group_id:
+            return await self.send_error("Group ID required", ERR.INVALID_INPUT)
+
+        is_member = await self._verify_group_membership(group_id, self.user.id)
+        if not is_member:
+            return await self.send_error("Not a group member", ERR.UNAUTHORIZED)
+
+        seq = await self._resolve_read_seq(group_id, payload)
+        if seq is None:
+            return await self.send_error("seq or message_id required", ERR.INVALID_INPUT)
+
+        if read_watermarks.advance(group_id, self.user.id, seq):
+            await self.consumer.db_services.redis_reset_unread_count(group_id, seq)
+            await self.consumer.send_group(
+                f"group_{group_id}",
+                {
+                    "group_id": group_id,
+                    "user_id": str(self.user.id),
+                    "last_read_seq": seq,
+                },
+                BroadCastAction.GROUP_READ_RECIEPT
+            )
 
-    
     async def ACTION_add_members(self, payload: Dict[str, Any]):
         """Add members to group"""
         group_id = payload.get('group_id')
@@ -247,10 +308,7 @@ class GroupChatModule(BaseModule):
         group_id = payload.get('group_id')
         
         await self._remove_group_member(group_id, self.user.id)
-        await self.consumer.channel_layer.group_discard(
-            f"group_{group_id}",
-            self.consumer.channel_name
-        )
+        await self.consumer.leave_broadcast_group(f"group_{group_id}")
         
         await self.consumer.channel_layer.group_send(
             f"group_{group_id}",
@@ -281,53 +339,62 @@ class GroupChatModule(BaseModule):
         )
 
     # Database operations (implement with your ORM)
-    @database_sync_to_async
+    @db_sync_to_async
     def _create_group_db(self, name: str, member_ids: list) -> Dict:
         # Implementation: Create group in database
         pass
     
-    @database_sync_to_async
-    def _verify_group_membership(self, group_id: int, user_id: int) -> bool:
-        # Implementation: Check if user is member
-        pass
+    async def _verify_group_membership(self, group_id: int, user_id: int) -> bool:
+        return await membership_roles.is_member(group_id, user_id)
+
+    async def _get_group_history(self, group_id, before: Optional[str], limit) -> Dict:
+        return await self.consumer.db_services.db_get_history_page(group_id, before, limit)
     
-    @database_sync_to_async
-    def _verify_group_admin(self, group_id: int, user_id: int) -> bool:
-        # Implementation: Check if user is admin
-        pass
+    async def _verify_group_admin(self, group_id: int, user_id: int) -> bool:
+        return await membership_roles.is_admin(group_id, user_id)
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _save_group_message(self, group_id: int, message: str, msg_type: str, reply_to: Optional[int]) -> Dict:
-        # Implementation: Save message to database
-        pass
-    
-    @database_sync_to_async
-    def _mark_messages_read(self, group_id: int, message_ids: list, user_id: int):
-        # Implementation: Mark messages as read
-        pass
-    
-    @database_sync_to_async
+        # message_type and reply_to are not stored yet, Message has no columns for them
+        msg_data = ChatMessageService.create_message(group_id, self.user.id, message)
+        UnreadCounters.increment(group_id, self.user.id)
+        return {**msg_data, "message_type": msg_type, "reply_to": reply_to}
+
+    @db_sync_to_async
+    def _journal_group_message(self, group_id: int, message: str, msg_type: str, reply_to: Optional[int]) -> Dict:
+        # Same as _save_group_message but the INSERT happens later, in a batch
+        msg_data = ChatMessageService.build_message(group_id, self.user.id, message)
+        message_write_behind.append(msg_data)
+        UnreadCounters.increment(group_id, self.user.id)
+        return {**msg_data, "message_type": msg_type, "reply_to": reply_to}
+    
+    async def _resolve_read_seq(self, group_id, payload: Dict[str, Any]) -> Optional[int]:
+        return await self.consumer.db_services.db_resolve_read_seq(group_id, payload)
+    
+    @db_sync_to_async
     def _add_group_members(self, group_id: int, member_ids: list):
         # Implementation: Add members to group
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _remove_group_member(self, group_id: int, member_id: int):
         # Implementation: Remove member from group
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _update_group_settings(self, group_id: int, settings: Dict):
         # Implementation: Update group settings
         pass
     
     async def _trigger_group_notifications(self, group_id: int, message: Dict):
-        # Implementation: Trigger push notifications for offline users
-        pass
+        # Offline members are found and notified in batches, see OfflineNotifier
+        chat_notifier.schedule(group_id, self.user.id, message["content"])
 
 
 class DirectChatModule(BaseModule):
     """Handles direct/private chat between two users"""
+
+    module_name = "DIRECT_CHAT"
     
     async def ACTION_send_message(self, payload: Dict[str, Any]):
         """Send direct message"""
@@ -380,32 +447,46 @@ class DirectChatModule(BaseModule):
         if not recipient_id:
             return
         
-        await self.consumer.channel_layer.group_send(
+        # Coalesced with other typing events and broadcast at a fixed cadence
+        typing_indicators.touch(
             f"user_{recipient_id}",
-            {
-                "type": "direct.typing",
-                "user_id": self.user.id,
-                "is_typing": is_typing
-            }
+            self.user.id,
+            bool(is_typing),
+            BroadCastAction.DIRECT_TYPING,
         )
     
     async def ACTION_mark_read(self, payload: Dict[str, Any]):
-        """Mark direct messages as read"""
+        """
+        Move the user's read watermark in a direct chat.
+        `seq` is the seq of the newest message the client has seen
+        (or send `message_id` and the server looks the seq up).
+        """
+        chat_id = payload.get('chat_id')
         sender_id = payload.get('sender_id')
-        message_ids = payload.get('message_ids', [])
-        
-        await self._mark_direct_messages_read(sender_id, message_ids, self.user.id)
-        
-        # Notify sender
-        await self.consumer.channel_layer.group_send(
-            f"user_{sender_id}",
-            {
-                "type": "direct.read_receipt",
-                "user_id": self.user.id,
-                "message_ids": message_ids
-            }
-        )
-    
+        if not chat_id or not sender_id:
+            return await self.send_error("chat_id and sender_id required", ERR.INVALID_INPUT)
+
+        is_member = await self._verify_chat_membership(chat_id, self.user.id)
+        if not is_member:
+            return await self.send_error("Not a chat participant", ERR.UNAUTHORIZED)
+
+        seq = await self._resolve_read_seq(chat_id, payload)
+        if seq is None:
+            return await self.send_error("seq or message_id required", ERR.INVALID_INPUT)
+
+        # Notify the sender (and nobody else)
+        if read_watermarks.advance(chat_id, self.user.id, seq):
+            await self.consumer.db_services.redis_reset_unread_count(chat_id, seq)
+            await self.consumer.send_group(
+                f"user_{sender_id}",
+                {
+                    "chat_id": chat_id,
+                    "user_id": str(self.user.id),
+                    "last_read_seq": seq,
+                },
+                BroadCastAction.DIRECT_READ_RECEIPT
+            )
+
     async def ACTION_delete_message(self, payload: Dict[str, Any]):
         """Delete message for everyone"""
         message_id = payload.get('message_id')
@@ -428,79 +509,127 @@ class DirectChatModule(BaseModule):
             }
         )
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _save_direct_message(self, recipient_id: int, message: str, msg_type: str, reply_to: Optional[int]) -> Dict:
         pass
     
-    @database_sync_to_async
-    def _mark_direct_messages_read(self, sender_id: int, message_ids: list, user_id: int):
-        pass
+    async def _verify_chat_membership(self, chat_id, user_id) -> bool:
+        return await membership_roles.is_member(chat_id, user_id)
+
+    async def _resolve_read_seq(self, chat_id, payload: Dict[str, Any]) -> Optional[int]:
+        return await self.consumer.db_services.db_resolve_read_seq(chat_id, payload)
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _verify_message_owner(self, message_id: int, user_id: int) -> bool:
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _delete_direct_message(self, message_id: int):
         pass
     
     async def _trigger_direct_notification(self, recipient_id: int, message: Dict):
+        # Not scheduled with chat_notifier until _save_direct_message stores the
+        # message: a notification would point at nothing in the history.
         pass
 
 
 class PresenceModule(BaseModule):
     """Handles user online/offline status and activity"""
 
+    __slots__ = ("watching",)
+
+    module_name = "PRESENCE"
+
+    def __init__(self, consumer: AppConsumer):
+        super().__init__(consumer)
+        self.watching = set()  # user ids this connection gets presence updates for
+
     async def on_connect(self):
         await self.handle_user_online()
     
     async def on_disconnect(self):
         await self.handle_user_offline()
+        await self.consumer.leave_broadcast_groups(presence_group(user_id) for user_id in self.watching)
+        self.watching = set()
     
     async def on_pong(self):
-        await self.redis_refresh_online_status()
+        await self.consumer.db_services.refresh_online_status()
         # await self.handle_user_online() # would have called this instead but again UNNCESSARY
 
     async def handle_user_online(self):
         """Called when user connects"""
-        # await self._set_user_online(self.user.id)
         await self.consumer.db_services.redis_i_am_onine()
         
-        # Notify contacts
-        # (This is uncessary load on the server)
-        # contact_ids = await self._get_user_contacts(self.user.id)
-        # await asyncio.gather(
-        #     *(
-        #         self.consumer.channel_layer.group_send(
-        #             f"user_{contact_id}",
-        #             {
-        #                 "type": BroadCastAction.PRESENCE_USER_ONLINE,
-        #             }
-        #         )
-        #         for contact_id in contact_ids
-        #     )
-        # )
+        # Notify watchers only (see ACTION_watch). Pushing to every contact
+        # was uncessary load on the server.
+        await self.consumer.send_group(
+            presence_group(self.user.id),
+            {
+                "user_id": self.user.id,
+                "is_online": True,
+                "last_seen": timezone.now().isoformat(),
+            },
+            BroadCastAction.PRESENCE_USER_ONLINE
+        )
     
     async def handle_user_offline(self):
         """Called when user disconnects"""
+        presence_heartbeats.discard(self.user.id)
         await self.consumer.db_services.redis_i_am_offline()
         
-        # Notify contacts
-        # (This is uncessary load on the server)
-        # contact_ids = await self._get_user_contacts(self.user.id)
-        # await asyncio.gather(
-        #     *(
-        #         self.consumer.channel_layer.group_send(
-        #             f"user_{contact_id}",
-        #             {
-        #                 "type": BroadCastAction.PRESENCE_USER_OFFLINE,
-        #                 "user_id": self.user.id,
-        #                 "last_seen": timezone.now().isoformat()
-        #             }
-        #         )
-        #         for contact_id in contact_ids
-        #     )
-        # )
+        await self.consumer.send_group(
+            presence_group(self.user.id),
+            {
+                "user_id": self.user.id,
+                "is_online": False,
+                "last_seen": timezone.now().isoformat(),
+            },
+            BroadCastAction.PRESENCE_USER_OFFLINE
+        )
+
+    async def ACTION_watch(self, payload: Dict[str, Any]):
+        """Set the users whose presence this connection wants pushed to it.
+
+        Replaces the previous watch list, so clients send the ids on screen
+        every time it changes. Answers with the current presence of newly
+        watched users.
+        """
+        user_ids = parse_user_ids(payload.get('user_ids', []))
+
+        if user_ids is None:
+            return await self.send_error(
+                f"user_ids must be a list of at most {MAX_PRESENCE_WATCH} user ids", ERR.INVALID_INPUT
+            )
+
+        watching = set(user_ids)
+        added = watching - self.watching
+        removed = self.watching - watching
+
+        await asyncio.gather(
+            self.consumer.join_broadcast_groups(presence_group(user_id) for user_id in added),
+            self.consumer.leave_broadcast_groups(presence_group(user_id) for user_id in removed),
+        )
+        self.watching = watching
+
+        users = await self.consumer.db_services.redis_get_users_presence(list(added)) if added else []
+        await self.send_success({"users": users})
+
+    async def ACTION_unwatch(self, payload: Dict[str, Any]):
+        """Stop presence updates for some users, or for everyone if no ids are given"""
+        user_ids = payload.get('user_ids')
+
+        if user_ids is not None:
+            user_ids = parse_user_ids(user_ids)
+            if user_ids is None:
+                return await self.send_error(
+                    f"user_ids must be a list of at most {MAX_PRESENCE_WATCH} user ids", ERR.INVALID_INPUT
+                )
+
+        removed = self.watching & set(user_ids) if user_ids else self.watching
+
+        await self.consumer.leave_broadcast_groups(presence_group(user_id) for user_id in removed)
+        self.watching = self.watching - removed
+        await self.send_success({"user_ids": list(removed)})
     
     async def ACTION_is_user_online(self, payload: Dict[str, Any]):
         """Check if a user is online"""
@@ -509,9 +638,25 @@ class PresenceModule(BaseModule):
         is_online = await self.consumer.db_services.redis_is_user_online(user_id)
         await self.send_success({"user_id": user_id, "is_online": is_online})
 
+    async def ACTION_is_users_online(self, payload: Dict[str, Any]):
+        """Check online status and last seen time of many users at once"""
+        user_ids = payload.get('user_ids', [])
+
+        if not isinstance(user_ids, list) or not user_ids:
+            return await self.send_error("user_ids must be a non-empty list", ERR.INVALID_INPUT)
+        if len(user_ids) > MAX_PRESENCE_LOOKUP:
+            return await self.send_error(
+                f"At most {MAX_PRESENCE_LOOKUP} user_ids per request", ERR.INVALID_INPUT
+            )
+
+        users = await self.consumer.db_services.redis_get_users_presence(list(dict.fromkeys(user_ids)))
+        await self.send_success({"users": users})
+
 
 class NotificationModule(BaseModule):
     """Handles in-app notifications"""
+
+    module_name = "NOTIFICATION"
     
     async def ACTION_fetch(self, payload: Dict[str, Any]):
         """Fetch unread notifications"""
@@ -543,21 +688,23 @@ class NotificationModule(BaseModule):
             }
         )
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _get_notifications(self, user_id: int, limit: int, offset: int) -> list:
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _mark_notifications_read(self, notification_ids: list, user_id: int):
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _mark_all_notifications_read(self, user_id: int) -> int:
         pass
 
 
 class CallModule(BaseModule):
     """Handles voice and video calls (signaling)"""
+
+    module_name = "CALL"
     
     async def ACTION_initiate(self, payload: Dict[str, Any]):
         """Initiate a call"""
@@ -661,22 +808,24 @@ class CallModule(BaseModule):
             }
         )
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _create_call_session(self, caller_id: int, recipient_id: Optional[int], 
                             call_type: str, is_group: bool, group_id: Optional[int]) -> Dict:
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _update_call_status(self, call_id: int, status: str):
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _get_call_data(self, call_id: int) -> Dict:
         pass
 
 
 class MediaModule(BaseModule):
     """Handles media upload/download operations"""
+
+    module_name = "MEDIA"
     
     async def ACTION_upload_request(self, payload: Dict[str, Any]):
         """Request upload URL for media"""
@@ -711,23 +860,25 @@ class MediaModule(BaseModule):
         
         await self.send_success({"download_url": download_url})
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _generate_upload_url(self, user_id: int, file_name: str, file_size: int, 
                             file_type: str, mime_type: str) -> Dict:
         # Generate S3 presigned URL or similar
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _mark_upload_complete(self, media_id: int):
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _generate_download_url(self, media_id: int, user_id: int) -> str:
         pass
 
 
 class ContactModule(BaseModule):
     """Handles contact management"""
+
+    module_name = "CONTACT"
     
     async def ACTION_add(self, payload: Dict[str, Any]):
         """Add new contact"""
@@ -777,29 +928,31 @@ class ContactModule(BaseModule):
         matched_contacts = await self._sync_contacts(self.user.id, phone_numbers)
         await self.send_success({"contacts": matched_contacts})
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _add_contact(self, user_id: int, contact_id: int):
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _remove_contact(self, user_id: int, contact_id: int):
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _block_user(self, user_id: int, blocked_id: int):
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _unblock_user(self, user_id: int, unblocked_id: int):
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _sync_contacts(self, user_id: int, phone_numbers: list) -> list:
         pass
 
 
 class StoryModule(BaseModule):
     """Handles WhatsApp-like status/stories"""
+
+    module_name = "STORY"
     
     async def ACTION_post(self, payload: Dict[str, Any]):
         """Post a new story"""
@@ -856,37 +1009,39 @@ class StoryModule(BaseModule):
         stories = await self._get_contact_stories(self.user.id)
         await self.send_success({"stories": stories})
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _create_story(self, user_id: int, media_id: int, caption: Optional[str], media_type: str) -> Dict:
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _mark_story_viewed(self, story_id: int, viewer_id: int):
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _get_story_owner(self, story_id: int) -> int:
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _verify_story_owner(self, story_id: int, user_id: int) -> bool:
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _delete_story(self, story_id: int):
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _get_contact_stories(self, user_id: int) -> list:
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _get_user_contacts(self, user_id: int) -> list:
         pass
 
 
 class SyncModule(BaseModule):
     """Handles multi-device synchronization"""
+
+    module_name = "SYNC"
     
     async def ACTION_register_device(self, payload: Dict[str, Any]):
         """Register new device"""
@@ -898,11 +1053,40 @@ class SyncModule(BaseModule):
         await self.send_success({"device_id": device_id})
     
     async def ACTION_request_sync(self, payload: Dict[str, Any]):
-        """Request full data sync"""
-        last_sync_timestamp = payload.get('last_sync_timestamp')
-        
-        sync_data = await self._get_sync_data(self.user.id, last_sync_timestamp)
-        await self.send_success({"sync_data": sync_data})
+        """
+        Send the changes (messages, membership, reactions, pins, notifications)
+        after the client's last sync sequence, in chunks:
+        ```
+        {"changes": [...], "cursor": 1042, "has_more": true}
+        ```
+        Each chunk's cursor is the sequence to store once its changes are applied.
+        After CHAT_SYNC_MAX_CHUNKS chunks has_more stays true and the client asks
+        again from the last cursor. A client without a cursor, or with one older
+        than the sync log keeps (CHAT_SYNC_RETENTION), gets
+        {"reset": true, "cursor": <latest>, "unread_counts": {<room id>: <count>}}
+        and should load the rest of its state (history) over REST before
+        syncing from that cursor.
+        """
+        cursor = payload.get('cursor')
+        if cursor is None:
+            return await self._send_reset()
+
+        try:
+            cursor = int(cursor)
+        except (TypeError, ValueError):
+            return await self.send_error("Invalid cursor", ERR.INVALID_INPUT)
+        if cursor < await self._get_sync_floor():
+            return await self._send_reset()
+
+        chunk_size = settings.CHAT_SYNC_CHUNK_SIZE
+        for _ in range(settings.CHAT_SYNC_MAX_CHUNKS):
+            changes = await self._get_changes(self.user.id, cursor, chunk_size)
+            if changes:
+                cursor = changes[-1]["seq"]
+            has_more = len(changes) == chunk_size
+            await self.send_success({"changes": changes, "cursor": cursor, "has_more": has_more})
+            if not has_more:
+                break
     
     async def ACTION_unregister_device(self, payload: Dict[str, Any]):
         """Unregister device"""
@@ -919,21 +1103,36 @@ class SyncModule(BaseModule):
             }
         )
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _register_device(self, user_id: int, device_id: str, device_type: str, device_name: str):
         pass
     
-    @database_sync_to_async
-    def _get_sync_data(self, user_id: int, last_sync_timestamp: Optional[str]) -> Dict:
-        pass
+    async def _send_reset(self):
+        head, unread_counts = await asyncio.gather(
+            self._get_sync_head(), self.consumer.db_services.redis_get_unread_counts()
+        )
+        await self.send_success({
+            "reset": True, "changes": [], "cursor": head, "has_more": False, "unread_counts": unread_counts,
+        })
+
+    async def _get_sync_head(self) -> int:
+        return await self.consumer.db_services.db_get_sync_head()
+
+    async def _get_sync_floor(self) -> int:
+        return await self.consumer.db_services.db_get_sync_floor()
+
+    async def _get_changes(self, user_id, after: int, limit: int) -> list:
+        return await self.consumer.db_services.db_get_changes(user_id, after, limit)
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _unregister_device(self, user_id: int, device_id: str):
         pass
 
 
 class SettingsModule(BaseModule):
     """Handles user settings and preferences"""
+
+    module_name = "SETTINGS"
     
     async def ACTION_update(self, payload: Dict[str, Any]):
         """Update user settings"""
@@ -966,21 +1165,23 @@ class SettingsModule(BaseModule):
         await self._update_notification_settings(self.user.id, notification_settings)
         await self.send_success({"notification_settings": notification_settings})
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _update_user_settings(self, user_id: int, settings: Dict):
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _update_privacy_settings(self, user_id: int, privacy_settings: Dict):
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _update_notification_settings(self, user_id: int, notification_settings: Dict):
         pass
 
 
 class EncryptionModule(BaseModule):
     """Handles end-to-end encryption key exchange"""
+
+    module_name = "ENCRYPTION"
     
     async def ACTION_exchange_keys(self, payload: Dict[str, Any]):
         """Exchange encryption keys"""
@@ -1007,11 +1208,11 @@ class EncryptionModule(BaseModule):
         keys = await self._get_public_keys(contact_ids)
         await self.send_success({"keys": keys})
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _store_public_key(self, user_id: int, recipient_id: int, public_key: str):
         pass
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _get_public_keys(self, contact_ids: list) -> Dict:
         pass
 
@@ -1031,7 +1232,7 @@ class Me(BaseModule):
         await self._update_user_profile(self.user.id, profile_data)
         await self.send_success({"profile": profile_data})
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _get_user_profile(self, user_id: int) -> Dict:
         return {
             "user_id": user_id,
@@ -1040,7 +1241,7 @@ class Me(BaseModule):
         }
     
     
-    @database_sync_to_async
+    @db_sync_to_async
     def _update_user_profile(self, user_id: int, profile_data: Dict):
         pass
 
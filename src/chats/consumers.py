@@ -1,14 +1,14 @@
 # consumers.py
-import json
 import logging
 import sys
 import enum
 import asyncio
-from typing import Dict, Any, Optional
+import time
+from importlib import import_module
+from typing import Dict, Any, Optional, Callable, NamedTuple, Iterable, List
 
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.core.cache import cache
+from django.conf import settings
 from django.utils import timezone
 
 from src.users.models import User
@@ -22,13 +22,77 @@ from src.chats.models import (
 )
 
 
-from .enums import ERR, BroadCastAction
+from .enums import ERR, EPHEMERAL_BROADCASTS, BroadCastAction
+from .channel_layer import group_add_many, group_discard_many
+from .serializers import MessageSerializer
+from .services import (
+    ChatChangeLog,
+    ChatHistoryService,
+    ChatMembershipIndex,
+    UnreadCounters,
+    resolve_read_seq,
+)
+from . import presence
+from .heartbeat import heartbeats
+from .outbound import OutboundQueue
+from .metrics import chat_metrics
+from .executor import db_sync_to_async
+from .membership import membership_roles
+from .singleflight import single_flight, single_flights
+from .async_services import AsyncChatReadServiceMixin
+from .ratelimit import ConnectionRateLimiter, user_rate_limiter
+from .codecs import (
+    DEFAULT_CODEC,
+    JSON_CODEC,
+    MSGPACK_CODEC,
+    FrameDecodeError,
+    encode_broadcast,
+    negotiate_codec,
+)
 
 logger = logging.getLogger(__name__)
 
 
 
-SEND_PING_INTERVAL = 30  # seconds
+
+ACTION_PREFIX = "ACTION_"
+
+
+class ActionRoute(NamedTuple):
+    module_name: str  # e.g. GROUP_CHAT
+    action_name: str  # e.g. SEND_MESSAGE
+    handler: Callable  # unbound ACTION_* function, called as handler(module, payload=...)
+
+
+# These tables are filled by ModuleRegistryMeta when consumer_modules is imported.
+# ACTION_ROUTES is keyed by the normalized wire action, e.g. "WS:GROUP_CHAT:SEND_MESSAGE"
+# MODULE_HOOKS lists the modules that define each lifecycle hook, e.g. {"on_connect": ["GROUP_CHAT", ...]}
+LIFECYCLE_HOOKS = ("on_connect", "on_disconnect", "on_pong")
+MODULE_CLASSES: Dict[str, type] = {}
+ACTION_ROUTES: Dict[str, ActionRoute] = {}
+MODULE_HOOKS: Dict[str, List[str]] = {hook: [] for hook in LIFECYCLE_HOOKS}
+
+
+class LazyModules(dict):
+    """
+    The module instances of one connection, {module name: module}.
+    A module is built on first lookup, so a connection only pays for the
+    modules it uses.
+    """
+
+    __slots__ = ("consumer",)
+
+    def __init__(self, consumer):
+        super().__init__()
+        self.consumer = consumer
+
+    def __missing__(self, module_name: str):
+        module = self[module_name] = MODULE_CLASSES[module_name](self.consumer)
+        return module
+
+    async def run_hook(self, hook: str):
+        """Run a lifecycle hook (e.g. "on_connect") of every module that defines it"""
+        await asyncio.gather(*(getattr(self[module_name], hook)() for module_name in MODULE_HOOKS[hook]))
 
 
 class GroupManagerMixin:
@@ -40,39 +104,53 @@ class GroupManagerMixin:
             group_name,
             self.channel_name
         )
+        self._count_joins(1)
 
     async def leave_broadcast_group(self, group_name: str):
         await self.channel_layer.group_discard(
             group_name,
             self.channel_name
         )
+        self._count_joins(-1)
+
+    async def join_broadcast_groups(self, group_names: Iterable[str]):
+        """Join many groups in one pipelined round trip (per Redis shard)."""
+        group_names = list(group_names)
+        await group_add_many(self.channel_layer, group_names, self.channel_name)
+        self._count_joins(len(group_names))
+
+    async def leave_broadcast_groups(self, group_names: Iterable[str]):
+        """Leave many groups in one pipelined round trip (per Redis shard)."""
+        group_names = list(group_names)
+        await group_discard_many(self.channel_layer, group_names, self.channel_name)
+        self._count_joins(-len(group_names))
+
+    def _count_joins(self, delta: int):
+        """
+        Track this connection's groups in chat_metrics.group_joins. Leaving
+        groups it never joined (discard is a no-op for those) can't take more
+        off the gauge than the connection added, and disconnect() takes off
+        (and logs) the groups that were never left.
+        """
+        delta = max(delta, -self.joined_groups)
+        self.joined_groups += delta
+        chat_metrics.group_joins += delta
 
     async def send_group(self, group_name: str, payload: Dict[str, Any], broadcast_action: BroadCastAction):
         """
         Sends a broadcast event to all members of a group.
+        The frame is encoded here, once, and forwarded as is by every recipient.
         """
-
-        user = getattr(self, "user", None) or getattr(self, "_user", None)
-
         data = {
             "broadcast": True,
             "action": broadcast_action.value,
             "payload": payload,
             "timestamp": timezone.now().isoformat(),
-            "sender": {
-                "id": user.id,
-                "username": user.username,
-                "full_name": user.get_name(),
-                "picture_url": user.picture_url,
-            } if user else None,
+            "sender": getattr(self, "sender_envelope", None),
         }
 
         await self.channel_layer.group_send(
-            group_name,
-            {
-                "type": "group_broadcast_dispatch",
-                "data": data,
-            }
+            group_name, encode_broadcast(data, ephemeral=broadcast_action in EPHEMERAL_BROADCASTS)
         )
 
     async def group_broadcast_dispatch(self, event: Dict[str, Any]):
@@ -80,7 +158,13 @@ class GroupManagerMixin:
         One universal handler for all group events.
         Send's messages to my client/browser/app
         """
-        await self.send_json(event["data"])
+        frames = event.get("frames")
+        if frames is None:
+            frame = self.codec.encode(event["data"])
+        else:
+            frame = frames[self.codec.subprotocol]
+        # sent by the queue's writer, so a slow client can't hold up this consumer
+        self.outbound.put(frame, ephemeral=event.get("ephemeral", False))
 
 
 
@@ -89,27 +173,25 @@ class AppConsumer(GroupManagerMixin, AsyncWebsocketConsumer):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.modules = {}
-        self.ping_task = None
+        self.modules = LazyModules(self)
+        self.heartbeat_slot = None  # set by the heartbeat scheduler
+        self.missed_pongs = 0
         self.user = None
-        self.db_services = DatabaseServices(consumer=self)
+        self.sender_envelope = None  # built once in connect(), sent with every broadcast
+        self.codec = DEFAULT_CODEC  # negotiated in connect()
+        self.db_services = DATABASE_SERVICES[settings.CHAT_DB_SERVICES](consumer=self)
+        self.outbound = OutboundQueue(
+            self, max_size=settings.CHAT_OUTBOUND_QUEUE_SIZE, max_buffer=settings.CHAT_OUTBOUND_BUFFER_BYTES
+        )
+        self.rate_limiter = ConnectionRateLimiter()
+        self.joined_groups = 0  # this connection's share of chat_metrics.group_joins
     
     async def connect(self):
         """Handle WebSocket connection"""
-        # Import modules here to avoid circular imports
-        from .consumer_modules import (
-            GroupChatModule,
-            DirectChatModule,
-            PresenceModule,
-            NotificationModule,
-            CallModule,
-            MediaModule,
-            ContactModule,
-            StoryModule,
-            SyncModule,
-            SettingsModule,
-            EncryptionModule,
-        )
+        # Import modules here to avoid circular imports.
+        # Importing them also fills MODULE_CLASSES and ACTION_ROUTES.
+        import_module(".consumer_modules", __package__)
+
         # Authentication check
         self.user = self.scope.get('user')
         
@@ -118,38 +200,30 @@ class AppConsumer(GroupManagerMixin, AsyncWebsocketConsumer):
             await self.close(code=4001)
             return
         
-        await self.accept()
+        # JSON text frames unless the client asked for a binary subprotocol
+        self.codec, subprotocol = negotiate_codec(self.scope.get('subprotocols'))
+        await self.accept(subprotocol=subprotocol)
+        chat_metrics.connection_opened()
         logger.info(f"User {self.user.id} connected")
 
         self.db_services.user = self.user
-        
-        # Initialize all modules
-        self.modules = {
-            'GROUP_CHAT': GroupChatModule(self),
-            'DIRECT_CHAT': DirectChatModule(self),
-            'PRESENCE': PresenceModule(self),
-            'NOTIFICATION': NotificationModule(self),
-            'CALL': CallModule(self),
-            'MEDIA': MediaModule(self),
-            'CONTACT': ContactModule(self),
-            'STORY': StoryModule(self),
-            'SYNC': SyncModule(self),
-            'SETTINGS': SettingsModule(self),
-            'ENCRYPTION': EncryptionModule(self),
+        self.sender_envelope = {
+            "id": str(self.user.id),
+            "username": self.user.username,
+            "full_name": self.user.get_name(),
+            "picture_url": self.user.picture_url,
         }
         
         # Join user's personal channel (for multi-device sync)
         await self.join_broadcast_group(f"user_{self.user.id}")
         
-        # for module in self.modules.values():
-        #     if hasattr(module, 'on_connect'):
-        #         await module.on_connect() # eg. await self.modules['PRESENCE'].handle_user_online()
-        await asyncio.gather(
-            *(m.on_connect() for m in self.modules.values() if hasattr(m, "on_connect"))
-        )
+        # Builds the modules with an on_connect hook, the rest wait for their first action
+        await self.modules.run_hook("on_connect")
 
-        # Start heartbeat
-        self.ping_task = asyncio.create_task(self.ping_loop())
+        # Pinged by the process-wide heartbeat scheduler from now on
+        heartbeats.register(self)
+        # Keeps this worker's cached chat roles fresh while it has connections
+        membership_roles.register(self.channel_layer)
         
         # Send connection confirmation
         await self.send_json({
@@ -164,22 +238,22 @@ class AppConsumer(GroupManagerMixin, AsyncWebsocketConsumer):
         if not self.user or not self.user.is_authenticated:
             return
         
-        # Stop heartbeat
-        if self.ping_task:
-            self.ping_task.cancel()
+        # Stop heartbeat and drop undelivered broadcasts
+        heartbeats.unregister(self)
+        membership_roles.unregister()
+        self.outbound.close()
+        chat_metrics.connection_closed()
         
-        # for module in self.modules.values():
-        #     if hasattr(module, 'on_disconnect'):
-        #         await module.on_disconnect() # eg. await self.modules['PRESENCE'].handle_user_offline()
-        await asyncio.gather(
-            *(m.on_disconnect() for m in self.modules.values() if hasattr(m, "on_disconnect"))
-        )
+        await self.modules.run_hook("on_disconnect")
 
         # Leave user's personal channel
+        # (group channels are left by GroupChatModule.on_disconnect)
         await self.leave_broadcast_group(f"user_{self.user.id}")
-        
-        # Leave all group channels
-        await self.leave_user_groups()
+        if self.joined_groups:
+            # joined but not left above (e.g. a room the user was removed from meanwhile):
+            # channels_redis keeps them until group_expiry, this only takes them off the gauge
+            logger.warning(f"User {self.user.id} disconnected with {self.joined_groups} groups not left")
+            self._count_joins(-self.joined_groups)
         
         logger.info(f"User {self.user.id} disconnected (code: {close_code})")
 
@@ -187,73 +261,116 @@ class AppConsumer(GroupManagerMixin, AsyncWebsocketConsumer):
     async def receive(self, text_data=None, bytes_data=None):
         """Handle incoming WebSocket messages"""
         # actions format MY_ACTION
+        # Any frame proves the socket is alive, not just a pong
+        heartbeats.alive(self)
         try:
-            if not text_data:
+            if text_data:
+                chat_metrics.frame_in(len(text_data.encode()))
+            elif bytes_data:
+                chat_metrics.frame_in(len(bytes_data))
+            else:
                 return
-            
-            data = json.loads(text_data)
+
+            # Connection bucket before any decoding, so flooding with junk costs as much as with actions
+            retry_after = self.rate_limiter.check_frame()
+            if retry_after:
+                await self.send_error(f"Rate limit exceeded, retry in {retry_after:.2f}s", ERR.RATE_LIMITED)
+                return
+
+            data = JSON_CODEC.decode(text_data) if text_data else MSGPACK_CODEC.decode(bytes_data)
+
+            if not isinstance(data, dict):
+                await self.send_error("Invalid action format", ERR.INVALID_ACTION)
+                return
+
             action = data.get('action')
             payload = data.get('payload', {})
             
             # Handle heartbeat pong
             if action == 'pong':
-                await asyncio.gather(
-                    *(m.on_pong() for m in self.modules.values() if hasattr(m, "on_pong"))
-                )
-                return
-            
-            action = action.upper()
-
-            # Parse action format: WS:MODULE:ACTION
-            if not action or not action.startswith('WS:'):
-                await self.send_error("Invalid action format", ERR.INVALID_ACTION)
+                await self.modules.run_hook("on_pong")
                 return
             
-            parts = action.split(':')
-            if len(parts) < 3:
+            if not isinstance(action, str):
                 await self.send_error("Invalid action format", ERR.INVALID_ACTION)
                 return
-            
-            module_name = parts[1].strip().lower() # MODULE
-            action_name = parts[2].strip().lower() # ACTION
-            
-            # Get module
-            module = self.modules.get(module_name)
 
-            if not module:
-                await self.send_error(f"Module '{module_name}' not found", ERR.MODULE_NOT_FOUND)
+            # Action format: WS:MODULE:ACTION, resolved with a single lookup
+            action = action.strip().upper()
+            route = ACTION_ROUTES.get(action)
+            if route is None:
+                message, code = self._describe_unknown_action(action)
+                await self.send_error(message, code)
                 return
-            
 
-            # Get action handler
-            handler_name = f"ACTION_{action_name}"
-            handler = getattr(module, handler_name, None)
-            
-            if not handler or not callable(handler):
-                await self.send_error(f"Action '{action_name}' not found in module '{module_name}'", ERR.ACTION_NOT_FOUND)
+            # Connection buckets before the user's, so a flooding client never reaches Redis
+            retry_after = self.rate_limiter.check(route.module_name, route.action_name)
+            if not retry_after:
+                retry_after = await user_rate_limiter.check(getattr(self.user, "id", None))
+            if retry_after:
+                await self.send_error(f"Rate limit exceeded, retry in {retry_after:.2f}s", ERR.RATE_LIMITED)
                 return
-            
-            # Execute action
-            module._current_action = action 
-            await handler(payload=payload)
-            
-        except json.JSONDecodeError:
-            await self.send_error("Invalid JSON format", ERR.INVALID_JSON)
+
+            module = self.modules[route.module_name]
+            module._current_action = action
+            started = time.perf_counter()
+            try:
+                await route.handler(module, payload=payload)
+            except Exception:
+                chat_metrics.observe_action(action, time.perf_counter() - started, failed=True)
+                raise
+            chat_metrics.observe_action(action, time.perf_counter() - started)
+
+        except FrameDecodeError:
+            if bytes_data:
+                await self.send_error("Invalid MessagePack frame", ERR.INVALID_FRAME)
+            else:
+                await self.send_error("Invalid JSON format", ERR.INVALID_JSON)
         except Exception as e:
             logger.error(f"Error handling message: {str(e)}", exc_info=True)
             await self.send_error("Internal server error", ERR.INTERNAL_ERROR)
     
 
-    async def ping_loop(self):
-        """Heartbeat loop to keep connection alive"""
-        try:
-            while True:
-                await asyncio.sleep(SEND_PING_INTERVAL)  # Send ping every 30 seconds
-                await self.send_json({"type": "ping"})
-        except asyncio.CancelledError:
-            pass
-        except Exception as e:
-            logger.error(f"Ping loop error: {str(e)}")
+    def _describe_unknown_action(self, action: str):
+        """Work out why an action has no route. Only runs on the (rare) miss path."""
+        parts = [part.strip() for part in action.split(':')]
+        if len(parts) < 3 or parts[0] != 'WS':
+            return "Invalid action format", ERR.INVALID_ACTION
+
+        module_name, action_name = parts[1], parts[2]
+        normalized = f"WS:{module_name}:{action_name}"
+        if normalized != action and normalized in ACTION_ROUTES:
+            return "Invalid action format", ERR.INVALID_ACTION
+        if module_name not in MODULE_CLASSES:
+            return f"Module '{module_name}' not found", ERR.MODULE_NOT_FOUND
+        return f"Action '{action_name}' not found in module '{module_name}'", ERR.ACTION_NOT_FOUND
+
+    async def send_json(self, content: Dict[str, Any]):
+        """Encode content with the negotiated codec and send it to the client"""
+        await self.send_frame(self.codec.encode(content))
+
+    async def send_frame(self, frame):
+        """Send an already encoded frame (bytes for binary codecs, str for JSON)"""
+        if isinstance(frame, bytes):
+            chat_metrics.frame_out(len(frame))
+            await self.send(bytes_data=frame)
+        else:
+            chat_metrics.frame_out(len(frame))  # JSON frames are ASCII (ensure_ascii), so this is the byte size
+            await self.send(text_data=frame)
+
+    async def send_error(self, message: str, code: str = "ERROR"):
+        """Send error message to client"""
+        chat_metrics.frame_errors[code] += 1
+        await self.send_json({
+            "type": "error",
+            "code": code,
+            "message": message,
+            "timestamp": timezone.now().isoformat()
+        })
+
+    async def send_ping(self):
+        """Called by the heartbeat scheduler"""
+        await self.send_json({"type": "ping"})
     
     
 
@@ -261,7 +378,8 @@ class AppConsumer(GroupManagerMixin, AsyncWebsocketConsumer):
 
 
 class AutoDBMeta(type):
-    """Metaclass to auto-wrap db_ methods with database_sync_to_async.
+    """Metaclass to auto-wrap db_ methods with database_sync_to_async
+    (db_sync_to_async, which runs them on the DBExecutor pool).
     
     Similar to doing this manually:
     ```
@@ -285,46 +403,201 @@ class AutoDBMeta(type):
     >>> service = Service()
     >>> result = await service.db_method(args)
     ```
+
+    db_/redis_ methods defined on plain mixins are wrapped as well.
+    Methods that are already async (e.g. the native async reads of
+    AsyncChatReadServiceMixin) are not wrapped.
+
+    Methods marked with @single_flight are then coalesced: concurrent calls
+    with equal arguments, from any connection of the process, share one call.
     """
+    @staticmethod
+    def is_db_method(attr_name, attr_value):
+        return callable(attr_value) and (attr_name.startswith("db_") or attr_name.startswith("redis_"))
+
     def __new__(cls, name, bases, attrs):
+        # Mixins are not built by this metaclass, so lift their methods up to be wrapped here
+        inherited = {}
+        for base in reversed(bases):
+            if isinstance(base, AutoDBMeta):
+                continue
+            for klass in reversed(base.__mro__):
+                inherited.update(
+                    (attr_name, attr_value) for attr_name, attr_value in vars(klass).items()
+                    if cls.is_db_method(attr_name, attr_value)
+                )
+        for attr_name, attr_value in inherited.items():
+            attrs.setdefault(attr_name, attr_value)
+
         for attr_name, attr_value in attrs.items():
-            if callable(attr_value) and (attr_name.startswith("db_") or attr_name.startswith("redis_")):
+            if cls.is_db_method(attr_name, attr_value):
                 # wrap it if not already wrapped
-                method = database_sync_to_async(attr_value)
+                method = attr_value
+                if not asyncio.iscoroutinefunction(method):
+                    method = db_sync_to_async(method)
+                options = getattr(attr_value, "single_flight", None)
+                if options is not None:
+                    method = single_flights.wrap(method, options)
                 attrs[attr_name] = method
         return super().__new__(cls, name, bases, attrs)
 
 
+class ModuleRegistryMeta(type):
+    """Metaclass to register consumer modules and their ACTION_* handlers.
+
+    Any module class that sets `module_name` is added to MODULE_CLASSES, and each
+    of its ACTION_* methods (inherited ones included) gets an entry in ACTION_ROUTES:
+    ```
+    >>> class GroupChatModule(BaseModule):
+            module_name = "GROUP_CHAT"
+
+            async def ACTION_send_message(self, payload): ...
+
+    >>> ACTION_ROUTES["WS:GROUP_CHAT:SEND_MESSAGE"].handler
+    <function GroupChatModule.ACTION_send_message>
+    ```
+
+    The table is built once, at import time, so AppConsumer.receive resolves an
+    action with a single dict lookup.
+
+    Module classes get an empty `__slots__` unless they declare their own, so
+    module instances (one per module a connection uses) carry no `__dict__`.
+    """
+    def __new__(cls, name, bases, attrs):
+        attrs.setdefault("__slots__", ())
+        module_class = super().__new__(cls, name, bases, attrs)
+        module_name = attrs.get("module_name")
+        if not module_name:
+            return module_class
+
+        MODULE_CLASSES[module_name] = module_class
+        for hook in LIFECYCLE_HOOKS:
+            if hasattr(module_class, hook) and module_name not in MODULE_HOOKS[hook]:
+                MODULE_HOOKS[hook].append(module_name)
+        for attr_name in dir(module_class):
+            if not attr_name.startswith(ACTION_PREFIX):
+                continue
+            handler = getattr(module_class, attr_name)
+            if not callable(handler):
+                continue
+            action_name = attr_name[len(ACTION_PREFIX):].upper()
+            ACTION_ROUTES[f"WS:{module_name}:{action_name}"] = ActionRoute(
+                module_name, action_name, handler
+            )
+        return module_class
+
+
 class GroupWebsocketServiceMixin:
+    __slots__ = ()
+
     def db_fetch_groups_for_user(self):
         """Fetch all groups for a user from the database."""
-        return ChatRoom.objects.filter(participants__id=self.user.id).distinct()
+        return list(ChatRoom.objects.filter(participants__id=self.user.id).distinct())
+
+    @single_flight(key=lambda self: self.user.id)
+    def db_fetch_group_ids_for_user(self):
+        """Fetch the ids of all groups for a user from the Redis membership index.
+        Only goes to the database on a cache miss."""
+        return ChatMembershipIndex.get_room_ids(self.user.id)
+
+    @single_flight(key=lambda self: self.user.id)
+    def redis_get_unread_counts(self) -> dict:
+        """Unread count of every room the user is in, one HGETALL."""
+        return UnreadCounters.get_counts(self.user.id)
+
+    def redis_reset_unread_count(self, room_id, seq: int):
+        """Called when the user's read watermark in a room advances to seq."""
+        UnreadCounters.reset(room_id, self.user.id, seq)
+
+
+class ChatReadServiceMixin:
+    """Reads of the chat modules, each run on a DBExecutor thread.
+    See AsyncChatReadServiceMixin for the version reading Redis on the event loop."""
+
+    __slots__ = ()
+
+    @single_flight()
+    def db_get_room_ids(self, user_id) -> list:
+        return ChatMembershipIndex.get_room_ids(user_id)
+
+    @single_flight()
+    def db_get_history_page(self, room_id, before, limit) -> dict:
+        messages, next_cursor = ChatHistoryService.get_page(
+            room_id, before=before, limit=int(limit) if limit else None
+        )
+        return {
+            "messages": MessageSerializer(messages, many=True).data,
+            "next_cursor": next_cursor,
+        }
+
+    @single_flight()
+    def db_resolve_read_seq(self, room_id, payload: dict):
+        return resolve_read_seq(room_id, payload)
+
+    @single_flight(ttl=settings.CHAT_SINGLE_FLIGHT_TTL)
+    def db_get_sync_head(self) -> int:
+        return ChatChangeLog.head()
+
+    @single_flight(ttl=settings.CHAT_SINGLE_FLIGHT_TTL)
+    def db_get_sync_floor(self) -> int:
+        return ChatChangeLog.floor()
+
+    @single_flight()
+    def db_get_changes(self, user_id, after: int, limit: int) -> list:
+        return ChatChangeLog.get_changes(user_id, after, limit)
 
 
 class PresenceWebsocketServiceMixin:
+    __slots__ = ()
+
     def redis_i_am_onine(self):
         """Mark user as online in Redis."""
-        cache.set(f"user_online_{self.user.id}", True, timeout=300)  # 5 minutes
+        presence.set_online(self.user.id)
     
     def redis_i_am_offline(self):
         """Mark user as offline in Redis."""
-        cache.delete(f"user_online_{self.user.id}")
+        presence.set_offline(self.user.id)
     
+    @single_flight(ttl=settings.CHAT_SINGLE_FLIGHT_TTL)
     def redis_is_user_online(self, user_id: int) -> bool:
         """Check if a user is online in Redis."""
-        return cache.get(f"user_online_{user_id}") is True
+        return presence.is_online(user_id)
+
+    @single_flight(ttl=settings.CHAT_SINGLE_FLIGHT_TTL)
+    def redis_get_users_presence(self, user_ids: list) -> list:
+        """Online status and last seen time of many users in one Redis call."""
+        return presence.get_presence_many(user_ids)
     
-    def redis_refresh_online_status(self):
-        """Refresh the online status timeout for the user."""
-        cache.set(f"user_online_{self.user.id}", True, timeout=300)  # 5 minutes
+    async def refresh_online_status(self):
+        """Refresh the online status timeout for the user.
+        Coalesced with other users' heartbeats and written in batches."""
+        presence.presence_heartbeats.refresh(self.user.id)
 
     
 
 class DatabaseServices(
         GroupWebsocketServiceMixin, 
+        PresenceWebsocketServiceMixin,
+        ChatReadServiceMixin,
         metaclass=AutoDBMeta
     ):
     """Service class with auto-wrapped db_ methods."""
+    # One per connection. Without a __dict__ it is ~60 B smaller (bench_chat_consumer.py --layer memory),
+    # but only while every base, the mixins included, declares __slots__ too.
+    __slots__ = ("consumer", "user")
+
     def __init__(self, consumer: AppConsumer):
         self.consumer = consumer
-        self.user = None
\ No newline at end of file
+        self.user = None
+
+
+class AsyncDatabaseServices(AsyncChatReadServiceMixin, DatabaseServices):
+    """DatabaseServices with the chat reads on the event loop (CHAT_DB_SERVICES = "async")."""
+    __slots__ = ()
+
+
+# CHAT_DB_SERVICES -> services class of each connection
+DATABASE_SERVICES = {
+    "thread": DatabaseServices,
+    "async": AsyncDatabaseServices,
+}
@@ -9,15 +9,28 @@ class ERR(str, enum.Enum):
     MODULE_NOT_FOUND = "MODULE_NOT_FOUND"
     ACTION_NOT_FOUND = "ACTION_NOT_FOUND"
     INVALID_JSON = "INVALID_JSON"
+    INVALID_FRAME = "INVALID_FRAME"
     INTERNAL_ERROR = "INTERNAL_ERROR"
+    RATE_LIMITED = "RATE_LIMITED"
 
 ErrorTypes = ERR
 
 
 class BroadCastAction(str, enum.Enum):
     GROUP_TYPING = "group.typing"
+    DIRECT_TYPING = "direct.typing"
     GROUP_CREATED = "group.created"
     GROUP_READ_RECIEPT = "group.read_receipt"
+    DIRECT_READ_RECEIPT = "direct.read_receipt"
     SEND_MESSAGE = "send.message"
     PRESENCE_USER_ONLINE = "presence.user_online"
-    PRESENCE_USER_OFFLINE = "presence.user_offline"
\ No newline at end of file
+    PRESENCE_USER_OFFLINE = "presence.user_offline"
+
+
+# Safe to drop for a client that is falling behind, see OutboundQueue
+EPHEMERAL_BROADCASTS = frozenset({
+    BroadCastAction.GROUP_TYPING,
+    BroadCastAction.DIRECT_TYPING,
+    BroadCastAction.PRESENCE_USER_ONLINE,
+    BroadCastAction.PRESENCE_USER_OFFLINE,
+})
@@ -0,0 +1,90 @@
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .metrics import chat_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DBExecutor:
+    """
+    Bounded thread pool for the chat consumer's database/Redis calls.
+
+    database_sync_to_async defaults to thread_sensitive mode, where every such
+    call of a daphne process runs on one shared thread, one at a time: a slow
+    query held up DB work for every connection of the worker. wrap() runs the
+    function on a pool of `max_workers` threads instead, still closing
+    obsolete connections around each call like database_sync_to_async does.
+    Each pool thread keeps its own Django connection, which stays open
+    between calls when CONN_MAX_AGE (DB_CONN_MAX_AGE) is set, and the pool
+    size bounds how many connections a worker holds.
+
+    Time spent waiting for a free thread is recorded in chat_metrics
+    ("db_executor" in the snapshot). With max_workers=0, wrap() is plain
+    database_sync_to_async.
+    ```
+    >>> class GroupChatModule(BaseModule):
+            @db_sync_to_async
+            def _save_group_message(self, group_id, message, msg_type, reply_to) -> dict:
+                ...
+    ```
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if max_workers:
+            self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="chat-db")
+        self._lock = threading.Lock()  # waits are recorded from the pool threads
+        chat_metrics.db_workers = max_workers
+
+    def wrap(self, func: Callable):
+        if self.executor is None:
+            return database_sync_to_async(func)
+
+        run = database_sync_to_async(self._timed(func), thread_sensitive=False, executor=self.executor)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            queued = [True]  # until a pool thread picks the call up
+            with self._lock:
+                chat_metrics.db_waiting += 1
+            try:
+                return await run(queued, time.perf_counter(), *args, **kwargs)
+            finally:
+                # cancelled while still queued: the call never starts, stop counting it
+                self._dequeue(queued)
+
+        return wrapper
+
+    def _dequeue(self, queued: list) -> bool:
+        with self._lock:
+            if not queued[0]:
+                return False
+            queued[0] = False
+            chat_metrics.db_waiting -= 1
+            return True
+
+    def _timed(self, func: Callable):
+        @functools.wraps(func)
+        def timed(queued: list, queued_at: float, *args, **kwargs):
+            wait = time.perf_counter() - queued_at
+            if self._dequeue(queued):
+                with self._lock:
+                    chat_metrics.observe_db_wait(wait)
+            return func(*args, **kwargs)
+
+        return timed
+
+
+db_executor = DBExecutor(max_workers=settings.CHAT_DB_EXECUTOR_WORKERS)
+
+# Decorator for sync DB/Redis helpers of the consumer, use instead of database_sync_to_async
+db_sync_to_async = db_executor.wrap
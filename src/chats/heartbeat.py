@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from typing import List, Optional, Set
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Close code for sockets that stopped answering pings
+CLOSE_CODE_HEARTBEAT_TIMEOUT = 4008
+
+
+class HeartbeatScheduler:
+    """
+    One process-wide timer wheel for WebSocket heartbeats.
+
+    Connections are spread over `slots` buckets. Every `interval / slots`
+    seconds one bucket is processed: its connections are pinged together, and
+    the ones that left `max_missed` pings in a row unanswered are closed. Each
+    connection is therefore pinged once per `interval`, and the worker has one
+    timer in total instead of one sleeping task per socket.
+
+    Any frame from the client counts as a pong (AppConsumer.receive calls
+    alive()). The wheel only turns while connections are registered.
+    """
+
+    def __init__(self, interval: float, slots: int, max_missed: int):
+        self.interval = interval
+        self.max_missed = max_missed
+        self._wheel: List[Set] = [set() for _ in range(slots)]
+        self._cursor = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def tick(self) -> float:
+        return self.interval / len(self._wheel)
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._wheel)
+
+    def register(self, consumer):
+        # the bucket processed last, so the first ping is a full interval away
+        slot = (self._cursor - 1) % len(self._wheel)
+        consumer.heartbeat_slot = slot
+        consumer.missed_pongs = 0
+        self._wheel[slot].add(consumer)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def unregister(self, consumer):
+        slot = getattr(consumer, "heartbeat_slot", None)
+        if slot is not None:
+            self._wheel[slot].discard(consumer)
+            consumer.heartbeat_slot = None
+
+    @staticmethod
+    def alive(consumer):
+        consumer.missed_pongs = 0
+
+    async def _run(self):
+        while any(self._wheel):
+            await asyncio.sleep(self.tick)
+            bucket = self._wheel[self._cursor]
+            self._cursor = (self._cursor + 1) % len(self._wheel)
+            if bucket:
+                try:
+                    await self._process(bucket)
+                except Exception as e:
+                    logger.error(f"Heartbeat tick failed: {str(e)}")
+
+    async def _process(self, bucket: Set):
+        dead, alive = [], []
+        for consumer in bucket:
+            if consumer.missed_pongs >= self.max_missed:
+                dead.append(consumer)
+            else:
+                consumer.missed_pongs += 1
+                alive.append(consumer)
+
+        for consumer in dead:
+            self.unregister(consumer)
+
+        results = await asyncio.gather(
+            *(consumer.send_ping() for consumer in alive),
+            *(consumer.close(code=CLOSE_CODE_HEARTBEAT_TIMEOUT) for consumer in dead),
+            return_exceptions=True,
+        )
+        if dead:
+            logger.info(f"Closed {len(dead)} sockets that missed {self.max_missed} pings")
+        failed = sum(isinstance(result, Exception) for result in results)
+        if failed:
+            logger.warning(f"{failed} heartbeat sends failed")
+
+
+heartbeats = HeartbeatScheduler(
+    interval=settings.CHAT_HEARTBEAT_INTERVAL,
+    slots=settings.CHAT_HEARTBEAT_SLOTS,
+    max_missed=settings.CHAT_HEARTBEAT_MAX_MISSED,
+)
@@ -0,0 +1,27 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from src.chats.metrics import merge_snapshots, read_published
+
+
+class Command(BaseCommand):
+    help = 'Dump the WebSocket chat metrics published by every daphne worker as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='Write the snapshot to this file instead of stdout')
+        parser.add_argument('--totals-only', action='store_true', help='Leave out the per worker numbers')
+
+    def handle(self, *args, **options):
+        workers = read_published()
+        snapshot = {"total": merge_snapshots(list(workers.values()))}
+        if not options['totals_only']:
+            snapshot["workers"] = workers
+
+        dump = json.dumps(snapshot, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(dump)
+            self.stdout.write(self.style.SUCCESS(f"Wrote metrics of {len(workers)} workers to {options['output']}"))
+        else:
+            self.stdout.write(dump)
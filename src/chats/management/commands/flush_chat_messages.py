@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from src.chats.persistence import message_write_behind
+
+
+class Command(BaseCommand):
+    help = 'Flush write-behind chat messages from the Redis journal into the database.'
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            flushed = message_write_behind.flush()
+            total += flushed
+            if flushed < message_write_behind.batch_size:
+                break
+
+        pending = message_write_behind.pending()
+        self.stdout.write(self.style.SUCCESS(f"Flushed {total} messages, {pending} still pending"))
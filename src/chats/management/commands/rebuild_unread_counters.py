@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from src.chats.models import ChatParticipant
+from src.chats.services import UnreadCounters
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the Redis unread counters from the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_ids', nargs='*', help='Only these users (default: every chat participant)')
+
+    def handle(self, *args, **options):
+        user_ids = options['user_ids'] or (
+            ChatParticipant.objects.values_list('user_id', flat=True).distinct().iterator()
+        )
+        rebuilt = 0
+        for user_id in user_ids:
+            UnreadCounters.rebuild(user_id)
+            rebuilt += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt unread counters of {rebuilt} users"))
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .executor import db_sync_to_async
+from .services import ChatRoomRoles
+from .singleflight import single_flights
+
+logger = logging.getLogger(__name__)
+
+# Channel layer group every worker listens on for ChatParticipant changes
+MEMBERSHIP_CHANGES_GROUP = "chat_membership_changes"
+
+_NOT_CACHED = object()
+
+
+def publish_membership_change(room_id, user_id):
+    """
+    Tell every worker that the user's role in the room may have changed.
+    Sync, for the ChatParticipant signals (after the transaction commits).
+    """
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            MEMBERSHIP_CHANGES_GROUP,
+            {"type": "membership.changed", "room_id": str(room_id), "user_id": str(user_id)},
+        )
+    except Exception as e:
+        # the workers' entries still expire after CHAT_MEMBERSHIP_CACHE_TTL
+        logger.error(f"Membership change publish failed: {str(e)}")
+
+
+class MembershipRoleCache:
+    """
+    Per-process LRU of chat roles, {(room id, user id): role or None}.
+
+    Every chat send checks that the sender is in the room. With this cache
+    the check is a dict lookup: a miss reads the room's Redis hash
+    (ChatRoomRoles, rebuilt from Postgres when missing), concurrent misses
+    for the same pair share one read.
+
+    Entries are dropped when a worker hears of a ChatParticipant change on
+    the MEMBERSHIP_CHANGES_GROUP channel layer group. A worker only listens
+    while it has connections (register/unregister); while it isn't listening
+    nothing is cached, and on stopping the cache is cleared, since missed
+    changes could leave it stale. `ttl` bounds the life of an entry in case
+    a change is lost on the way anyway.
+    """
+
+    def __init__(self, max_size: int, ttl: float, regroup_interval: float = 60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.regroup_interval = regroup_interval  # renews the group membership before it expires
+        self._roles: OrderedDict = OrderedDict()  # (room id, user id) -> (expires at, role)
+        self._generation = 0  # bumped by every invalidation, so loads racing one aren't cached
+        self._connections = 0
+        self._listening = False
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._roles)
+
+    async def get_role(self, room_id, user_id) -> Optional[str]:
+        """ChatRoomRoles.ADMIN, ChatRoomRoles.MEMBER, or None for non participants"""
+        key = (str(room_id), str(user_id))
+        now = asyncio.get_running_loop().time()
+        expires_at, role = self._roles.get(key, (0, _NOT_CACHED))
+        if expires_at > now:
+            self._roles.move_to_end(key)
+            self.hits += 1
+            return role
+
+        self.misses += 1
+        generation = self._generation
+        role = await single_flights.do(("membership_role",) + key, lambda: self._load(*key))
+        if self._listening and generation == self._generation:
+            self._roles[key] = (now + self.ttl, role)
+            self._roles.move_to_end(key)
+            while len(self._roles) > self.max_size:
+                self._roles.popitem(last=False)
+        return role
+
+    async def is_member(self, room_id, user_id) -> bool:
+        return await self.get_role(room_id, user_id) is not None
+
+    async def is_admin(self, room_id, user_id) -> bool:
+        return await self.get_role(room_id, user_id) == ChatRoomRoles.ADMIN
+
+    def invalidate(self, room_id, user_id):
+        self._generation += 1
+        self._roles.pop((str(room_id), str(user_id)), None)
+
+    def clear(self):
+        self._generation += 1
+        self._roles.clear()
+
+    def register(self, channel_layer):
+        """A connection opened, listen for changes on its channel layer"""
+        self._connections += 1
+        if channel_layer is not None and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._listen(channel_layer))
+
+    def unregister(self):
+        self._connections = max(0, self._connections - 1)
+        if not self._connections and self._task is not None:
+            # forgotten right away, so a register() before the cancellation lands starts a new listener
+            self._task.cancel()
+            self._task = None
+            self._listening = False
+            self.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._roles), "hits": self.hits, "misses": self.misses, "listening": self._listening}
+
+    @staticmethod
+    @db_sync_to_async
+    def _load(room_id, user_id) -> Optional[str]:
+        return ChatRoomRoles.get_role(room_id, user_id)
+
+    async def _listen(self, channel_layer):
+        channel = await channel_layer.new_channel("chat-membership")
+        try:
+            while self._connections:
+                await channel_layer.group_add(MEMBERSHIP_CHANGES_GROUP, channel)
+                self._listening = True
+                try:
+                    while True:
+                        message = await asyncio.wait_for(channel_layer.receive(channel), self.regroup_interval)
+                        self.invalidate(message["room_id"], message["user_id"])
+                except asyncio.TimeoutError:
+                    pass
+        except Exception as e:
+            logger.error(f"Membership change listener failed: {str(e)}")
+        finally:
+            if self._task is asyncio.current_task():  # not replaced by a newer listener
+                self._listening = False
+                self.clear()
+            try:
+                await channel_layer.group_discard(MEMBERSHIP_CHANGES_GROUP, channel)
+            except Exception:
+                pass
+
+
+membership_roles = MembershipRoleCache(
+    max_size=settings.CHAT_MEMBERSHIP_CACHE_SIZE, ttl=settings.CHAT_MEMBERSHIP_CACHE_TTL
+)
@@ -0,0 +1,226 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import socket
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from .outbound import outbound_stats
+from .singleflight import single_flights
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (ms) of the latency histogram buckets, the last one is +Inf
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value_ms: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, value_ms)] += 1
+        self.sum += value_ms
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        return {"buckets": list(self.counts), "sum_ms": round(self.sum, 3), "count": self.count}
+
+
+def percentile(histogram: dict, q: float) -> Optional[float]:
+    """Upper bound (ms) of the bucket holding the q-th quantile, None for +Inf or no data"""
+    if not histogram["count"]:
+        return None
+    rank = q * histogram["count"]
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS, histogram["buckets"]):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None
+
+
+class ChatMetrics:
+    """
+    Per-process counters for the WebSocket chat path.
+
+    AppConsumer.receive times every ACTION_* handler it dispatches, and the
+    consumer reports frames, bytes, connections and group joins as they happen.
+    Everything is plain in-memory arithmetic, nothing is awaited on the hot path.
+
+    While the worker has connections, its snapshot is published to a Redis hash
+    every `publish_interval` seconds, so the metrics endpoint and the
+    `chat_metrics` command can see every daphne worker, not just their own.
+    """
+
+    REDIS_KEY = "chat_metrics_workers"
+
+    def __init__(self, publish_interval: float):
+        self.publish_interval = publish_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.started_at = time.time()
+        self.latency: Dict[str, Histogram] = {}  # "WS:MODULE:ACTION" -> handler latency
+        self.action_errors = Counter()  # "WS:MODULE:ACTION" -> handler raised or answered an error
+        self.frame_errors = Counter()  # ERR code -> error frames sent by AppConsumer itself
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.group_joins = 0
+        self.db_workers = 0  # set by DBExecutor, 0 is the shared thread_sensitive thread
+        self.db_waiting = 0  # calls queued for a free DBExecutor thread
+        self.db_queue_wait = Histogram()
+        self._publish_task: Optional[asyncio.Task] = None
+
+    def observe_action(self, action: str, seconds: float, failed: bool = False):
+        histogram = self.latency.get(action)
+        if histogram is None:
+            histogram = self.latency[action] = Histogram()
+        histogram.observe(seconds * 1000)
+        if failed:
+            self.action_errors[action] += 1
+
+    def observe_db_wait(self, seconds: float):
+        self.db_queue_wait.observe(seconds * 1000)
+
+    def frame_in(self, size: int):
+        self.frames_in += 1
+        self.bytes_in += size
+
+    def frame_out(self, size: int):
+        self.frames_out += 1
+        self.bytes_out += size
+
+    def connection_opened(self):
+        self.connections += 1
+        if self._publish_task is None or self._publish_task.done():
+            self._publish_task = asyncio.get_running_loop().create_task(self._publish_loop())
+
+    def connection_closed(self):
+        self.connections -= 1
+
+    def snapshot(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "started_at": self.started_at,
+            "published_at": time.time(),
+            "latency_buckets_ms": list(LATENCY_BUCKETS_MS),
+            "actions": {
+                action: {
+                    **histogram.snapshot(),
+                    "errors": self.action_errors.get(action, 0),
+                }
+                for action, histogram in self.latency.items()
+            },
+            "frame_errors": dict(self.frame_errors),
+            "frames_in": self.frames_in,
+            "bytes_in": self.bytes_in,
+            "frames_out": self.frames_out,
+            "bytes_out": self.bytes_out,
+            "connections": self.connections,
+            "group_joins": self.group_joins,
+            "outbound": outbound_stats(),
+            "single_flight": single_flights.stats(),
+            "db_executor": {
+                "workers": self.db_workers,
+                "waiting": self.db_waiting,
+                "queue_wait": self.db_queue_wait.snapshot(),
+            },
+        }
+
+    def publish(self):
+        get_redis_connection("default").hset(
+            cache.make_key(self.REDIS_KEY), self.worker_id, json.dumps(self.snapshot())
+        )
+
+    async def _publish_loop(self):
+        # one last publish after the final disconnect, so the gauges read 0
+        while True:
+            await asyncio.sleep(self.publish_interval)
+            try:
+                await sync_to_async(self.publish, thread_sensitive=False)()
+            except Exception as e:
+                logger.error(f"Chat metrics publish failed: {str(e)}")
+            if not self.connections:
+                return
+
+
+def read_published(max_age: Optional[float] = None) -> Dict[str, dict]:
+    """
+    Snapshots published by every worker, {worker id: snapshot}.
+    Workers that stopped publishing (dead, or idle for `max_age` seconds) are dropped.
+    """
+    if max_age is None:
+        max_age = chat_metrics.publish_interval * 3
+    key = cache.make_key(ChatMetrics.REDIS_KEY)
+    connection = get_redis_connection("default")
+
+    snapshots, stale = {}, []
+    now = time.time()
+    for worker_id, value in connection.hgetall(key).items():
+        snapshot = json.loads(value)
+        if snapshot["connections"] or now - snapshot["published_at"] <= max_age:
+            snapshots[worker_id.decode()] = snapshot
+        else:
+            stale.append(worker_id)
+    if stale:
+        connection.hdel(key, *stale)
+    return snapshots
+
+
+def merge_snapshots(snapshots: List[dict]) -> dict:
+    """Add up worker snapshots into one, e.g. for a whole deployment"""
+    total = {
+        "workers": len(snapshots),
+        "actions": {},
+        "frame_errors": Counter(),
+        "frames_in": 0,
+        "bytes_in": 0,
+        "frames_out": 0,
+        "bytes_out": 0,
+        "connections": 0,
+        "group_joins": 0,
+        "db_executor": {"workers": 0, "waiting": 0, "queue_wait": Histogram().snapshot()},
+    }
+    for snapshot in snapshots:
+        for field in ("frames_in", "bytes_in", "frames_out", "bytes_out", "connections", "group_joins"):
+            total[field] += snapshot[field]
+        total["frame_errors"].update(snapshot["frame_errors"])
+        db_total, db = total["db_executor"], snapshot.get("db_executor")
+        if db:
+            db_total["workers"] += db["workers"]
+            db_total["waiting"] += db["waiting"]
+            _add_histogram(db_total["queue_wait"], db["queue_wait"])
+        for action, stats in snapshot["actions"].items():
+            merged = total["actions"].setdefault(action, {**Histogram().snapshot(), "errors": 0})
+            _add_histogram(merged, stats)
+            merged["errors"] += stats["errors"]
+
+    for stats in [*total["actions"].values(), total["db_executor"]["queue_wait"]]:
+        stats["p50_ms"] = percentile(stats, 0.5)
+        stats["p95_ms"] = percentile(stats, 0.95)
+        stats["p99_ms"] = percentile(stats, 0.99)
+    total["frame_errors"] = dict(total["frame_errors"])
+    return total
+
+
+def _add_histogram(total: dict, histogram: dict):
+    total["buckets"] = [a + b for a, b in zip(total["buckets"], histogram["buckets"])]
+    total["sum_ms"] += histogram["sum_ms"]
+    total["count"] += histogram["count"]
+
+
+chat_metrics = ChatMetrics(publish_interval=settings.CHAT_METRICS_PUBLISH_INTERVAL)
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.30 on 2026-10-16 21:08
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def number_existing_messages(apps, schema_editor):
+    # each room's messages get 1..n in the order they were sent, so next_seq continues after them
+    Message = apps.get_model('chats', 'Message')
+    messages = Message.objects.order_by('chatroom_id', 'created_at', 'id').only('id', 'chatroom_id')
+    room_id, seq, batch = None, 0, []
+    for message in messages.iterator(chunk_size=2000):
+        if message.chatroom_id != room_id:
+            room_id, seq = message.chatroom_id, 0
+        seq += 1
+        message.seq = seq
+        batch.append(message)
+        if len(batch) == 2000:
+            Message.objects.bulk_update(batch, ['seq'])
+            batch = []
+    Message.objects.bulk_update(batch, ['seq'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(number_existing_messages, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
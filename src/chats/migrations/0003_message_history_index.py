@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-16 21:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0002_message_seq'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chatroom', 'created_at', 'id'], name='chats_message_history_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-16 21:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0003_message_history_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='last_read_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
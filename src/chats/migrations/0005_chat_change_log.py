@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-16 21:13
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0004_participant_read_watermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatChange',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('chatroom_id', models.UUIDField(blank=True, null=True)),
+                ('user_id', models.UUIDField(blank=True, null=True)),
+                ('kind', models.CharField(choices=[('message', 'Message'), ('membership', 'Membership'), ('reaction', 'Reaction'), ('pin', 'Pin'), ('notification', 'Notification')], max_length=20)),
+                ('op', models.CharField(choices=[('upsert', 'Created or updated'), ('delete', 'Deleted')], max_length=10)),
+                ('object_id', models.CharField(max_length=64)),
+                ('data', models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['chatroom_id', 'id'], name='chats_change_room_idx'), models.Index(fields=['user_id', 'id'], name='chats_change_user_idx')],
+            },
+        ),
+    ]
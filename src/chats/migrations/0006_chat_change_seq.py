@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:55
+
+from django.db import migrations, models
+
+
+def number_existing_changes(apps, schema_editor):
+    # clients hold ids as their cursor so far, committed changes keep them as seq
+    ChatChange = apps.get_model('chats', 'ChatChange')
+    ChatChange.objects.update(seq=models.F('id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0005_chat_change_log'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chatchange',
+            name='chats_change_room_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='chatchange',
+            name='chats_change_user_idx',
+        ),
+        migrations.AddField(
+            model_name='chatchange',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True, unique=True),
+        ),
+        migrations.RunPython(number_existing_changes, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatchange',
+            index=models.Index(fields=['chatroom_id', 'seq'], name='chats_change_room_seq_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatchange',
+            index=models.Index(fields=['user_id', 'seq'], name='chats_change_user_seq_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatchange',
+            index=models.Index(condition=models.Q(('seq__isnull', True)), fields=['id'], name='chats_change_unsequenced_idx'),
+        ),
+    ]
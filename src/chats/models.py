@@ -1,5 +1,7 @@
 import uuid
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
 
 
 class ChatRoom(models.Model):
@@ -39,6 +41,9 @@ class ChatParticipant(models.Model):
         "orders.Order", blank=True, related_name="chat_participants"
     )
     joined_at = models.DateTimeField(auto_now_add=True)
+    # Read watermark: every message with seq <= last_read_seq has been read
+    last_read_seq = models.BigIntegerField(default=0)
+    last_read_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         unique_together = ("chatroom", "user")
@@ -56,7 +61,16 @@ class Message(models.Model):
         "users.User", on_delete=models.CASCADE, related_name="messages"
     )
     content = models.TextField(blank=True, null=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Per chatroom, assigned by ChatMessageService.next_seq (server side, before the INSERT)
+    seq = models.BigIntegerField(null=True, blank=True)
+    # not auto_now_add, so write-behind batches keep the time the message was sent
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # history pages, see ChatHistoryService
+            models.Index(fields=["chatroom", "created_at", "id"], name="chats_message_history_idx"),
+        ]
 
     def __str__(self):
         return f"Message {self.id} in {self.chatroom}"
@@ -118,3 +132,52 @@ class Attachment(models.Model):
 
     def __str__(self):
         return f"{self.type} for {self.message.id}"
+
+
+class ChatChange(models.Model):
+    """
+    Change log behind SYNC:REQUEST_SYNC. `seq` is the sync sequence: a client
+    keeps the seq of the last change it applied and asks for everything after it.
+
+    Ids are handed out at INSERT, so a long transaction can commit a lower id
+    after a reader has moved past it. seq is assigned after the commit instead,
+    in the order changes become visible (ChatChangeLog.sequence), and changes
+    are only read once they have one.
+
+    A change is visible to every participant of `chatroom_id` and to `user_id`
+    (either can be empty). They are plain ids, not foreign keys, so the log
+    outlives deleted rooms and memberships.
+    """
+
+    KINDS = [
+        ("message", "Message"),
+        ("membership", "Membership"),
+        ("reaction", "Reaction"),
+        ("pin", "Pin"),
+        ("notification", "Notification"),
+    ]
+    OPS = [
+        ("upsert", "Created or updated"),
+        ("delete", "Deleted"),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    seq = models.BigIntegerField(null=True, blank=True, unique=True)
+    chatroom_id = models.UUIDField(null=True, blank=True)
+    user_id = models.UUIDField(null=True, blank=True)
+    kind = models.CharField(max_length=20, choices=KINDS)
+    op = models.CharField(max_length=10, choices=OPS)
+    object_id = models.CharField(max_length=64)
+    data = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chatroom_id", "seq"], name="chats_change_room_seq_idx"),
+            models.Index(fields=["user_id", "seq"], name="chats_change_user_seq_idx"),
+            # the changes still waiting for their seq
+            models.Index(fields=["id"], condition=models.Q(seq__isnull=True), name="chats_change_unsequenced_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.op} {self.kind} {self.object_id}"
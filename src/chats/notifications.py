@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from src.notifications.models import Notification
+from .executor import db_sync_to_async
+from .models import ChatChange, ChatParticipant
+from .presence import get_presence_many
+from .services import ChatChangeLog
+from .tasks import deliver_chat_notifications
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_LENGTH = 100
+
+
+class MessageEvent(NamedTuple):
+    room_id: str
+    sender_id: str
+    preview: str
+    recipient_ids: Optional[Tuple[str, ...]]  # None: every participant of the room
+
+
+def group_events(events: Iterable[MessageEvent], participants: Dict[str, List[str]]) -> Dict[tuple, tuple]:
+    """
+    {(user id, room id): (message count, preview of the latest)} for the
+    recipients of the events, senders excluded.
+    `participants` are the user ids of each room, for events without recipient_ids.
+    """
+    grouped = {}
+    for event in events:
+        recipient_ids = event.recipient_ids
+        if recipient_ids is None:
+            recipient_ids = participants.get(event.room_id, ())
+        for user_id in recipient_ids:
+            if user_id == event.sender_id:
+                continue
+            count, _ = grouped.get((user_id, event.room_id), (0, None))
+            grouped[(user_id, event.room_id)] = (count + 1, event.preview)
+    return grouped
+
+
+class OfflineNotifier:
+    """
+    Batched notifications of chat messages for offline participants.
+
+    Sending a message only records it (schedule(), no I/O). Every
+    `flush_interval` seconds the messages collected by the worker are turned
+    into notifications at once: one query for the participants of their
+    rooms, one presence MGET for who of them is offline, one MGET for the
+    notifications still open to merge into, and one transaction that writes
+    the Notification rows (bulk_create/bulk_update) with their sync log.
+
+    A user gets one Notification per room and `merge_window`: later messages
+    update it to "N new messages" instead of adding rows, as long as they
+    come less than `merge_window` seconds apart and it is still there and
+    unread. Only new notifications are delivered, as one queued email per
+    user and flush (src.chats.tasks.deliver_chat_notifications); merged ones
+    reach the user through delta sync.
+
+    Flushes of different workers take turns (a Redis lock), since they
+    read and write the same merge state. New notifications also get ids
+    derived from that state, so if two flushes still overlap they insert the
+    same row (ignore_conflicts) rather than two, and only the flush that
+    inserted it logs and delivers it.
+
+    Messages of DIRECT_CHAT:SEND_MESSAGE are not stored yet, so they are not
+    scheduled; direct rooms sent to with GROUP_CHAT:SEND_MESSAGE are.
+
+    The flush task only runs while there is something to flush.
+    """
+
+    MERGE_KEY = "chat_notification_{user_id}_{room_id}"
+    LOCK_KEY = "chat_notification_flush_lock"
+    ID_NAMESPACE = uuid.UUID("5d0c4c7e-2f0b-4a8e-9a43-3a6f0f3a9c11")
+
+    def __init__(self, flush_interval: float, merge_window: float):
+        self.flush_interval = flush_interval
+        self.merge_window = merge_window
+        self._pending: List[MessageEvent] = []
+        self._flush_task = None
+
+    def schedule(self, room_id, sender_id, content: str, recipient_ids: Iterable = None):
+        if recipient_ids is not None:
+            recipient_ids = tuple(str(user_id) for user_id in recipient_ids)
+        self._pending.append(MessageEvent(str(room_id), str(sender_id), content[:PREVIEW_LENGTH], recipient_ids))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    def flush(self, events: List[MessageEvent]) -> Optional[int]:
+        """
+        Write the notifications for `events` and queue their delivery.
+        Returns how many users were notified, None if other flushes kept it from running.
+        """
+        room_ids = {event.room_id for event in events if event.recipient_ids is None}
+        participants = defaultdict(list)
+        for room_id, user_id in ChatParticipant.objects.filter(chatroom_id__in=room_ids).values_list(
+            "chatroom_id", "user_id"
+        ):
+            participants[str(room_id)].append(str(user_id))
+
+        grouped = group_events(events, participants)
+        offline = {
+            presence["user_id"]
+            for presence in get_presence_many(list({user_id for user_id, _ in grouped}))
+            if not presence["is_online"]
+        }
+        grouped = {pair: value for pair, value in grouped.items() if pair[0] in offline}
+        if not grouped:
+            return 0
+
+        lock = cache.lock(self.LOCK_KEY, timeout=60)
+        if not lock.acquire(blocking=True, blocking_timeout=self.flush_interval):
+            return None
+        try:
+            created, merge_state = self._write(grouped)
+            cache.set_many(merge_state, timeout=self.merge_window)
+        finally:
+            lock.release()
+
+        # grouped per user: one delivery (email) per user, however many rooms
+        deliveries = defaultdict(list)
+        for (user_id, _), notification in created.items():
+            deliveries[user_id].append({"title": notification.title, "message": notification.message})
+        if deliveries:
+            deliver_chat_notifications.delay([
+                {"user_id": user_id, "notifications": notifications}
+                for user_id, notifications in deliveries.items()
+            ])
+        return len({user_id for user_id, _ in grouped})
+
+    def _write(self, grouped: Dict[tuple, tuple]) -> Tuple[dict, dict]:
+        """
+        Create or merge the notifications, in one transaction.
+        Returns the created ones, {(user id, room id): notification}, and the merge state to cache.
+        """
+        merge_keys = {pair: self._merge_key(*pair) for pair in grouped}
+        open_notifications = cache.get_many(merge_keys.values())
+
+        created, updated, merge_state = {}, [], {}
+        with transaction.atomic():
+            # merged only while there and unread, locked so they stay that way until the commit
+            still_open = {
+                str(notification_id)
+                for notification_id in Notification.objects.select_for_update().filter(
+                    id__in=[state["id"] for state in open_notifications.values()], is_read=False
+                ).values_list("id", flat=True)
+            }
+            for (user_id, room_id), (count, preview) in grouped.items():
+                key = merge_keys[(user_id, room_id)]
+                state = open_notifications.get(key)
+                if state is None or str(state["id"]) not in still_open:
+                    created[(user_id, room_id)] = Notification(
+                        id=self._notification_id(user_id, room_id, state),
+                        user_id=user_id, type="chat", title="New message",
+                        message=preview if count == 1 else f"{count} new messages",
+                    )
+                else:
+                    count += state["count"]
+                    updated.append(Notification(
+                        id=state["id"], user_id=user_id, type="chat", title="New message",
+                        message=f"{count} new messages", is_read=False, created_at=state["created_at"],
+                    ))
+                    merge_state[key] = {**state, "count": count}
+
+            Notification.objects.bulk_create(created.values(), ignore_conflicts=True)
+            created = self._inserted(created)
+            Notification.objects.bulk_update(updated, ["message"])
+            # bulk writes skip post_save, so the sync log is written here
+            ChatChange.objects.bulk_create([
+                self._log_change(notification) for notification in [*created.values(), *updated]
+                if ChatChangeLog.logs_notification(notification)
+            ])
+
+        for pair, notification in created.items():
+            merge_state[merge_keys[pair]] = {
+                "id": str(notification.id),
+                "count": grouped[pair][0],
+                "created_at": notification.created_at,
+            }
+        return created, merge_state
+
+    @staticmethod
+    def _inserted(created: Dict[tuple, Notification]) -> Dict[tuple, Notification]:
+        """
+        The notifications of `created` that bulk_create inserted. A conflict
+        (the row of another flush that read the same merge state) is skipped
+        silently; its stored created_at is not the one given to ours.
+        """
+        stored = dict(
+            Notification.objects.filter(id__in=[notification.id for notification in created.values()])
+            .values_list("id", "created_at")
+        )
+        return {
+            pair: notification for pair, notification in created.items()
+            if stored.get(notification.id) == notification.created_at
+        }
+
+    def _notification_id(self, user_id, room_id, state: Optional[dict]) -> uuid.UUID:
+        """
+        Id of a new notification: the successor of the one in the merge state
+        (gone or read), or else the first of the user's in the room in this
+        merge window. Flushes that read the same state pick the same id.
+        """
+        previous = state["id"] if state is not None else int(time.time() // self.merge_window)
+        return uuid.uuid5(self.ID_NAMESPACE, f"{user_id}:{room_id}:{previous}")
+
+    async def _flush_loop(self):
+        flush = db_sync_to_async(self.flush)
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            events, self._pending = self._pending, []
+            try:
+                if await flush(events) is None:
+                    self._pending[:0] = events  # the lock stayed taken, next time
+            except Exception as e:
+                logger.error(f"Chat notification flush failed: {str(e)}", exc_info=True)
+
+    def _merge_key(self, user_id, room_id) -> str:
+        return self.MERGE_KEY.format(user_id=user_id, room_id=room_id)
+
+    @staticmethod
+    def _log_change(notification: Notification) -> ChatChange:
+        return ChatChangeLog.build(
+            "notification", "upsert", notification.id,
+            {
+                "type": notification.type,
+                "title": notification.title,
+                "message": notification.message,
+                "is_read": notification.is_read,
+                "created_at": notification.created_at,
+            },
+            user_id=notification.user_id,
+        )
+
+
+chat_notifier = OfflineNotifier(
+    flush_interval=settings.CHAT_NOTIFY_FLUSH_INTERVAL,
+    merge_window=settings.CHAT_NOTIFY_MERGE_WINDOW,
+)
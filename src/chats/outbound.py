@@ -0,0 +1,206 @@
+import asyncio
+import functools
+import logging
+import weakref
+from collections import deque
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Close code for clients that fell too far behind on broadcasts
+CLOSE_CODE_SLOW_CONSUMER = 4009
+
+_NOT_REGISTERED = object()
+
+
+class TransportProducer:
+    """
+    Twisted push producer (IPushProducer) on a daphne connection's transport.
+
+    The transport pauses it once its write buffer holds more than
+    `bufferSize` bytes and resumes it when the buffer drained; OutboundQueue's
+    writer waits for `writable` before each frame.
+    """
+
+    __slots__ = ("transport", "writable")
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    @classmethod
+    def register(cls, consumer, buffer_size: int) -> Optional["TransportProducer"]:
+        """
+        Register a producer on the daphne transport of `consumer`. None under
+        other servers (uvicorn's send waits for the socket itself) or if the
+        transport already has a producer: no backpressure from here then.
+
+        Relies on daphne's send being `functools.partial(Server.handle_reply,
+        protocol)` (daphne 4.x) and on the public IConsumer/FileDescriptor API
+        of the transport, registerProducer and bufferSize (Twisted >= 22.4, as
+        daphne 4 requires).
+        """
+        send = getattr(consumer, "base_send", None)
+        protocol = send.args[0] if isinstance(send, functools.partial) and send.args else None
+        transport = getattr(protocol, "transport", None)
+        if transport is None or not hasattr(transport, "registerProducer"):
+            return None
+
+        producer = cls(transport)
+        try:
+            transport.registerProducer(producer, True)
+        except RuntimeError:  # someone else's producer
+            return None
+        if hasattr(transport, "bufferSize"):
+            transport.bufferSize = buffer_size
+        return producer
+
+    def unregister(self):
+        if getattr(self.transport, "producer", None) is self:
+            self.transport.unregisterProducer()
+        self.writable.set()
+
+    def pauseProducing(self):
+        self.writable.clear()
+
+    def resumeProducing(self):
+        if getattr(self.transport, "disconnecting", False):
+            # a closing transport only finishes once its producer is gone
+            self.unregister()
+        self.writable.set()
+
+    def stopProducing(self):
+        # connection lost, the writer runs on into the consumer's disconnect
+        self.writable.set()
+
+
+class OutboundQueue:
+    """
+    Bounded queue of broadcast frames for one connection.
+
+    group_broadcast_dispatch only puts frames here, and a writer task (started
+    when the queue gets its first frame, gone once it is empty) sends them. A
+    slow client therefore can't stall the consumer's channel layer inbox, and
+    the most a worker buffers for one client is `max_size` frames.
+
+    When the queue is full:
+    1. a new ephemeral frame (typing, presence) is dropped,
+    2. a new regular frame evicts the oldest queued ephemeral frame,
+    3. with no ephemeral frame left to evict, the client is disconnected
+       with CLOSE_CODE_SLOW_CONSUMER; it catches up with SYNC:REQUEST_SYNC.
+
+    Frames only pile up here if `send` holds the writer back. Uvicorn's does
+    while the socket can't take more. Daphne's never does: it appends to the
+    Twisted transport's write buffer, which grows without bound. So under
+    daphne the queue registers a TransportProducer, and the writer waits
+    while the transport has it paused (more than `max_buffer` bytes unsent);
+    the frames behind it are subject to the rules above.
+    """
+
+    __slots__ = (
+        "consumer", "max_size", "max_buffer", "dropped", "closed", "_frames", "_ephemeral", "_writer", "_producer",
+        "__weakref__",
+    )
+
+    # every live queue of the process, for outbound_stats()
+    _queues = weakref.WeakSet()
+    dropped_total = 0
+    disconnects_total = 0
+
+    def __init__(self, consumer, max_size: int, max_buffer: int = 256 * 1024):
+        self.consumer = consumer
+        self.max_size = max_size
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self.closed = False
+        self._frames = deque()  # (frame, ephemeral)
+        self._ephemeral = 0
+        self._writer: Optional[asyncio.Task] = None
+        self._producer = _NOT_REGISTERED  # registered by the first write, when the server's send is known
+        self._queues.add(self)
+
+    @property
+    def depth(self) -> int:
+        return len(self._frames)
+
+    def put(self, frame, ephemeral: bool = False):
+        if self.closed:
+            return
+
+        if len(self._frames) >= self.max_size:
+            if ephemeral:
+                self._drop()
+                return
+            if not self._evict_ephemeral():
+                self._overflow()
+                return
+
+        self._frames.append((frame, ephemeral))
+        self._ephemeral += ephemeral
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.get_running_loop().create_task(self._write())
+
+    async def join(self):
+        """Wait until every queued frame was handed to the server"""
+        while self._writer is not None and not self._writer.done():
+            await self._writer
+
+    def close(self):
+        self.closed = True
+        self._frames.clear()
+        self._ephemeral = 0
+        if self._writer is not None:
+            self._writer.cancel()
+        if self._producer not in (None, _NOT_REGISTERED):
+            self._producer.unregister()
+
+    def _drop(self):
+        self.dropped += 1
+        OutboundQueue.dropped_total += 1
+
+    def _evict_ephemeral(self) -> bool:
+        if not self._ephemeral:
+            return False
+        for index, (_, ephemeral) in enumerate(self._frames):
+            if ephemeral:
+                del self._frames[index]
+                self._ephemeral -= 1
+                self._drop()
+                return True
+        return False
+
+    def _overflow(self):
+        logger.warning(f"Outbound queue full ({self.max_size} frames), disconnecting slow client")
+        OutboundQueue.disconnects_total += 1
+        self.close()
+        asyncio.get_running_loop().create_task(self.consumer.close(code=CLOSE_CODE_SLOW_CONSUMER))
+
+    async def _write(self):
+        if self._producer is _NOT_REGISTERED:
+            self._producer = TransportProducer.register(self.consumer, self.max_buffer)
+        while self._frames:
+            if self._producer is not None:
+                await self._producer.writable.wait()
+                if not self._frames:  # closed meanwhile
+                    return
+            frame, ephemeral = self._frames.popleft()
+            self._ephemeral -= ephemeral
+            try:
+                await self.consumer.send_frame(frame)
+            except Exception as e:
+                logger.error(f"Outbound send failed: {str(e)}")
+                self.close()
+                return
+
+
+def outbound_stats() -> dict:
+    """Process-wide outbound queue numbers"""
+    depths = [queue.depth for queue in OutboundQueue._queues if not queue.closed]
+    return {
+        "connections": len(depths),
+        "queued_frames": sum(depths),
+        "max_depth": max(depths, default=0),
+        "dropped_total": OutboundQueue.dropped_total,
+        "disconnects_total": OutboundQueue.disconnects_total,
+    }
@@ -0,0 +1,188 @@
+import asyncio
+import json
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.utils.dateparse import parse_datetime
+from django_redis import get_redis_connection
+
+from src.users.models import User
+from .models import ChatChange, ChatRoom, Message
+from .services import ChatChangeLog, ChatMessageService
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteBehind:
+    """
+    Write-behind persistence for chat messages (enabled with CHAT_WRITE_BEHIND).
+
+    Instead of one INSERT per message before the broadcast, a message gets its id
+    and seq from ChatMessageService.build_message, is appended to a Redis list
+    (the journal) and broadcast right away. A flush task moves the journal into
+    chats.Message with bulk_create every CHAT_WRITE_BEHIND_FLUSH_INTERVAL seconds.
+
+    Durability: Redis runs with appendonly, and a batch is only trimmed from the
+    journal after its transaction committed. If a worker dies between the commit
+    and the trim, the next flush finds those messages already stored (ids are
+    assigned up front) and skips them and their sync log, so nothing is lost or
+    duplicated. A Redis lock keeps flushes from different workers from overlapping.
+
+    A message that can't be stored, because it doesn't parse or its room or
+    sender was deleted meanwhile, is moved to a dead letter list
+    (DEAD_LETTER_KEY) instead of blocking the journal. If the batch still
+    fails with an IntegrityError, its messages are stored one transaction
+    each, so only the ones at fault end up there.
+    """
+
+    JOURNAL_KEY = "chat_message_journal"
+    DEAD_LETTER_KEY = "chat_message_journal_dead"
+    LOCK_KEY = "chat_message_journal_lock"
+
+    def __init__(self, flush_interval: float, batch_size: int):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._flush_task = None
+
+    @property
+    def _journal_key(self) -> str:
+        return cache.make_key(self.JOURNAL_KEY)
+
+    @property
+    def _dead_letter_key(self) -> str:
+        return cache.make_key(self.DEAD_LETTER_KEY)
+
+    def append(self, message: dict):
+        """Journal a message built by ChatMessageService.build_message (sync, Redis only)"""
+        get_redis_connection("default").rpush(
+            self._journal_key, json.dumps(message, cls=DjangoJSONEncoder)
+        )
+
+    def schedule_flush(self):
+        """Make sure this worker's flush task is running"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    def flush(self) -> int:
+        """
+        Move up to batch_size journaled messages into Postgres.
+        Returns how many were flushed (0 if another worker holds the lock).
+        """
+        lock = cache.lock(self.LOCK_KEY, timeout=60)
+        if not lock.acquire(blocking=False):
+            return 0
+        try:
+            connection = get_redis_connection("default")
+            entries = connection.lrange(self._journal_key, 0, self.batch_size - 1)
+            if not entries:
+                return 0
+
+            batch, rejected = [], []  # batch: (entry, message)
+            for entry in entries:
+                try:
+                    message = json.loads(entry)
+                    message["created_at"] = parse_datetime(message["created_at"])
+                    ChatMessageService.to_model(message)
+                except (ValueError, TypeError, KeyError):
+                    rejected.append(entry)
+                else:
+                    batch.append((entry, message))
+
+            try:
+                rejected += self._store(batch)
+            except IntegrityError:
+                for item in batch:
+                    try:
+                        rejected += self._store([item])
+                    except IntegrityError:
+                        rejected.append(item[0])
+
+            # only after the commit, see the class docstring
+            pipe = connection.pipeline()
+            if rejected:
+                pipe.rpush(self._dead_letter_key, *rejected)
+            pipe.ltrim(self._journal_key, len(entries), -1)
+            pipe.execute()
+            if rejected:
+                logger.error(f"{len(rejected)} journaled chat messages could not be stored, see {self.DEAD_LETTER_KEY}")
+            return len(entries)
+        finally:
+            lock.release()
+
+    @staticmethod
+    def _store(batch: list) -> list:
+        """
+        Insert the messages of `batch` that aren't stored yet, with their sync
+        log, in one transaction. Returns the entries whose room or sender is gone.
+        """
+        with transaction.atomic():
+            ids = [message["id"] for _, message in batch]
+            stored = {str(message_id) for message_id in Message.objects.filter(id__in=ids).values_list("id", flat=True)}
+            batch = [(entry, message) for entry, message in batch if message["id"] not in stored]
+
+            room_ids = {
+                str(room_id) for room_id in ChatRoom.objects.filter(
+                    id__in={message["chatroom_id"] for _, message in batch}
+                ).values_list("id", flat=True)
+            }
+            sender_ids = {
+                str(user_id) for user_id in User.objects.filter(
+                    id__in={message["sender_id"] for _, message in batch}
+                ).values_list("id", flat=True)
+            }
+            messages, rejected = [], []
+            for entry, message in batch:
+                if message["chatroom_id"] in room_ids and message["sender_id"] in sender_ids:
+                    messages.append(message)
+                else:
+                    rejected.append(entry)
+
+            Message.objects.bulk_create(
+                [ChatMessageService.to_model(message) for message in messages], ignore_conflicts=True
+            )
+            # bulk_create skips post_save, so the sync log is written here
+            ChatChange.objects.bulk_create([
+                ChatChangeLog.build(
+                    "message", "upsert", message["id"], ChatChangeLog.message_data(message),
+                    chatroom_id=message["chatroom_id"],
+                )
+                for message in messages
+            ])
+        return rejected
+
+    def journaled(self) -> list:
+        """Every message still in the journal, as built by ChatMessageService.build_message"""
+        messages = []
+        for entry in get_redis_connection("default").lrange(self._journal_key, 0, -1):
+            try:
+                messages.append(json.loads(entry))
+            except ValueError:  # dead-lettered by the next flush
+                pass
+        return messages
+
+    def pending(self) -> int:
+        return get_redis_connection("default").llen(self._journal_key)
+
+    async def _flush_loop(self):
+        flush = database_sync_to_async(self.flush)
+        pending = database_sync_to_async(self.pending)
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                # drain full batches right away, then wait for the next interval
+                while await flush() >= self.batch_size:
+                    pass
+                if not await pending():
+                    return
+            except Exception as e:
+                logger.error(f"Chat message flush failed: {str(e)}", exc_info=True)
+
+
+message_write_behind = MessageWriteBehind(
+    flush_interval=settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL,
+    batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+)
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+ONLINE_TIMEOUT = 300  # 5 minutes, a user with no heartbeat for this long is offline
+LAST_SEEN_TIMEOUT = 60 * 60 * 24 * 30  # 30 days
+
+
+# The online key holds the time of the user's last heartbeat, so one MGET over
+# both keys answers "is online" and "last seen" for a list of users.
+def online_key(user_id) -> str:
+    return f"user_online_{user_id}"
+
+
+def last_seen_key(user_id) -> str:
+    return f"user_last_seen_{user_id}"
+
+
+def set_online(user_id):
+    """Mark user as online in Redis."""
+    now = timezone.now().isoformat()
+    cache.set(online_key(user_id), now, timeout=ONLINE_TIMEOUT)
+    cache.set(last_seen_key(user_id), now, timeout=LAST_SEEN_TIMEOUT)
+
+
+def set_offline(user_id):
+    """Mark user as offline in Redis."""
+    cache.delete(online_key(user_id))
+    cache.set(last_seen_key(user_id), timezone.now().isoformat(), timeout=LAST_SEEN_TIMEOUT)
+
+
+def is_online(user_id) -> bool:
+    """Check if a user is online in Redis."""
+    return cache.get(online_key(user_id)) is not None
+
+
+def get_presence_many(user_ids) -> list:
+    """
+    Online status and last seen time of many users, in one MGET.
+    ```
+    >>> get_presence_many([1, 2])
+    [
+        {"user_id": 1, "is_online": True, "last_seen": "2025-10-01T10:00:00+00:00"},
+        {"user_id": 2, "is_online": False, "last_seen": None},
+    ]
+    ```
+    """
+    keys = [key for user_id in user_ids for key in (online_key(user_id), last_seen_key(user_id))]
+    values = cache.get_many(keys)
+
+    result = []
+    for user_id in user_ids:
+        heartbeat = values.get(online_key(user_id))
+        result.append({
+            "user_id": user_id,
+            "is_online": heartbeat is not None,
+            "last_seen": heartbeat or values.get(last_seen_key(user_id)),
+        })
+    return result
+
+
+def refresh_many(user_ids):
+    """Refresh the online status timeout of many users in one round trip
+    (django_redis sends set_many as a single pipeline)."""
+    now = timezone.now().isoformat()
+    cache.set_many({online_key(user_id): now for user_id in user_ids}, timeout=ONLINE_TIMEOUT)
+
+
+class PresenceHeartbeatWriter:
+    """
+    Per-process presence refresh coalescer.
+
+    Every pong used to cost a thread hop and a Redis write. Instead, consumers
+    call refresh() (no I/O) and the user ids collected during an interval are
+    written with one pipelined refresh_many(). The flush task only runs while
+    there is something to flush, so idle workers are not woken up.
+
+    Online/offline transitions are not coalesced; use set_online/set_offline
+    for those.
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._pending = set()
+        self._flush_task = None
+
+    def refresh(self, user_id):
+        self._pending.add(user_id)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    def discard(self, user_id):
+        """Drop a pending refresh, e.g. because the user just went offline."""
+        self._pending.discard(user_id)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        user_ids, self._pending = self._pending, set()
+        # Not a DB call, so keep it off the shared thread_sensitive executor
+        await sync_to_async(refresh_many, thread_sensitive=False)(user_ids)
+
+    async def _flush_loop(self):
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Presence flush failed: {str(e)}")
+
+
+presence_heartbeats = PresenceHeartbeatWriter(settings.CHAT_PRESENCE_FLUSH_INTERVAL)
@@ -0,0 +1,159 @@
+import functools
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# Rule key applied to every frame of a connection, on top of the module/action rule
+CONNECTION_RULE = "*"
+
+_PERIODS = {"s": 1, "m": 60, "h": 60 * 60, "d": 60 * 60 * 24}
+
+
+@functools.lru_cache(maxsize=None)
+def parse_rate(rate: str) -> Tuple[int, float]:
+    """
+    Parse a DRF style rate into (burst, tokens per second).
+    ```
+    >>> parse_rate("10/second")
+    (10, 10.0)
+    >>> parse_rate("60/minute")
+    (60, 1.0)
+    ```
+    """
+    num, period = rate.split("/")
+    burst = int(num)
+    return burst, burst / _PERIODS[period.strip()[0].lower()]
+
+
+class TokenBucket:
+    __slots__ = ("capacity", "fill_rate", "tokens", "updated")
+
+    def __init__(self, capacity: int, fill_rate: float, now: float):
+        self.capacity = capacity
+        self.fill_rate = fill_rate
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def consume(self, now: float) -> float:
+        """Take a token. Returns 0 on success, else the seconds until one is available."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.fill_rate
+
+
+class ConnectionRateLimiter:
+    """
+    In-memory token buckets for one WebSocket connection.
+
+    `rules` maps "MODULE:ACTION", "MODULE" or "*" to a DRF style rate
+    (CHAT_WS_RATE_LIMITS). Every frame takes a token from the "*" bucket
+    (check_frame, before it is even decoded, so malformed frames and unknown
+    actions count too). A routed action also takes one from the bucket of its
+    most specific rule (check), so a module rule is shared by all of the
+    module's actions:
+    ```
+    {
+        "*": "30/second",                       # anything, per connection
+        "GROUP_CHAT": "15/second",              # any GROUP_CHAT action
+        "GROUP_CHAT:SEND_MESSAGE": "5/second",  # just this action
+    }
+    ```
+    Buckets are created on first use, so actions a connection never sends cost
+    nothing.
+    """
+
+    __slots__ = ("rules", "_buckets", "_clock")
+
+    def __init__(self, rules: Optional[Dict[str, str]] = None, clock=time.monotonic):
+        self.rules = settings.CHAT_WS_RATE_LIMITS if rules is None else rules
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._clock = clock
+
+    def check_frame(self) -> float:
+        """0 if another frame may come in, else the seconds to wait before retrying"""
+        return self._consume(CONNECTION_RULE, self._clock())
+
+    def check(self, module_name: str, action_name: str) -> float:
+        """0 if the action may run, else the seconds to wait before retrying"""
+        now = self._clock()
+        for rule in (f"{module_name}:{action_name}", module_name):
+            if rule in self.rules:
+                return self._consume(rule, now)
+        return 0.0
+
+    def _consume(self, rule: str, now: float) -> float:
+        bucket = self._buckets.get(rule)
+        if bucket is None:
+            rate = self.rules.get(rule)
+            if not rate:
+                return 0.0
+            bucket = self._buckets[rule] = TokenBucket(*parse_rate(rate), now=now)
+        return bucket.consume(now)
+
+
+class UserRateLimiter:
+    """
+    Token bucket per user in Redis, shared by all of the user's connections on
+    every worker (CHAT_WS_USER_RATE_LIMIT). Costs one round trip per frame, so
+    it is checked after the connection's own buckets and is off by default.
+    """
+
+    # KEYS[1]: bucket hash, ARGV: capacity, fill rate (tokens/s), now (s)
+    # Returns 0, or the milliseconds until a token is available
+    _CONSUME_SCRIPT = """
+        local capacity = tonumber(ARGV[1])
+        local fill_rate = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or capacity
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - updated) * fill_rate)
+        local retry_after = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            retry_after = math.ceil((1 - tokens) / fill_rate * 1000)
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / fill_rate) + 1)
+        return retry_after
+    """
+
+    def __init__(self, rate: Optional[str]):
+        self.rate = rate
+
+    @staticmethod
+    def _key(user_id) -> str:
+        return cache.make_key(f"chat_ws_rate_user_{user_id}")
+
+    def consume(self, user_id) -> float:
+        capacity, fill_rate = parse_rate(self.rate)
+        retry_after_ms = get_redis_connection("default").eval(
+            self._CONSUME_SCRIPT, 1, self._key(user_id), capacity, fill_rate, time.time()
+        )
+        return int(retry_after_ms) / 1000
+
+    async def check(self, user_id) -> float:
+        """0 if the user may send another frame, else the seconds to wait"""
+        if not self.rate or user_id is None:
+            return 0.0
+        try:
+            # Not a DB call, so keep it off the shared thread_sensitive executor
+            return await sync_to_async(self.consume, thread_sensitive=False)(user_id)
+        except Exception as e:
+            # fail open, the per connection buckets still apply
+            logger.error(f"User rate limit check failed: {str(e)}")
+            return 0.0
+
+
+user_rate_limiter = UserRateLimiter(settings.CHAT_WS_USER_RATE_LIMIT)
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DataError, IntegrityError, transaction
+from django.utils import timezone
+
+from .models import ChatParticipant
+
+logger = logging.getLogger(__name__)
+
+# errors of one watermark's own values, which a retry won't fix
+ROW_ERRORS = (DataError, IntegrityError, OverflowError)
+
+
+class ReadWatermarkWriter:
+    """
+    Per-process read watermark coalescer.
+
+    A participant's read state is one number, ChatParticipant.last_read_seq:
+    everything up to that message seq has been read. advance() only raises the
+    pending watermark and tells the caller whether it moved, so a burst of
+    mark_read calls costs no I/O. Every `flush_interval` seconds the highest
+    watermark of each (room, user) is written with one UPDATE per participant.
+
+    The UPDATE only ever raises last_read_seq, so flushes from different
+    workers can land in any order. Clients should likewise keep the highest
+    last_read_seq they receive per user.
+
+    The last `max_flushed` written watermarks are remembered as well, so a
+    repeated mark_read after a flush is still a no-op. A watermark the
+    database rejects is dropped on its own (the batch is retried row by row).
+    A flush failing otherwise puts its watermarks back to be retried with the
+    next one, up to `max_retries` flushes in a row, after which they are dropped.
+    """
+
+    def __init__(self, flush_interval: float, max_flushed: int = 100000, max_retries: int = 5):
+        self.flush_interval = flush_interval
+        self.max_flushed = max_flushed
+        self.max_retries = max_retries
+        self._failed_flushes = 0
+        self._pending: Dict[Tuple[str, str], tuple] = {}  # (room, user) -> (seq, read_at)
+        self._flushed: OrderedDict = OrderedDict()  # (room, user) -> seq, LRU
+        self._flush_task = None
+
+    def get(self, room_id, user_id) -> Optional[int]:
+        """The highest watermark this worker has seen for the participant, None if it has none"""
+        key = (str(room_id), str(user_id))
+        if key in self._pending:
+            return self._pending[key][0]
+        return self._flushed.get(key)
+
+    def advance(self, room_id, user_id, seq: int) -> bool:
+        """Returns False if the watermark is already at or past `seq`"""
+        current = self.get(room_id, user_id)
+        if current is not None and seq <= current:
+            return False
+
+        self._pending[(str(room_id), str(user_id))] = (seq, timezone.now())
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+        return True
+
+    def flush(self, pending: Dict[Tuple[str, str], tuple]):
+        """
+        Write the watermarks in one transaction. If a row's values break it,
+        each is written on its own instead and the rejected ones are dropped.
+        """
+        try:
+            self._write(pending.items())
+        except ROW_ERRORS:
+            for key, watermark in pending.items():
+                try:
+                    self._write([(key, watermark)])
+                except ROW_ERRORS as e:
+                    logger.error(f"Dropped read watermark {key[0]}/{key[1]} -> {watermark[0]}: {str(e)}")
+
+    @staticmethod
+    def _write(watermarks):
+        with transaction.atomic():
+            for (room_id, user_id), (seq, read_at) in watermarks:
+                ChatParticipant.objects.filter(
+                    chatroom_id=room_id, user_id=user_id, last_read_seq__lt=seq
+                ).update(last_read_seq=seq, last_read_at=read_at)
+
+    async def _flush_loop(self):
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            pending, self._pending = self._pending, {}
+            try:
+                await database_sync_to_async(self.flush)(pending)
+            except Exception as e:
+                self._failed_flushes += 1
+                if self._failed_flushes <= self.max_retries:
+                    logger.error(f"Read watermark flush failed: {str(e)}")
+                    self._restore(pending)
+                else:
+                    logger.error(f"Read watermark flush failed {self._failed_flushes} times, "
+                                 f"dropped {len(pending)} watermarks: {str(e)}")
+                    self._failed_flushes = 0
+            else:
+                self._failed_flushes = 0
+                self._remember(pending)
+
+    def _restore(self, pending: Dict[Tuple[str, str], tuple]):
+        """Put back the watermarks of a failed flush, unless they moved on meanwhile"""
+        for key, watermark in pending.items():
+            if key not in self._pending or self._pending[key][0] < watermark[0]:
+                self._pending[key] = watermark
+
+    def _remember(self, pending: Dict[Tuple[str, str], tuple]):
+        for key, (seq, _) in pending.items():
+            self._flushed[key] = max(seq, self._flushed.get(key, seq))
+            self._flushed.move_to_end(key)
+        while len(self._flushed) > self.max_flushed:
+            self._flushed.popitem(last=False)
+
+
+read_watermarks = ReadWatermarkWriter(settings.CHAT_READ_WATERMARK_FLUSH_INTERVAL)
@@ -0,0 +1,53 @@
+from rest_framework import serializers
+
+from src.chats.models import Attachment, Message, PinnedMessage, Reaction
+
+
+class AttachmentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Attachment
+        fields = ("id", "file_url", "type", "uploaded_at")
+
+
+class ReactionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Reaction
+        fields = ("id", "user_id", "emoji", "created_at")
+
+
+class PinnedMessageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PinnedMessage
+        fields = ("pinned_by_id", "pinned_at")
+
+
+class MessageSerializer(serializers.ModelSerializer):
+    """Expects messages from ChatHistoryService.get_page (relations already loaded)"""
+
+    attachments = AttachmentSerializer(many=True, read_only=True)
+    reactions = ReactionSerializer(many=True, read_only=True)
+    pinned = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Message
+        fields = (
+            "id",
+            "chatroom_id",
+            "sender_id",
+            "content",
+            "seq",
+            "created_at",
+            "attachments",
+            "reactions",
+            "pinned",
+        )
+
+    def get_pinned(self, message):
+        pinned = getattr(message, "pinned", None)
+        return PinnedMessageSerializer(pinned).data if pinned else None
+
+
+class MessageHistoryQuerySerializer(serializers.Serializer):
+    chatroom_id = serializers.UUIDField()
+    before = serializers.CharField(required=False, help_text="next_cursor of the previous page")
+    limit = serializers.IntegerField(required=False, min_value=1)
@@ -0,0 +1,715 @@
+import base64
+import binascii
+import itertools
+import logging
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, F, Max, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django_redis import get_redis_connection
+
+from .models import ChatChange, ChatParticipant, Message
+
+logger = logging.getLogger(__name__)
+
+
+class RedisCachedIndex:
+    """
+    Base of the Redis structures below, one per owner (a user or a room),
+    filled from Postgres on a miss and updated in place by the code that
+    changes the rows behind them.
+
+    A cached structure always holds SENTINEL, so an owner with nothing in it
+    still gets a cache hit. Every update bumps a version key next to the
+    structure (see _updating), and a fill only lands if the version is still
+    the one read before the Postgres query. Otherwise a fill racing an update
+    could write back what it read before the update and keep it for TIMEOUT.
+    """
+
+    SENTINEL = "-"
+    TIMEOUT = 60 * 60 * 24  # 1 day, bounds how long a missed update can linger
+
+    KEY: str  # key of an owner's structure, formatted with the owner id
+    TYPE: str  # "set" or "hash"
+
+    # KEYS[1]: structure, KEYS[2]: version
+    # ARGV: version read before the query, timeout, type, then members (set) or fields and values (hash)
+    _FILL_IF_UNCHANGED_SCRIPT = """
+        if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+            return 0
+        end
+        redis.call('DEL', KEYS[1])
+        local command = ARGV[3] == 'set' and 'SADD' or 'HSET'
+        -- unpack() takes a limited number of values, an even chunk size keeps hash pairs together
+        for i = 4, #ARGV, 1000 do
+            redis.call(command, KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+        end
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+        return 1
+    """
+
+    @classmethod
+    def _key(cls, owner_id) -> str:
+        return cache.make_key(cls.KEY.format(owner_id))
+
+    @classmethod
+    def _version_key(cls, owner_id) -> str:
+        return cache.make_key(cls.KEY.format(owner_id) + "_version")
+
+    @classmethod
+    def _read_version(cls, owner_id) -> str:
+        """Read before querying Postgres for a fill"""
+        version = get_redis_connection("default").get(cls._version_key(owner_id))
+        return version.decode() if version else ""
+
+    @classmethod
+    def _fill(cls, owner_id, version: str, values) -> bool:
+        """
+        Replace the cached structure with `values` (members, or a {field: value}
+        dict), unless the owner was updated since `version` was read.
+        """
+        if cls.TYPE == "set":
+            args = [cls.SENTINEL, *values]
+        else:
+            args = [cls.SENTINEL, cls.SENTINEL, *itertools.chain.from_iterable(values.items())]
+        return bool(get_redis_connection("default").eval(
+            cls._FILL_IF_UNCHANGED_SCRIPT, 2, cls._key(owner_id), cls._version_key(owner_id),
+            version, cls.TIMEOUT, cls.TYPE, *args,
+        ))
+
+    @classmethod
+    def _updating(cls, owner_ids):
+        """
+        Transaction pipeline that bumps the owners' versions.
+        Queue the update itself on it, then execute() it.
+        """
+        pipe = get_redis_connection("default").pipeline()
+        for owner_id in owner_ids:
+            version_key = cls._version_key(owner_id)
+            pipe.incr(version_key)
+            pipe.expire(version_key, cls.TIMEOUT * 2)  # outlives the structure
+        return pipe
+
+
+class ChatMembershipIndex(RedisCachedIndex):
+    """
+    Redis set of chat room ids per user, so WebSocket connect/disconnect can find
+    the user's rooms without querying ChatRoom/ChatParticipant.
+
+    The set is filled from Postgres on a miss and kept up to date by the
+    ChatParticipant signals in src.chats.signals.
+    """
+
+    KEY = "chat_rooms_user_{}"
+    TYPE = "set"
+
+    _ADD_IF_CACHED_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            return redis.call('SADD', KEYS[1], ARGV[1])
+        end
+        return 0
+    """
+
+    @classmethod
+    def get_room_ids(cls, user_id) -> list:
+        """
+        Returns the ids (as strings) of every room the user participates in.
+        Reads Redis and only falls back to Postgres on a miss.
+        """
+        members = get_redis_connection("default").smembers(cls._key(user_id))
+        if members:
+            return [member.decode() for member in members if member.decode() != cls.SENTINEL]
+        return cls.rebuild(user_id)
+
+    @classmethod
+    def rebuild(cls, user_id) -> list:
+        version = cls._read_version(user_id)
+        room_ids = [
+            str(room_id)
+            for room_id in ChatParticipant.objects.filter(user_id=user_id).values_list(
+                "chatroom_id", flat=True
+            )
+        ]
+        cls._fill(user_id, version, room_ids)
+        return room_ids
+
+    @classmethod
+    def add_room(cls, user_id, room_id):
+        """Add a room to an already cached set. A missing set stays missing and is
+        rebuilt from Postgres on the next read, so it can't end up partial."""
+        pipe = cls._updating([user_id])
+        pipe.eval(cls._ADD_IF_CACHED_SCRIPT, 1, cls._key(user_id), str(room_id))
+        pipe.execute()
+
+    @classmethod
+    def remove_room(cls, user_id, room_id):
+        pipe = cls._updating([user_id])
+        pipe.srem(cls._key(user_id), str(room_id))
+        pipe.execute()
+
+
+class ChatRoomRoles(RedisCachedIndex):
+    """
+    Redis hash of a chat room's participants and their role: {user id: role}.
+
+    There is no role column: the seller of a product chat's product is its
+    admin, every other participant is a member. The hash is filled from
+    Postgres on a miss and dropped by the ChatParticipant signals in
+    src.chats.signals, so the next read rebuilds it. Workers keep their own
+    copy of the roles they use in src.chats.membership.
+    """
+
+    KEY = "chat_room_roles_{}"
+    TYPE = "hash"
+
+    ADMIN = "admin"
+    MEMBER = "member"
+
+    @classmethod
+    def get_role(cls, room_id, user_id):
+        """The user's role in the room, None if they are not a participant"""
+        try:
+            room_id = uuid.UUID(str(room_id))
+        except ValueError:
+            return None
+
+        key = cls._key(room_id)
+        pipe = get_redis_connection("default").pipeline(transaction=False)
+        pipe.hget(key, str(user_id))
+        pipe.exists(key)
+        role, cached = pipe.execute()
+        if cached:
+            return role.decode() if role else None
+        return cls.rebuild(room_id).get(str(user_id))
+
+    @classmethod
+    def rebuild(cls, room_id) -> dict:
+        version = cls._read_version(room_id)
+        participants = ChatParticipant.objects.filter(chatroom_id=room_id).values_list(
+            "user_id", "chatroom__product__seller_id"
+        )
+        roles = {
+            str(user_id): cls.ADMIN if user_id == seller_id else cls.MEMBER
+            for user_id, seller_id in participants
+        }
+        cls._fill(room_id, version, roles)
+        return roles
+
+    @classmethod
+    def forget(cls, room_id):
+        pipe = cls._updating([room_id])
+        pipe.delete(cls._key(room_id))
+        pipe.execute()
+
+
+class UnreadCounters(RedisCachedIndex):
+    """
+    Unread message counts in one Redis hash per user: {room id: count}.
+
+    Counters are bumped for every other participant when a message is stored
+    (or journaled, with CHAT_WRITE_BEHIND) and reset when the user's read
+    watermark advances, so the chat list gets every badge with one HGETALL.
+    A missing hash is rebuilt from Postgres (messages after last_read_seq)
+    on the next read; updates never create a hash, so it can't end up partial.
+
+    Read watermarks reach Postgres in batches (src.chats.read_receipts), so
+    reset() also keeps them in a second hash per user (READ_KEY) for
+    READ_TIMEOUT, which rebuilds use where it is ahead of last_read_seq.
+    """
+
+    KEY = "chat_unread_user_{}"
+    TYPE = "hash"
+
+    READ_KEY = "chat_read_seq_user_{}"  # {room id: read seq}
+    READ_TIMEOUT = 60 * 60  # outlives the read watermark flushes by far
+
+    # KEYS: user hashes, ARGV[1]: room id
+    _INCREMENT_IF_CACHED_SCRIPT = """
+        for _, key in ipairs(KEYS) do
+            if redis.call('EXISTS', key) == 1 then
+                redis.call('HINCRBY', key, ARGV[1], 1)
+            end
+        end
+        return 0
+    """
+
+    # KEYS[1]: unread hash, KEYS[2]: read watermarks, KEYS[3]: the room's seq counter
+    # ARGV[1]: room id, ARGV[2]: read seq, ARGV[3]: READ_TIMEOUT
+    # Returns 1 if the room has messages after the read seq, which need a recount
+    _RESET_SCRIPT = """
+        local seq = tonumber(ARGV[2])
+        if seq > tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '-1') then
+            redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+        end
+        redis.call('EXPIRE', KEYS[2], ARGV[3])
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return 0
+        end
+        local head = redis.call('GET', KEYS[3])
+        if head and seq >= tonumber(head) then
+            redis.call('HSET', KEYS[1], ARGV[1], 0)
+            return 0
+        end
+        return 1
+    """
+
+    # KEYS[1]: unread hash, KEYS[2]: version, ARGV[1]: version read before the count, ARGV[2]: room id, ARGV[3]: count
+    _SET_IF_UNCHANGED_SCRIPT = """
+        if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] or redis.call('EXISTS', KEYS[1]) == 0 then
+            return 0
+        end
+        redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+        return 1
+    """
+
+    @classmethod
+    def _read_key(cls, user_id) -> str:
+        return cache.make_key(cls.READ_KEY.format(user_id))
+
+    @classmethod
+    def get_counts(cls, user_id) -> dict:
+        """Unread count of every room the user is in, {room id (str): count}"""
+        counts = get_redis_connection("default").hgetall(cls._key(user_id))
+        if counts:
+            return {
+                room_id.decode(): int(count)
+                for room_id, count in counts.items()
+                if room_id.decode() != cls.SENTINEL
+            }
+        return cls.rebuild(user_id)
+
+    @classmethod
+    def rebuild(cls, user_id) -> dict:
+        """Recount in one query (two if a read watermark is ahead of Postgres) and replace the cached hash"""
+        version = cls._read_version(user_id)
+        read_seqs = cls._read_seqs(user_id)
+        participations = ChatParticipant.objects.filter(user_id=user_id).annotate(
+            unread=Count(
+                "chatroom__messages",
+                filter=Q(chatroom__messages__seq__gt=F("last_read_seq"))
+                & ~Q(chatroom__messages__sender_id=user_id),
+            )
+        )
+        counts, watermarks, ahead = {}, {}, {}
+        for room_id, last_read_seq, unread in participations.values_list("chatroom_id", "last_read_seq", "unread"):
+            room_id = str(room_id)
+            counts[room_id] = unread
+            watermarks[room_id] = last_read_seq
+            if read_seqs.get(room_id, 0) > last_read_seq:  # read, not flushed to Postgres yet
+                watermarks[room_id] = ahead[room_id] = read_seqs[room_id]
+
+        if ahead:
+            counts.update(cls._count_stored(user_id, ahead))
+        for room_id, journaled in cls._count_journaled(user_id, watermarks).items():
+            counts[room_id] += journaled
+
+        cls._fill(user_id, version, counts)
+        return counts
+
+    @classmethod
+    def increment(cls, room_id, sender_id):
+        """A message from sender_id was stored in room_id"""
+        user_ids = ChatParticipant.objects.filter(chatroom_id=room_id).exclude(user_id=sender_id).values_list(
+            "user_id", flat=True
+        )
+        user_ids = list(user_ids)
+        if user_ids:
+            pipe = cls._updating(user_ids)
+            keys = [cls._key(user_id) for user_id in user_ids]
+            pipe.eval(cls._INCREMENT_IF_CACHED_SCRIPT, len(keys), *keys, str(room_id))
+            pipe.execute()
+
+    @classmethod
+    def reset(cls, room_id, user_id, seq: int):
+        """
+        The user's read watermark in room_id advanced to `seq`. The count goes
+        to 0 unless the room has messages after `seq`, then it is recounted.
+        """
+        room_id = str(room_id)
+        pipe = cls._updating([user_id])
+        pipe.eval(
+            cls._RESET_SCRIPT, 3, cls._key(user_id), cls._read_key(user_id), ChatMessageService._seq_key(room_id),
+            room_id, int(seq), cls.READ_TIMEOUT,
+        )
+        if pipe.execute()[-1]:
+            cls._recount(room_id, user_id)
+
+    @classmethod
+    def _recount(cls, room_id: str, user_id):
+        version = cls._read_version(user_id)
+        read_seq = max(
+            cls._read_seqs(user_id).get(room_id, 0),
+            ChatParticipant.objects.filter(chatroom_id=room_id, user_id=user_id).values_list(
+                "last_read_seq", flat=True
+            ).first() or 0,
+        )
+        count = cls._count_stored(user_id, {room_id: read_seq})[room_id]
+        count += cls._count_journaled(user_id, {room_id: read_seq}).get(room_id, 0)
+
+        connection = get_redis_connection("default")
+        if not connection.eval(
+            cls._SET_IF_UNCHANGED_SCRIPT, 2, cls._key(user_id), cls._version_key(user_id), version, room_id, count
+        ):
+            # updated meanwhile, the count may be off: rebuild on the next read
+            pipe = cls._updating([user_id])
+            pipe.delete(cls._key(user_id))
+            pipe.execute()
+
+    @classmethod
+    def _read_seqs(cls, user_id) -> dict:
+        """Read watermarks of the last READ_TIMEOUT, {room id: seq}"""
+        read_seqs = get_redis_connection("default").hgetall(cls._read_key(user_id))
+        return {room_id.decode(): int(seq) for room_id, seq in read_seqs.items()}
+
+    @staticmethod
+    def _count_stored(user_id, watermarks: dict) -> dict:
+        """Stored messages of others after each room's watermark, {room id: count}"""
+        after = Q()
+        for room_id, seq in watermarks.items():
+            after |= Q(chatroom_id=room_id, seq__gt=seq)
+        counted = (
+            Message.objects.filter(after).exclude(sender_id=user_id)
+            .values("chatroom_id").annotate(unread=Count("id")).values_list("chatroom_id", "unread")
+        )
+        counts = dict.fromkeys(watermarks, 0)
+        counts.update((str(room_id), unread) for room_id, unread in counted)
+        return counts
+
+    @staticmethod
+    def _count_journaled(user_id, watermarks: dict) -> dict:
+        """Messages of others after each room's watermark still in the write-behind journal, {room id: count}"""
+        from .persistence import message_write_behind  # persistence imports this module
+
+        user_id = str(user_id)
+        messages = [
+            message for message in message_write_behind.journaled()
+            if message["sender_id"] != user_id and message["seq"] > watermarks.get(message["chatroom_id"], message["seq"])
+        ]
+        if not messages:
+            return {}
+        # a batch stays journaled until shortly after its commit
+        stored = {
+            str(message_id)
+            for message_id in Message.objects.filter(id__in=[message["id"] for message in messages]).values_list(
+                "id", flat=True
+            )
+        }
+        counts = {}
+        for message in messages:
+            if message["id"] not in stored:
+                counts[message["chatroom_id"]] = counts.get(message["chatroom_id"], 0) + 1
+        return counts
+
+
+class ChatMessageService:
+    """
+    Builds chat messages with their id, per-room seq and timestamp assigned up
+    front, so a message can be broadcast before it is stored
+    (see src.chats.persistence).
+    """
+
+    @staticmethod
+    def _seq_key(room_id) -> str:
+        return cache.make_key(f"chat_room_seq_{room_id}")
+
+    @classmethod
+    def next_seq(cls, room_id) -> int:
+        """
+        Next message sequence number of a room, from a Redis counter.
+        The counter is seeded from the highest seq in Postgres if Redis lost it.
+        """
+        connection = get_redis_connection("default")
+        return connection.incr(cls._seeded_seq_key(connection, room_id))
+
+    @classmethod
+    def current_seq(cls, room_id) -> int:
+        """Seq of the room's latest message, 0 if it has none"""
+        connection = get_redis_connection("default")
+        return int(connection.get(cls._seeded_seq_key(connection, room_id)))
+
+    @classmethod
+    def _seeded_seq_key(cls, connection, room_id) -> str:
+        key = cls._seq_key(room_id)
+        if not connection.exists(key):
+            last_seq = Message.objects.filter(chatroom_id=room_id).aggregate(Max("seq"))["seq__max"]
+            connection.set(key, last_seq or 0, nx=True)
+        return key
+
+    @classmethod
+    def build_message(cls, room_id, sender_id, content: str) -> dict:
+        """Assign the id, seq and timestamp of a new message without saving it"""
+        return {
+            "id": str(uuid.uuid4()),
+            "chatroom_id": str(room_id),
+            "sender_id": str(sender_id),
+            "content": content,
+            "seq": cls.next_seq(room_id),
+            "created_at": timezone.now(),
+        }
+
+    @staticmethod
+    def to_model(message: dict) -> Message:
+        return Message(
+            id=message["id"],
+            chatroom_id=message["chatroom_id"],
+            sender_id=message["sender_id"],
+            content=message["content"],
+            seq=message["seq"],
+            created_at=message["created_at"],
+        )
+
+    @classmethod
+    def create_message(cls, room_id, sender_id, content: str) -> dict:
+        message = cls.build_message(room_id, sender_id, content)
+        cls.to_model(message).save(force_insert=True)
+        return message
+
+
+def is_read_seq(seq) -> bool:
+    """A `seq` as mark_read accepts it: a non-negative int"""
+    return isinstance(seq, int) and not isinstance(seq, bool) and seq >= 0
+
+
+def resolve_read_seq(room_id, payload: dict):
+    """
+    Seq for a mark_read payload: `seq` as sent, capped at the room's latest
+    seq, or the seq of `message_id`. Returns None if neither is usable.
+    """
+    seq = payload.get("seq")
+    if seq is not None:
+        if not is_read_seq(seq):
+            return None
+        return min(seq, ChatMessageService.current_seq(room_id))
+
+    message_id = payload.get("message_id")
+    if not message_id:
+        return None
+    try:
+        return read_seq_query(room_id, message_id).first()
+    except (ValueError, ValidationError):
+        return None
+
+
+def read_seq_query(room_id, message_id):
+    return Message.objects.filter(id=message_id, chatroom_id=room_id).values_list("seq", flat=True)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class ChatHistoryService:
+    """
+    Keyset pagination over a room's messages, newest first.
+
+    A page is read with the (chatroom, created_at, id) index and the cursor is
+    the (created_at, id) of the oldest message of the previous page, so every
+    page costs the same no matter how deep into the history it is. Attachments,
+    reactions and pins are loaded for the whole page in a fixed number of queries.
+    """
+
+    @staticmethod
+    def encode_cursor(message) -> str:
+        raw = f"{message.created_at.isoformat()}|{message.id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str):
+        try:
+            created_at, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+            created_at = parse_datetime(created_at)
+            message_id = uuid.UUID(message_id)
+        except (binascii.Error, UnicodeError, ValueError) as e:
+            raise InvalidCursor("Invalid cursor") from e
+        if created_at is None:
+            raise InvalidCursor("Invalid cursor")
+        return created_at, message_id
+
+    @classmethod
+    def get_page(cls, room_id, before: str = None, limit: int = None):
+        """
+        Returns (messages, next_cursor), messages newest first.
+        next_cursor is None once the start of the room is reached.
+        """
+        messages, limit = cls.page_query(room_id, before, limit)
+        return cls.to_page(list(messages), limit)
+
+    @classmethod
+    def page_query(cls, room_id, before: str = None, limit: int = None):
+        """(queryset of the page's messages, page size), see get_page"""
+        limit = min(limit or settings.CHAT_HISTORY_PAGE_SIZE, settings.CHAT_HISTORY_MAX_PAGE_SIZE)
+
+        messages = (
+            Message.objects.filter(chatroom_id=room_id)
+            .select_related("pinned")
+            .prefetch_related("attachments", "reactions")
+            .order_by("-created_at", "-id")
+        )
+        if before:
+            created_at, message_id = cls.decode_cursor(before)
+            messages = messages.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+            )
+
+        # one extra row tells whether there is another page
+        return messages[: limit + 1], limit
+
+    @classmethod
+    def to_page(cls, messages: list, limit: int):
+        if len(messages) > limit:
+            messages = messages[:limit]
+            return messages, cls.encode_cursor(messages[-1])
+        return messages, None
+
+
+class ChatChangeLog:
+    """
+    Writes and reads the ChatChange log used for delta sync.
+
+    Changes are written in the same transaction as the row they describe
+    (see src.chats.signals, and MessageWriteBehind.flush for batched
+    messages), numbered once committed (sequence) and read per user over the
+    rooms they are in plus the changes addressed to them.
+
+    Changes older than CHAT_SYNC_RETENTION are deleted (prune, run by
+    PruneChatChangesTask). Cursors from before the oldest change left
+    (floor) are answered with a reset.
+    """
+
+    SEQUENCE_LOCK_KEY = "chat_change_sequence_lock"
+    SEQUENCE_BATCH_SIZE = 1000
+    PRUNE_BATCH_SIZE = 10000
+    # Notification types delta sync serves, only these are logged
+    SYNCED_NOTIFICATION_TYPES = ("chat",)
+
+    @staticmethod
+    def build(kind, op, object_id, data=None, chatroom_id=None, user_id=None) -> ChatChange:
+        return ChatChange(
+            kind=kind,
+            op=op,
+            object_id=str(object_id),
+            data=data or {},
+            chatroom_id=chatroom_id,
+            user_id=user_id,
+        )
+
+    @classmethod
+    def record(cls, *args, **kwargs) -> ChatChange:
+        change = cls.build(*args, **kwargs)
+        change.save()
+        return change
+
+    @classmethod
+    def logs_notification(cls, notification) -> bool:
+        return notification.type in cls.SYNCED_NOTIFICATION_TYPES
+
+    @staticmethod
+    def message_data(message) -> dict:
+        """Snapshot of a Message (or a message dict from ChatMessageService)"""
+        if isinstance(message, dict):
+            return {field: message[field] for field in ("id", "chatroom_id", "sender_id", "content", "seq", "created_at")}
+        return {
+            "id": message.id,
+            "chatroom_id": message.chatroom_id,
+            "sender_id": message.sender_id,
+            "content": message.content,
+            "seq": message.seq,
+            "created_at": message.created_at,
+        }
+
+    @classmethod
+    def sequence(cls) -> int:
+        """
+        Give the committed changes without a seq the next ones, in id order.
+        A change only becomes visible here once its transaction committed, so
+        it gets a higher seq than everything already read: no reader can have
+        moved past it. Runs before reads, one worker at a time (a Redis lock,
+        the unique seq backs it up). Returns how many changes were numbered.
+        """
+        lock = cache.lock(cls.SEQUENCE_LOCK_KEY, timeout=60)
+        if not lock.acquire(blocking=False):
+            return 0  # another worker is numbering them
+        try:
+            numbered = 0
+            while True:
+                with transaction.atomic():
+                    ids = list(
+                        ChatChange.objects.filter(seq__isnull=True).order_by("id")
+                        .values_list("id", flat=True)[:cls.SEQUENCE_BATCH_SIZE]
+                    )
+                    if not ids:
+                        return numbered
+                    head = ChatChange.objects.aggregate(Max("seq"))["seq__max"] or 0
+                    ChatChange.objects.bulk_update(
+                        [ChatChange(id=change_id, seq=head + n) for n, change_id in enumerate(ids, 1)], ["seq"]
+                    )
+                numbered += len(ids)
+                if len(ids) < cls.SEQUENCE_BATCH_SIZE:
+                    return numbered
+        finally:
+            lock.release()
+
+    @staticmethod
+    def head_query():
+        return ChatChange.objects.filter(seq__isnull=False).order_by("-seq").values_list("seq", flat=True)
+
+    @classmethod
+    def head(cls) -> int:
+        """Sequence of the newest change, a starting point for new clients"""
+        return cls.head_query().first() or 0
+
+    @staticmethod
+    def floor_query():
+        return ChatChange.objects.filter(seq__isnull=False).order_by("seq").values_list("seq", flat=True)
+
+    @classmethod
+    def floor(cls) -> int:
+        """Oldest cursor still served: every change after it is in the log"""
+        oldest = cls.floor_query().first()
+        return oldest - 1 if oldest is not None else 0
+
+    @classmethod
+    def prune(cls, retention: float) -> int:
+        """
+        Delete the changes older than `retention` seconds, oldest seq first,
+        so the log is always everything after floor(). The newest change is
+        kept for floor() to go by. Returns how many were deleted.
+        """
+        cutoff = timezone.now() - timedelta(seconds=retention)
+        head = cls.head()
+        deleted = 0
+        while True:
+            oldest = list(
+                ChatChange.objects.filter(seq__lt=head).order_by("seq")
+                .values_list("seq", "created_at")[:cls.PRUNE_BATCH_SIZE]
+            )
+            expired = list(itertools.takewhile(lambda change: change[1] < cutoff, oldest))
+            if expired:
+                deleted += ChatChange.objects.filter(seq__lte=expired[-1][0]).delete()[0]
+            if len(expired) < cls.PRUNE_BATCH_SIZE:
+                return deleted
+
+    @staticmethod
+    def changes_query(room_ids, user_id, after: int, limit: int):
+        return (
+            ChatChange.objects.filter(Q(chatroom_id__in=room_ids) | Q(user_id=user_id), seq__gt=after)
+            .order_by("seq")
+            .values("seq", "kind", "op", "object_id", "chatroom_id", "data", "created_at")
+        )[:limit]
+
+    @classmethod
+    def get_changes(cls, user_id, after: int, limit: int) -> list:
+        """Up to `limit` changes visible to the user with a sequence above `after`, oldest first"""
+        return cls.changes(ChatMembershipIndex.get_room_ids(user_id), user_id, after, limit)
+
+    @classmethod
+    def changes(cls, room_ids, user_id, after: int, limit: int) -> list:
+        """get_changes for a user in `room_ids`"""
+        cls.sequence()
+        return list(cls.changes_query(room_ids, user_id, after, limit))
@@ -0,0 +1,124 @@
+from django.db import transaction
+from django.db.models import Subquery
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from src.notifications.models import Notification
+from .membership import publish_membership_change
+from .models import ChatParticipant, Message, PinnedMessage, Reaction
+from .services import ChatChangeLog, ChatMembershipIndex, ChatRoomRoles
+
+
+def forget_role(user_id, room_id):
+    """Drop the room's cached roles, in Redis and in every worker"""
+    ChatRoomRoles.forget(room_id)
+    publish_membership_change(room_id, user_id)
+
+
+@receiver(post_save, sender=ChatParticipant)
+def add_room_to_membership_index(sender, instance, created, **kwargs):
+    if not created:
+        return
+
+    ChatChangeLog.record(
+        "membership", "upsert", instance.id,
+        {"chatroom_id": instance.chatroom_id, "user_id": instance.user_id},
+        chatroom_id=instance.chatroom_id, user_id=instance.user_id,
+    )
+    transaction.on_commit(
+        lambda: ChatMembershipIndex.add_room(instance.user_id, instance.chatroom_id)
+    )
+    transaction.on_commit(lambda: forget_role(instance.user_id, instance.chatroom_id))
+
+
+@receiver(post_delete, sender=ChatParticipant)
+def remove_room_from_membership_index(sender, instance, **kwargs):
+    # addressed to the user too, since they can no longer see the room's changes
+    ChatChangeLog.record(
+        "membership", "delete", instance.id,
+        {"chatroom_id": instance.chatroom_id, "user_id": instance.user_id},
+        chatroom_id=instance.chatroom_id, user_id=instance.user_id,
+    )
+    transaction.on_commit(
+        lambda: ChatMembershipIndex.remove_room(instance.user_id, instance.chatroom_id)
+    )
+    transaction.on_commit(lambda: forget_role(instance.user_id, instance.chatroom_id))
+
+
+# Sync log (SYNC:REQUEST_SYNC), written in the same transaction as the change.
+# Messages stored by MessageWriteBehind are logged by its flush instead.
+
+@receiver(post_save, sender=Message)
+def log_message_saved(sender, instance, **kwargs):
+    ChatChangeLog.record(
+        "message", "upsert", instance.id, ChatChangeLog.message_data(instance),
+        chatroom_id=instance.chatroom_id,
+    )
+
+
+@receiver(post_delete, sender=Message)
+def log_message_deleted(sender, instance, **kwargs):
+    ChatChangeLog.record("message", "delete", instance.id, chatroom_id=instance.chatroom_id)
+
+
+def message_room_id(message_id):
+    """The message's chatroom_id, looked up by the INSERT of the change rather than a query of its own"""
+    return Subquery(Message.objects.filter(id=message_id).values("chatroom_id")[:1])
+
+
+@receiver(post_save, sender=Reaction)
+def log_reaction_saved(sender, instance, **kwargs):
+    ChatChangeLog.record(
+        "reaction", "upsert", instance.id,
+        {"message_id": instance.message_id, "user_id": instance.user_id, "emoji": instance.emoji},
+        chatroom_id=message_room_id(instance.message_id),
+    )
+
+
+@receiver(post_delete, sender=Reaction)
+def log_reaction_deleted(sender, instance, **kwargs):
+    ChatChangeLog.record(
+        "reaction", "delete", instance.id,
+        {"message_id": instance.message_id, "user_id": instance.user_id},
+        chatroom_id=message_room_id(instance.message_id),
+    )
+
+
+@receiver(post_save, sender=PinnedMessage)
+def log_pin_saved(sender, instance, **kwargs):
+    ChatChangeLog.record(
+        "pin", "upsert", instance.id,
+        {"message_id": instance.message_id, "pinned_by_id": instance.pinned_by_id, "pinned_at": instance.pinned_at},
+        chatroom_id=instance.chatroom_id,
+    )
+
+
+@receiver(post_delete, sender=PinnedMessage)
+def log_pin_deleted(sender, instance, **kwargs):
+    ChatChangeLog.record(
+        "pin", "delete", instance.id, {"message_id": instance.message_id}, chatroom_id=instance.chatroom_id
+    )
+
+
+@receiver(post_save, sender=Notification)
+def log_notification_saved(sender, instance, **kwargs):
+    if not ChatChangeLog.logs_notification(instance):
+        return
+    ChatChangeLog.record(
+        "notification", "upsert", instance.id,
+        {
+            "type": instance.type,
+            "title": instance.title,
+            "message": instance.message,
+            "is_read": instance.is_read,
+            "created_at": instance.created_at,
+        },
+        user_id=instance.user_id,
+    )
+
+
+@receiver(post_delete, sender=Notification)
+def log_notification_deleted(sender, instance, **kwargs):
+    if not ChatChangeLog.logs_notification(instance):
+        return
+    ChatChangeLog.record("notification", "delete", instance.id, user_id=instance.user_id)
@@ -0,0 +1,125 @@
+import asyncio
+import functools
+from typing import Any, Awaitable, Callable, Dict, Hashable, NamedTuple, Optional, Tuple
+
+
+class SingleFlightOptions(NamedTuple):
+    ttl: float
+    key: Optional[Callable]
+
+
+def single_flight(ttl: float = 0.0, key: Optional[Callable] = None):
+    """
+    Mark a db_/redis_ method of a DatabaseServices mixin for coalescing
+    (applied by AutoDBMeta, after the method is made async):
+    ```
+    >>> class PresenceWebsocketServiceMixin:
+            @single_flight(ttl=1)
+            def redis_is_user_online(self, user_id) -> bool:
+                ...
+    ```
+    Concurrent calls with equal arguments share one call. With `ttl`, its
+    result is also reused for `ttl` seconds. The arguments (minus self) are
+    the key; methods that read state off self, like self.user, need `key`,
+    called with the method's arguments (self included).
+    """
+    def decorate(func):
+        func.single_flight = SingleFlightOptions(ttl, key)
+        return func
+
+    return decorate
+
+
+def _freeze(value) -> Hashable:
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        # dict keys are unique and hashable, no ordering (which mixed key types lack) needed
+        return frozenset((k, _freeze(v)) for k, v in value.items())
+    return value
+
+
+class SingleFlight:
+    """
+    Per-process coalescing of identical concurrent awaitables.
+
+    In a busy room many connections of a worker look up the same thing at
+    the same moment (membership, presence, the sync head). do() runs the
+    first call for a key as a task and has every caller with that key await
+    it until it finishes, so the database sees one query instead of one per
+    connection. A caller being cancelled doesn't cancel the shared call.
+
+    Results kept for `ttl` are shared objects: callers must not mutate them.
+    Failures are never kept, the next call tries again.
+    """
+
+    def __init__(self, max_memo: int = 4096):
+        self.max_memo = max_memo
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self._memo: Dict[Hashable, Tuple[float, Any]] = {}  # key -> (expires at, result)
+        self.calls = 0
+        self.shared = 0
+        self.memo_hits = 0
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable], ttl: float = 0.0):
+        loop = asyncio.get_running_loop()
+        if ttl:
+            memo = self._memo.get(key)
+            if memo is not None:
+                if memo[0] > loop.time():
+                    self.memo_hits += 1
+                    return memo[1]
+                del self._memo[key]
+
+        task = self._calls.get(key)
+        if task is None or task.get_loop() is not loop:
+            self.calls += 1
+            task = self._calls[key] = loop.create_task(call())
+            task.add_done_callback(functools.partial(self._done, key, ttl))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def wrap(self, method: Callable, options: SingleFlightOptions):
+        """Coalesce calls of an async method (see single_flight)"""
+        name = method.__qualname__
+
+        @functools.wraps(method)
+        async def coalesced(*args, **kwargs):
+            if options.key is None:
+                key = (name, _freeze(args[1:]), _freeze(kwargs))
+            else:
+                key = (name, options.key(*args, **kwargs))
+            try:
+                hash(key)
+            except TypeError:  # arguments that can't be a key are not coalesced
+                return await method(*args, **kwargs)
+            return await self.do(key, lambda: method(*args, **kwargs), options.ttl)
+
+        return coalesced
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "memo_hits": self.memo_hits,
+            "in_flight": len(self._calls),
+        }
+
+    def _done(self, key, ttl: float, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # always retrieve the exception, every waiter may have been cancelled
+        if task.cancelled() or task.exception() is not None or not ttl:
+            return
+        if len(self._memo) >= self.max_memo:
+            now = task.get_loop().time()
+            self._memo = {k: memo for k, memo in self._memo.items() if memo[0] > now}
+            if len(self._memo) >= self.max_memo:
+                self._memo.clear()
+        self._memo[key] = (task.get_loop().time() + ttl, task.result())
+
+
+single_flights = SingleFlight()
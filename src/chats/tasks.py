@@ -0,0 +1,34 @@
+from celery import shared_task
+from django.conf import settings
+
+from src.notifications.services import ACTIVITY_CHAT_NEW_MESSAGES, notify
+from src.users.models import User
+
+from .services import ChatChangeLog
+
+
+@shared_task(name="DeliverChatNotificationsTask")
+def deliver_chat_notifications(deliveries):
+    """
+    Email the notifications of one OfflineNotifier flush, one email per user,
+    through the notifications app (notify, EmailChannel).
+    deliveries: [{"user_id": ..., "notifications": [{"title": ..., "message": ...}]}]
+    """
+    users = User.objects.filter(id__in=[delivery["user_id"] for delivery in deliveries]).exclude(email="")
+    users = {str(user.id): user for user in users.only("id", "username", "email")}
+
+    for delivery in deliveries:
+        user = users.get(delivery["user_id"])
+        if user is None:
+            continue
+        notify(
+            ACTIVITY_CHAT_NEW_MESSAGES,
+            context={"username": user.username, "notifications": delivery["notifications"]},
+            email_to=[user.email],
+        )
+
+
+@shared_task(name="PruneChatChangesTask")
+def prune_chat_changes():
+    """Delete the sync log's changes older than CHAT_SYNC_RETENTION (run by beat)"""
+    return ChatChangeLog.prune(settings.CHAT_SYNC_RETENTION)
@@ -1,3 +1,1366 @@
-from django.test import TestCase
+import asyncio
+import functools
+import json
+import threading
+import uuid
+from datetime import datetime, timezone as dt_timezone
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer
+from django.db import DataError, IntegrityError, OperationalError
+from django.test import SimpleTestCase, override_settings
+from twisted.internet import abstract
+
+from src.chats.channel_layer import group_add_many, group_discard_many
+from src.chats.codecs import JSON_CODEC, MSGPACK_CODEC, negotiate_codec
+from src.chats.async_services import AsyncChatReadServiceMixin
+from src.chats.consumers import (
+    ACTION_ROUTES,
+    MODULE_CLASSES,
+    MODULE_HOOKS,
+    AppConsumer,
+    AsyncDatabaseServices,
+    DatabaseServices,
+)
+from src.chats.consumer_modules import (
+    MAX_PRESENCE_WATCH,
+    GroupChatModule,
+    PresenceModule,
+    SyncModule,
+    presence_group,
+)
+from src.chats.enums import ERR, BroadCastAction
+from src.chats.persistence import MessageWriteBehind
+from src.chats.services import (
+    ChatChangeLog,
+    ChatHistoryService,
+    ChatMembershipIndex,
+    ChatMessageService,
+    ChatRoomRoles,
+    InvalidCursor,
+    UnreadCounters,
+    resolve_read_seq,
+)
+from src.chats import presence
+from src.chats.executor import DBExecutor
+from src.chats.metrics import ChatMetrics, merge_snapshots
+from src.chats.notifications import MessageEvent, OfflineNotifier, group_events
+from src.chats.tasks import deliver_chat_notifications
+from src.chats.membership import MEMBERSHIP_CHANGES_GROUP, MembershipRoleCache
+from src.chats.heartbeat import CLOSE_CODE_HEARTBEAT_TIMEOUT, HeartbeatScheduler
+from src.chats.outbound import CLOSE_CODE_SLOW_CONSUMER, OutboundQueue, TransportProducer
+from src.chats.ratelimit import ConnectionRateLimiter, parse_rate
+from src.chats.read_receipts import ReadWatermarkWriter
+from src.chats.signals import log_notification_deleted, log_notification_saved
+from src.chats.singleflight import SingleFlight, SingleFlightOptions, single_flights
+from src.chats.typing import TypingCoalescer
+from src.notifications.services import ACTIVITY_CHAT_NEW_MESSAGES
+
+
+class ActionRoutingTableTestCase(SimpleTestCase):
+    def test_modules_are_registered_by_name(self):
+        self.assertIs(MODULE_CLASSES["GROUP_CHAT"], GroupChatModule)
+        self.assertIs(MODULE_CLASSES["PRESENCE"], PresenceModule)
+
+    def test_actions_are_routed_to_their_handlers(self):
+        route = ACTION_ROUTES["WS:GROUP_CHAT:SEND_MESSAGE"]
+        self.assertEqual(route.module_name, "GROUP_CHAT")
+        self.assertIs(route.handler, GroupChatModule.ACTION_send_message)
+        self.assertIn("WS:PRESENCE:IS_USER_ONLINE", ACTION_ROUTES)
+
+    def test_only_modules_defining_a_hook_are_run_for_it(self):
+        self.assertEqual(sorted(MODULE_HOOKS["on_connect"]), ["GROUP_CHAT", "PRESENCE"])
+        self.assertEqual(MODULE_HOOKS["on_pong"], ["PRESENCE"])
+
+
+class LazyModulesTestCase(SimpleTestCase):
+    def setUp(self):
+        self.consumer = AppConsumer()
+        self.consumer.scope = {"user": SimpleNamespace(id="me")}
+
+    def test_modules_are_built_on_first_use(self):
+        self.assertEqual(len(self.consumer.modules), 0)
+
+        module = self.consumer.modules["SYNC"]
+        self.assertIsInstance(module, SyncModule)
+        self.assertIs(self.consumer.modules["SYNC"], module)
+        self.assertEqual(list(self.consumer.modules), ["SYNC"])
+
+    def test_modules_have_no_instance_dict(self):
+        for module_name in MODULE_CLASSES:
+            self.assertFalse(hasattr(self.consumer.modules[module_name], "__dict__"), module_name)
+        self.assertFalse(hasattr(self.consumer.outbound, "__dict__"))
+
+
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+class AppConsumerReceiveTestCase(SimpleTestCase):
+    def setUp(self):
+        self.consumer = AppConsumer()
+        self.consumer.send = mock.AsyncMock()
+        self.module = mock.Mock(spec=GroupChatModule)
+        self.consumer.modules = {"GROUP_CHAT": self.module}
+
+    def receive(self, action, payload=None):
+        text_data = json.dumps({"action": action, "payload": payload or {}})
+        async_to_sync(self.consumer.receive)(text_data=text_data)
+
+    def sent_error_code(self):
+        return json.loads(self.consumer.send.call_args.kwargs["text_data"])["code"]
+
+    def test_dispatches_case_insensitive_action(self):
+        handler = mock.AsyncMock()
+        route = ACTION_ROUTES["WS:GROUP_CHAT:TYPING"]._replace(handler=handler)
+        with mock.patch.dict(ACTION_ROUTES, {"WS:GROUP_CHAT:TYPING": route}):
+            self.receive("ws:group_chat:typing", {"group_id": 1})
+
+        handler.assert_awaited_once_with(self.module, payload={"group_id": 1})
+        self.assertEqual(self.module._current_action, "WS:GROUP_CHAT:TYPING")
+
+    def test_rejects_unknown_module(self):
+        self.receive("WS:NOPE:TYPING")
+        self.assertEqual(self.sent_error_code(), ERR.MODULE_NOT_FOUND)
+
+    def test_rejects_unknown_action(self):
+        self.receive("WS:GROUP_CHAT:NOPE")
+        self.assertEqual(self.sent_error_code(), ERR.ACTION_NOT_FOUND)
+
+    def test_rejects_malformed_action(self):
+        self.receive("GROUP_CHAT")
+        self.assertEqual(self.sent_error_code(), ERR.INVALID_ACTION)
+
+    def test_decodes_binary_frames_as_msgpack(self):
+        handler = mock.AsyncMock()
+        route = ACTION_ROUTES["WS:GROUP_CHAT:TYPING"]._replace(handler=handler)
+        frame = MSGPACK_CODEC.encode({"action": "WS:GROUP_CHAT:TYPING", "payload": {"group_id": 1}})
+        with mock.patch.dict(ACTION_ROUTES, {"WS:GROUP_CHAT:TYPING": route}):
+            async_to_sync(self.consumer.receive)(bytes_data=frame)
+
+        handler.assert_awaited_once_with(self.module, payload={"group_id": 1})
+
+    def test_rejects_invalid_binary_frame(self):
+        async_to_sync(self.consumer.receive)(bytes_data=b"\xc1")
+        self.assertEqual(self.sent_error_code(), ERR.INVALID_FRAME)
+
+    def test_sends_binary_frames_on_msgpack_connection(self):
+        self.consumer.codec = MSGPACK_CODEC
+        async_to_sync(self.consumer.send_json)({"type": "ping"})
+
+        frame = self.consumer.send.call_args.kwargs["bytes_data"]
+        self.assertEqual(MSGPACK_CODEC.decode(frame), {"type": "ping"})
+
+
+class CodecNegotiationTestCase(SimpleTestCase):
+    def test_defaults_to_json(self):
+        self.assertEqual(negotiate_codec([]), (JSON_CODEC, None))
+        self.assertEqual(negotiate_codec(["graphql-ws"]), (JSON_CODEC, None))
+
+    def test_prefers_msgpack_when_offered(self):
+        self.assertEqual(negotiate_codec(["json", "msgpack"]), (MSGPACK_CODEC, "msgpack"))
+
+
+class BulkGroupMembershipTestCase(SimpleTestCase):
+    def test_falls_back_to_per_group_calls(self):
+        layer = InMemoryChannelLayer()
+        async_to_sync(group_add_many)(layer, ["group_1", "group_2"], "chan")
+        self.assertEqual(set(layer.groups), {"group_1", "group_2"})
+
+        async_to_sync(group_discard_many)(layer, ["group_1", "group_2"], "chan")
+        self.assertEqual(layer.groups, {})
+
+    def test_pipelines_redis_commands_per_shard(self):
+        layer = RedisChannelLayer(hosts=["redis://localhost:6379"])
+        pipe = mock.Mock(execute=mock.AsyncMock())
+        connection = mock.Mock(**{"pipeline.return_value": pipe})
+        with mock.patch.object(layer, "connection", return_value=connection):
+            async_to_sync(group_add_many)(layer, ["group_1", "group_2", "group_1"], "chan")
+
+        connection.pipeline.assert_called_once_with(transaction=False)
+        self.assertEqual(pipe.zadd.call_count, 2)
+        self.assertEqual(pipe.expire.call_count, 2)
+        pipe.execute.assert_awaited_once()
+
+
+class ChatMembershipIndexTestCase(SimpleTestCase):
+    @mock.patch("src.chats.services.get_redis_connection")
+    def test_reads_cached_room_ids_without_the_sentinel(self, get_redis_connection):
+        get_redis_connection.return_value.smembers.return_value = {b"-", b"room-1", b"room-2"}
+        self.assertEqual(sorted(ChatMembershipIndex.get_room_ids("user-1")), ["room-1", "room-2"])
+
+    @mock.patch("src.chats.services.ChatParticipant.objects")
+    @mock.patch("src.chats.services.get_redis_connection")
+    def test_keeps_sentinel_for_users_without_rooms(self, get_redis_connection, objects):
+        get_redis_connection.return_value.get.return_value = None
+        objects.filter.return_value.values_list.return_value = []
+
+        self.assertEqual(ChatMembershipIndex.rebuild("user-1"), [])
+        args = get_redis_connection.return_value.eval.call_args.args
+        self.assertEqual(args[2:], (
+            ChatMembershipIndex._key("user-1"), ChatMembershipIndex._version_key("user-1"),
+            "", ChatMembershipIndex.TIMEOUT, "set", "-",
+        ))
+
+    @mock.patch("src.chats.services.get_redis_connection")
+    def test_updates_bump_the_version(self, get_redis_connection):
+        ChatMembershipIndex.remove_room("user-1", "room-1")
+
+        pipe = get_redis_connection.return_value.pipeline.return_value
+        pipe.incr.assert_called_once_with(ChatMembershipIndex._version_key("user-1"))
+        pipe.srem.assert_called_once_with(ChatMembershipIndex._key("user-1"), "room-1")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PresenceTestCase(SimpleTestCase):
+    def test_coalesces_refreshes_into_one_write(self):
+        writer = presence.PresenceHeartbeatWriter(flush_interval=60)
+
+        async def run():
+            writer.refresh("user-1")
+            writer.refresh("user-2")
+            writer.refresh("user-1")
+            writer.discard("user-2")
+            with mock.patch.object(presence, "refresh_many", wraps=presence.refresh_many) as refresh_many:
+                await writer.flush()
+            writer._flush_task.cancel()
+            return refresh_many
+
+        refresh_many = async_to_sync(run)()
+        refresh_many.assert_called_once_with({"user-1"})
+        self.assertTrue(presence.is_online("user-1"))
+        self.assertFalse(presence.is_online("user-2"))
+
+    def test_looks_up_presence_of_many_users(self):
+        presence.set_online("user-1")
+        presence.set_offline("user-2")
+
+        users = {user["user_id"]: user for user in presence.get_presence_many(["user-1", "user-2", "user-3"])}
+        self.assertTrue(users["user-1"]["is_online"])
+        self.assertFalse(users["user-2"]["is_online"])
+        self.assertIsNotNone(users["user-2"]["last_seen"])
+        self.assertEqual(users["user-3"], {"user_id": "user-3", "is_online": False, "last_seen": None})
+
+
+class PresenceWatchTestCase(SimpleTestCase):
+    A, B, C = (str(uuid.UUID(int=n)) for n in (1, 2, 3))
+
+    def setUp(self):
+        self.consumer = AppConsumer()
+        self.consumer.scope = {"user": SimpleNamespace(id="me")}
+        self.consumer.channel_layer = InMemoryChannelLayer()
+        self.consumer.channel_name = "chan"
+        self.consumer.send = mock.AsyncMock()
+        self.consumer.db_services = mock.Mock(redis_get_users_presence=mock.AsyncMock(return_value=[]))
+        self.module = PresenceModule(self.consumer)
+
+    def test_watch_replaces_the_watched_groups(self):
+        async_to_sync(self.module.ACTION_watch)(payload={"user_ids": [self.A, self.B]})
+        async_to_sync(self.module.ACTION_watch)(payload={"user_ids": [self.B, self.C.upper()]})
+
+        self.assertEqual(self.module.watching, {self.B, self.C})
+        self.assertEqual(set(self.consumer.channel_layer.groups), {presence_group(self.B), presence_group(self.C)})
+        self.consumer.db_services.redis_get_users_presence.assert_awaited_with([self.C])
+
+    def test_unwatch_everyone(self):
+        async_to_sync(self.module.ACTION_watch)(payload={"user_ids": [self.A, self.B]})
+        async_to_sync(self.module.ACTION_unwatch)(payload={})
+
+        self.assertEqual(self.module.watching, set())
+        self.assertEqual(self.consumer.channel_layer.groups, {})
+
+    def test_rejects_user_ids_that_are_not_ids(self):
+        too_many = [str(uuid.uuid4()) for _ in range(MAX_PRESENCE_WATCH + 1)]
+        for user_ids in ("a", ["a"], [1], ["a" * 200], [["a"]], [{"id": "a"}], [None], [True], too_many):
+            self.consumer.send.reset_mock()
+            async_to_sync(self.module.ACTION_watch)(payload={"user_ids": user_ids})
+            async_to_sync(self.module.ACTION_unwatch)(payload={"user_ids": user_ids})
+
+            codes = [json.loads(call.kwargs["text_data"])["code"] for call in self.consumer.send.await_args_list]
+            self.assertEqual(codes, [ERR.INVALID_INPUT, ERR.INVALID_INPUT])
+        self.assertEqual(self.module.watching, set())
+        self.assertEqual(self.consumer.channel_layer.groups, {})
+
+    def test_watch_list_only_changes_once_the_groups_did(self):
+        async_to_sync(self.module.ACTION_watch)(payload={"user_ids": [self.A]})
+
+        with mock.patch.object(self.consumer.channel_layer, "group_add", side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                async_to_sync(self.module.ACTION_watch)(payload={"user_ids": [self.B]})
+
+        self.assertEqual(self.module.watching, {self.A})
+
+
+class TypingCoalescerTestCase(SimpleTestCase):
+    def test_coalesces_and_expires_typing_state(self):
+        layer = InMemoryChannelLayer()
+        coalescer = TypingCoalescer(interval=0.01, ttl=0.05)
+
+        async def run():
+            await layer.group_add("group_1", "chan")
+            for _ in range(10):
+                coalescer.touch("group_1", "user-1", True, context={"group_id": 1})
+            coalescer.touch("group_1", "user-2", True, context={"group_id": 1})
+            first = await asyncio.wait_for(layer.receive("chan"), 1)
+
+            coalescer.touch("group_1", "user-2", False, context={"group_id": 1})
+            second = await asyncio.wait_for(layer.receive("chan"), 1)
+
+            # user-1 goes quiet and expires on its own
+            while coalescer._typing:
+                await asyncio.sleep(0.01)
+            messages = [second]
+            while "chan" in layer.channels:
+                messages.append(await layer.receive("chan"))
+            return first, messages
+
+        with mock.patch("src.chats.typing.get_channel_layer", return_value=layer):
+            first, messages = async_to_sync(run)()
+
+        first = JSON_CODEC.decode(first["frames"]["json"])["payload"]
+        second, last = [JSON_CODEC.decode(m["frames"]["json"])["payload"] for m in (messages[0], messages[-1])]
+        self.assertEqual(sorted(first["typing_user_ids"]), ["user-1", "user-2"])
+        self.assertEqual(first["group_id"], 1)
+        self.assertEqual(second["stopped_user_ids"], ["user-2"])
+        self.assertEqual(last["typing_user_ids"], [])
+        self.assertEqual(last["stopped_user_ids"], ["user-1"])
+
+
+class EncodeOnceBroadcastTestCase(SimpleTestCase):
+    def setUp(self):
+        self.consumer = AppConsumer()
+        self.consumer.channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        self.consumer.sender_envelope = {"id": "me"}
+        self.consumer.send = mock.AsyncMock()
+
+    def test_sender_encodes_the_frame_once_per_codec(self):
+        with mock.patch.object(JSON_CODEC, "encode", wraps=JSON_CODEC.encode) as encode:
+            async_to_sync(self.consumer.send_group)("group_1", {"a": 1}, BroadCastAction.SEND_MESSAGE)
+        encode.assert_called_once()
+
+        event = self.consumer.channel_layer.group_send.call_args.args[1]
+        self.assertEqual(JSON_CODEC.decode(event["frames"]["json"])["sender"], {"id": "me"})
+        self.assertEqual(MSGPACK_CODEC.decode(event["frames"]["msgpack"])["payload"], {"a": 1})
+
+    def test_recipient_forwards_the_frame_for_its_codec(self):
+        event = {"type": "group_broadcast_dispatch", "frames": {"json": "{}", "msgpack": b"\x80"}}
+
+        async def dispatch():
+            await self.consumer.group_broadcast_dispatch(event)
+            await self.consumer.outbound.join()
+
+        self.consumer.codec = MSGPACK_CODEC
+        async_to_sync(dispatch)()
+        self.consumer.send.assert_awaited_with(bytes_data=b"\x80")
+
+        self.consumer.codec = JSON_CODEC
+        async_to_sync(dispatch)()
+        self.consumer.send.assert_awaited_with(text_data="{}")
+
+
+class MessageWriteBehindTestCase(SimpleTestCase):
+    def setUp(self):
+        self.writer = MessageWriteBehind(flush_interval=1, batch_size=2)
+        self.journal = [
+            json.dumps({
+                "id": f"00000000-0000-0000-0000-00000000000{seq}",
+                "chatroom_id": "00000000-0000-0000-0000-0000000000aa",
+                "sender_id": "00000000-0000-0000-0000-0000000000bb",
+                "content": "hi",
+                "seq": seq,
+                "created_at": "2025-10-01T10:00:00+00:00",
+            })
+            for seq in (1, 2, 3)
+        ]
+
+    def patch_flush(self, stored=(), rooms=("00000000-0000-0000-0000-0000000000aa",)):
+        """Patch the journal and the queries of a flush. Returns the Redis connection and both bulk_create mocks"""
+        patches = {
+            "get_redis_connection": mock.patch("src.chats.persistence.get_redis_connection"),
+            "cache": mock.patch("src.chats.persistence.cache"),
+            "atomic": mock.patch("src.chats.persistence.transaction.atomic"),
+            "messages": mock.patch("src.chats.persistence.Message.objects"),
+            "changes": mock.patch("src.chats.persistence.ChatChange.objects"),
+            "rooms": mock.patch("src.chats.persistence.ChatRoom.objects"),
+            "users": mock.patch("src.chats.persistence.User.objects"),
+        }
+        mocks = {name: patcher.start() for name, patcher in patches.items()}
+        for patcher in patches.values():
+            self.addCleanup(patcher.stop)
+
+        connection = mocks["get_redis_connection"].return_value
+        connection.lrange.side_effect = lambda key, start, end: self.journal[start:end + 1]
+        mocks["cache"].lock.return_value.acquire.return_value = True
+        mocks["messages"].filter.return_value.values_list.return_value = list(stored)
+        mocks["rooms"].filter.return_value.values_list.return_value = list(rooms)
+        mocks["users"].filter.return_value.values_list.return_value = ["00000000-0000-0000-0000-0000000000bb"]
+        return connection, mocks["messages"].bulk_create, mocks["changes"].bulk_create
+
+    def test_flush_inserts_one_batch_then_trims_it(self):
+        connection, bulk_create, bulk_log = self.patch_flush()
+
+        self.assertEqual(self.writer.flush(), 2)
+
+        messages = bulk_create.call_args.args[0]
+        self.assertEqual([message.seq for message in messages], [1, 2])
+        self.assertTrue(bulk_create.call_args.kwargs["ignore_conflicts"])
+        self.assertEqual(len(bulk_log.call_args.args[0]), 2)
+        connection.pipeline.return_value.ltrim.assert_called_once_with(mock.ANY, 2, -1)
+        connection.pipeline.return_value.rpush.assert_not_called()
+
+    def test_replayed_batch_skips_stored_messages_and_their_sync_log(self):
+        # a worker died between the commit and the trim of message 1
+        connection, bulk_create, bulk_log = self.patch_flush(stored=[uuid.UUID(int=1)])
+
+        self.assertEqual(self.writer.flush(), 2)
+
+        self.assertEqual([message.seq for message in bulk_create.call_args.args[0]], [2])
+        self.assertEqual([change.data["seq"] for change in bulk_log.call_args.args[0]], [2])
+
+    def test_messages_that_cant_be_stored_are_dead_lettered(self):
+        self.journal[0] = "not json"
+        self.journal[1] = self.journal[1].replace("0000000000aa", "0000000000cc")  # room deleted
+        connection, bulk_create, bulk_log = self.patch_flush()
+        self.writer.batch_size = 3
+
+        self.assertEqual(self.writer.flush(), 3)
+
+        self.assertEqual([message.seq for message in bulk_create.call_args.args[0]], [3])
+        pipe = connection.pipeline.return_value
+        pipe.rpush.assert_called_once_with(mock.ANY, "not json", self.journal[1])
+        pipe.ltrim.assert_called_once_with(mock.ANY, 3, -1)
+
+    def test_failing_batch_is_retried_one_message_at_a_time(self):
+        connection, bulk_create, bulk_log = self.patch_flush()
+        # the batch fails, then message 1 on its own
+        bulk_create.side_effect = [IntegrityError, IntegrityError, None]
+
+        self.assertEqual(self.writer.flush(), 2)
+
+        self.assertEqual([[message.seq for message in call.args[0]] for call in bulk_create.call_args_list], [
+            [1, 2], [1], [2],
+        ])
+        connection.pipeline.return_value.rpush.assert_called_once_with(mock.ANY, self.journal[0])
+
+    @mock.patch("src.chats.persistence.Message.objects.bulk_create")
+    @mock.patch("src.chats.persistence.cache")
+    @mock.patch("src.chats.persistence.get_redis_connection")
+    def test_flush_skips_while_another_worker_holds_the_lock(self, get_connection, cache, bulk_create):
+        cache.lock.return_value.acquire.return_value = False
+
+        self.assertEqual(self.writer.flush(), 0)
+        bulk_create.assert_not_called()
+        get_connection.return_value.ltrim.assert_not_called()
+
+
+class ChatHistoryTestCase(SimpleTestCase):
+    def test_cursor_round_trip(self):
+        message = SimpleNamespace(
+            created_at=datetime(2025, 10, 1, 10, 0, 0, 123456, tzinfo=dt_timezone.utc), id=uuid.uuid4()
+        )
+        cursor = ChatHistoryService.encode_cursor(message)
+        self.assertEqual(ChatHistoryService.decode_cursor(cursor), (message.created_at, message.id))
+
+    def test_rejects_garbage_cursor(self):
+        for cursor in ("not-base64!", "aGVsbG8=", ""):
+            with self.assertRaises(InvalidCursor):
+                ChatHistoryService.decode_cursor(cursor)
+
+    @mock.patch("src.chats.services.ChatRoomRoles.get_role", return_value=None)
+    def test_history_requires_membership(self, get_role):
+        consumer = AppConsumer()
+        consumer.scope = {"user": SimpleNamespace(id="me")}
+        consumer.send = mock.AsyncMock()
+        module = GroupChatModule(consumer)
+
+        async_to_sync(module.ACTION_history)(payload={"group_id": "room"})
+
+        frame = json.loads(consumer.send.call_args.kwargs["text_data"])
+        self.assertEqual(frame["code"], ERR.UNAUTHORIZED)
+        get_role.assert_called_once_with("room", "me")
+
+
+class ReadWatermarkTestCase(SimpleTestCase):
+    def test_burst_of_reads_is_one_update_per_participant(self):
+        writer = ReadWatermarkWriter(flush_interval=60)
+
+        async def run():
+            moved = [writer.advance("room", "me", seq) for seq in (3, 5, 4, 5)]
+            writer._flush_task.cancel()
+            return moved
+
+        self.assertEqual(async_to_sync(run)(), [True, True, False, False])
+
+        with mock.patch("src.chats.read_receipts.ChatParticipant.objects") as objects, \
+                mock.patch("src.chats.read_receipts.transaction.atomic"):
+            writer.flush(writer._pending)
+
+        objects.filter.assert_called_once_with(chatroom_id="room", user_id="me", last_read_seq__lt=5)
+        self.assertEqual(objects.filter.return_value.update.call_args.kwargs["last_read_seq"], 5)
+
+    def test_flushed_watermarks_still_dedupe_and_failed_flushes_are_retried(self):
+        writer = ReadWatermarkWriter(flush_interval=0.01)
+        flushed = []
+
+        def flush(pending):
+            if not flushed:
+                flushed.append(None)
+                raise ConnectionError
+            flushed.append(dict(pending))
+
+        async def run():
+            writer.advance("room", "me", 5)
+            await asyncio.sleep(0.015)  # first flush fails
+            writer.advance("room", "me", 3)
+            writer.advance("room", "you", 2)
+            await writer._flush_task
+            moved = writer.advance("room", "me", 5), writer.advance("room", "me", 6)
+            writer._flush_task.cancel()
+            return moved
+
+        with mock.patch.object(writer, "flush", side_effect=flush):
+            self.assertEqual(async_to_sync(run)(), (False, True))
+
+        self.assertEqual([sorted((key, seq) for key, (seq, _) in batch.items()) for batch in flushed[1:]], [
+            [(("room", "me"), 5), (("room", "you"), 2)],
+        ])
+        self.assertEqual(writer.get("room", "you"), 2)
+
+    @mock.patch.object(ChatMessageService, "current_seq", return_value=40)
+    def test_read_seq_must_be_a_non_negative_int_up_to_the_room_seq(self, current_seq):
+        for seq in ("5", -1, True, 1.5, [5]):
+            self.assertIsNone(resolve_read_seq("room", {"seq": seq}), seq)
+        self.assertEqual(resolve_read_seq("room", {"seq": 12}), 12)
+        self.assertEqual(resolve_read_seq("room", {"seq": 99999999999999999999999}), 40)
+
+    def test_rejected_watermarks_are_dropped_alone(self):
+        writer = ReadWatermarkWriter(flush_interval=60)
+        written = []
+
+        def write(watermarks):
+            watermarks = list(watermarks)
+            if any(key == ("room", "bad") for key, _ in watermarks):
+                raise DataError("bigint out of range")
+            written.extend(key for key, _ in watermarks)
+
+        pending = {("room", "me"): (3, None), ("room", "bad"): (4, None), ("room", "you"): (5, None)}
+        with mock.patch.object(writer, "_write", side_effect=write):
+            writer.flush(pending)
+
+        self.assertEqual(written, [("room", "me"), ("room", "you")])
+
+    def test_failing_flushes_are_retried_a_bounded_number_of_times(self):
+        writer = ReadWatermarkWriter(flush_interval=0.001, max_retries=2)
+
+        async def run():
+            writer.advance("room", "me", 5)
+            await writer._flush_task
+
+        with mock.patch.object(writer, "flush", side_effect=OperationalError) as flush:
+            async_to_sync(run)()
+
+        self.assertEqual(flush.call_count, 3)
+        self.assertIsNone(writer.get("room", "me"))
+
+
+class UnreadCountersTestCase(SimpleTestCase):
+    @mock.patch("src.chats.services.get_redis_connection")
+    def test_counts_come_from_one_hgetall(self, get_connection):
+        get_connection.return_value.hgetall.return_value = {b"-": b"0", b"room-1": b"3", b"room-2": b"0"}
+
+        self.assertEqual(UnreadCounters.get_counts("me"), {"room-1": 3, "room-2": 0})
+        get_connection.return_value.hgetall.assert_called_once()
+
+    @mock.patch.object(UnreadCounters, "rebuild", return_value={})
+    @mock.patch("src.chats.services.get_redis_connection")
+    def test_missing_hash_is_rebuilt(self, get_connection, rebuild):
+        get_connection.return_value.hgetall.return_value = {}
+
+        UnreadCounters.get_counts("me")
+        rebuild.assert_called_once_with("me")
+
+    @mock.patch.object(UnreadCounters, "_recount")
+    @mock.patch("src.chats.services.get_redis_connection")
+    def test_reset_recounts_when_messages_came_after_the_read_seq(self, get_connection, recount):
+        pipe = get_connection.return_value.pipeline.return_value
+        for stale, recounted in ((0, False), (1, True)):
+            pipe.execute.return_value = [1, True, stale]
+            UnreadCounters.reset("room", "me", 7)
+            self.assertEqual(recount.called, recounted)
+
+        args = pipe.eval.call_args.args
+        self.assertEqual(
+            args[2:5], (UnreadCounters._key("me"), UnreadCounters._read_key("me"), ChatMessageService._seq_key("room"))
+        )
+        self.assertEqual(args[5:7], ("room", 7))
+        recount.assert_called_once_with("room", "me")
+
+    @mock.patch.object(UnreadCounters, "_fill")
+    @mock.patch.object(UnreadCounters, "_count_journaled", return_value={"room-2": 1})
+    @mock.patch.object(UnreadCounters, "_count_stored", return_value={"room-1": 0})
+    @mock.patch.object(UnreadCounters, "_read_seqs", return_value={"room-1": 9, "room-2": 1})
+    @mock.patch.object(UnreadCounters, "_read_version", return_value="3")
+    @mock.patch("src.chats.services.ChatParticipant.objects")
+    def test_rebuild_counts_unflushed_reads_and_journaled_messages(self, objects, *_):
+        objects.filter.return_value.annotate.return_value.values_list.return_value = [("room-1", 5, 4), ("room-2", 2, 0)]
+
+        self.assertEqual(UnreadCounters.rebuild("me"), {"room-1": 0, "room-2": 1})
+
+        UnreadCounters._count_stored.assert_called_once_with("me", {"room-1": 9})  # read up to 9, Postgres says 5
+        UnreadCounters._count_journaled.assert_called_once_with("me", {"room-1": 9, "room-2": 2})
+        UnreadCounters._fill.assert_called_once_with("me", "3", {"room-1": 0, "room-2": 1})
+
+
+class ChatChangeLogTestCase(SimpleTestCase):
+    @mock.patch("src.chats.services.transaction.atomic")
+    @mock.patch("src.chats.services.ChatChange.objects")
+    @mock.patch("src.chats.services.cache")
+    def test_committed_changes_are_numbered_after_the_head(self, cache, objects, atomic):
+        cache.lock.return_value.acquire.return_value = True
+        objects.filter.return_value.order_by.return_value.values_list.return_value = [7, 9]  # ids without a seq
+        objects.aggregate.return_value = {"seq__max": 10}
+
+        self.assertEqual(ChatChangeLog.sequence(), 2)
+
+        numbered = objects.bulk_update.call_args.args[0]
+        self.assertEqual([(change.id, change.seq) for change in numbered], [(7, 11), (9, 12)])
+        objects.filter.assert_called_once_with(seq__isnull=True)
+        cache.lock.return_value.release.assert_called_once()
+
+    @mock.patch("src.chats.services.ChatChange.objects")
+    @mock.patch("src.chats.services.cache")
+    def test_one_worker_numbers_at_a_time(self, cache, objects):
+        cache.lock.return_value.acquire.return_value = False
+
+        self.assertEqual(ChatChangeLog.sequence(), 0)
+        objects.bulk_update.assert_not_called()
+
+    @mock.patch("src.chats.services.ChatChangeLog.changes_query", return_value=[])
+    @mock.patch("src.chats.services.ChatMembershipIndex.get_room_ids", return_value=["room"])
+    @mock.patch("src.chats.services.ChatChangeLog.sequence")
+    def test_changes_are_numbered_before_they_are_read(self, sequence, get_room_ids, changes_query):
+        sequence.side_effect = lambda: changes_query.assert_not_called()
+
+        ChatChangeLog.get_changes("me", 10, 50)
+
+        sequence.assert_called_once_with()
+        changes_query.assert_called_once_with(["room"], "me", 10, 50)
+
+    @mock.patch.object(ChatChangeLog, "PRUNE_BATCH_SIZE", 2)
+    @mock.patch("src.chats.services.ChatChangeLog.head", return_value=10)
+    @mock.patch("src.chats.services.ChatChange.objects")
+    def test_prune_deletes_the_expired_seq_prefix_and_keeps_the_head(self, objects, head):
+        expired, kept = datetime(2020, 1, 1, tzinfo=dt_timezone.utc), datetime(2100, 1, 1, tzinfo=dt_timezone.utc)
+        oldest = objects.filter.return_value.order_by.return_value.values_list.return_value.__getitem__
+        oldest.side_effect = [[(1, expired), (2, expired)], [(3, expired), (4, kept)]]
+        objects.filter.return_value.delete.side_effect = [(2, {}), (1, {})]
+
+        self.assertEqual(ChatChangeLog.prune(60), 3)
+
+        self.assertIn(mock.call(seq__lt=10), objects.filter.call_args_list)
+        self.assertEqual(
+            [call for call in objects.filter.call_args_list if "seq__lte" in call.kwargs],
+            [mock.call(seq__lte=2), mock.call(seq__lte=3)],
+        )
+
+    @mock.patch("src.chats.services.ChatChangeLog.floor_query")
+    def test_floor_is_the_cursor_before_the_oldest_change(self, floor_query):
+        floor_query.return_value.first.return_value = 42
+        self.assertEqual(ChatChangeLog.floor(), 41)
+
+        floor_query.return_value.first.return_value = None
+        self.assertEqual(ChatChangeLog.floor(), 0)
+
+    @mock.patch("src.chats.signals.ChatChangeLog.record")
+    def test_only_synced_notification_types_are_logged(self, record):
+        notification = SimpleNamespace(
+            id=1, user_id="me", type="system", title="", message="", is_read=False, created_at=None
+        )
+        log_notification_saved(None, notification)
+        log_notification_deleted(None, notification)
+        record.assert_not_called()
+
+        notification.type = "chat"
+        log_notification_saved(None, notification)
+        log_notification_deleted(None, notification)
+        self.assertEqual(record.call_count, 2)
+
+
+@override_settings(CHAT_SYNC_CHUNK_SIZE=2, CHAT_SYNC_MAX_CHUNKS=10)
+class DeltaSyncTestCase(SimpleTestCase):
+    def setUp(self):
+        self.consumer = AppConsumer()
+        self.consumer.scope = {"user": SimpleNamespace(id="me")}
+        self.consumer.send = mock.AsyncMock()
+        self.module = SyncModule(self.consumer)
+        self.module._current_action = "WS:SYNC:REQUEST_SYNC"
+        single_flights._memo.clear()  # the head and floor are kept for CHAT_SINGLE_FLIGHT_TTL
+
+    def sent_frames(self):
+        return [json.loads(call.kwargs["text_data"])["data"] for call in self.consumer.send.call_args_list]
+
+    @mock.patch("src.chats.services.ChatChangeLog.floor", return_value=0)
+    @mock.patch("src.chats.services.ChatChangeLog.get_changes")
+    def test_streams_changes_after_cursor_in_chunks(self, get_changes, floor):
+        log = [{"seq": seq} for seq in (11, 12, 13)]
+        get_changes.side_effect = lambda user_id, after, limit: [c for c in log if c["seq"] > after][:limit]
+
+        async_to_sync(self.module.ACTION_request_sync)(payload={"cursor": 10})
+
+        self.assertEqual(
+            [(frame["cursor"], frame["has_more"]) for frame in self.sent_frames()],
+            [(12, True), (13, False)],
+        )
+
+    @mock.patch("src.chats.services.UnreadCounters.get_counts", return_value={"room": 2})
+    @mock.patch("src.chats.services.ChatChangeLog.head", return_value=99)
+    def test_client_without_cursor_is_told_to_reset(self, head, get_counts):
+        self.consumer.db_services.user = self.consumer.scope["user"]  # set by connect()
+        async_to_sync(self.module.ACTION_request_sync)(payload={})
+
+        frame = self.sent_frames()[0]
+        self.assertTrue(frame["reset"])
+        self.assertEqual(frame["cursor"], 99)
+        self.assertEqual(frame["unread_counts"], {"room": 2})
+        get_counts.assert_called_once_with("me")
+
+    @mock.patch("src.chats.services.UnreadCounters.get_counts", return_value={"room": 2})
+    @mock.patch("src.chats.services.ChatChangeLog.get_changes")
+    @mock.patch("src.chats.services.ChatChangeLog.floor", return_value=50)
+    @mock.patch("src.chats.services.ChatChangeLog.head", return_value=99)
+    def test_cursor_older_than_the_log_is_told_to_reset(self, head, floor, get_changes, get_counts):
+        self.consumer.db_services.user = self.consumer.scope["user"]
+        async_to_sync(self.module.ACTION_request_sync)(payload={"cursor": 49})
+
+        frame = self.sent_frames()[0]
+        self.assertTrue(frame["reset"])
+        self.assertEqual(frame["cursor"], 99)
+        get_changes.assert_not_called()
+
+
+class HeartbeatSchedulerTestCase(SimpleTestCase):
+    def test_pings_in_batches_and_closes_dead_sockets(self):
+        scheduler = HeartbeatScheduler(interval=0.04, slots=4, max_missed=2)
+        live, dead = mock.Mock(), mock.Mock()
+        live.send_ping = mock.AsyncMock(side_effect=lambda: scheduler.alive(live))
+        dead.send_ping = mock.AsyncMock()
+        live.close, dead.close = mock.AsyncMock(), mock.AsyncMock()
+
+        async def run():
+            scheduler.register(live)
+            scheduler.register(dead)
+            await asyncio.sleep(0.15)
+            scheduler.unregister(live)
+            await scheduler._task
+
+        async_to_sync(run)()
+
+        self.assertGreaterEqual(live.send_ping.await_count, 2)
+        live.close.assert_not_awaited()
+        self.assertEqual(dead.send_ping.await_count, 2)
+        dead.close.assert_awaited_once_with(code=CLOSE_CODE_HEARTBEAT_TIMEOUT)
+        self.assertEqual(len(scheduler), 0)
+
+
+class OutboundQueueTestCase(SimpleTestCase):
+    def setUp(self):
+        self.consumer = mock.Mock(close=mock.AsyncMock())
+        self.sent = []
+        self.unblock = None
+
+        async def send_frame(frame):
+            self.sent.append(frame)
+            await self.unblock.wait()  # a client that stopped reading
+
+        self.consumer.send_frame = send_frame
+        self.queue = OutboundQueue(self.consumer, max_size=2)
+
+    def test_drops_ephemeral_frames_first_then_disconnects(self):
+        async def run():
+            self.unblock = asyncio.Event()
+            self.queue.put("m1")
+            await asyncio.sleep(0)  # m1 is now stuck in send_frame
+            self.queue.put("typing-1", ephemeral=True)
+            self.queue.put("m2")
+            self.queue.put("typing-2", ephemeral=True)  # full: dropped
+            self.assertEqual(self.queue.dropped, 1)
+
+            self.queue.put("m3")  # full: evicts typing-1
+            self.assertEqual(self.queue.dropped, 2)
+            self.assertEqual([frame for frame, _ in self.queue._frames], ["m2", "m3"])
+
+            self.queue.put("m4")  # full, nothing ephemeral left
+            await asyncio.sleep(0)
+
+        async_to_sync(run)()
+
+        self.assertTrue(self.queue.closed)
+        self.assertEqual(self.queue.depth, 0)
+        self.consumer.close.assert_awaited_once_with(code=CLOSE_CODE_SLOW_CONSUMER)
+
+    def test_daphne_write_buffer_holds_frames_in_the_queue(self):
+        class Socket(abstract.FileDescriptor):
+            """A Twisted transport whose peer reads nothing until `draining`"""
+            connected = True
+            draining = False
+
+            def writeSomeData(self, data):
+                return len(data) if self.draining else 0
+
+            def startWriting(self):
+                pass
+
+            def stopWriting(self):
+                pass
+
+        transport = Socket(reactor=mock.Mock())
+        protocol = mock.Mock(transport=transport)
+
+        async def handle_reply(protocol, message):
+            # daphne's send returns at once, the frame only lands in the transport's buffer
+            protocol.transport.write(message["text"].encode())
+
+        self.consumer.base_send = functools.partial(handle_reply, protocol)
+
+        async def send_frame(frame):
+            self.sent.append(frame)
+            await self.consumer.base_send({"type": "websocket.send", "text": frame})
+
+        self.consumer.send_frame = send_frame
+        queue = OutboundQueue(self.consumer, max_size=2, max_buffer=4)
+
+        async def run():
+            queue.put("m1-full")
+            await asyncio.sleep(0)  # m1 sent, the transport buffer is now over max_buffer
+            queue.put("m2")
+            queue.put("m3")
+            await asyncio.sleep(0)
+            self.assertEqual(self.sent, ["m1-full"])
+            self.assertEqual(queue.depth, 2)
+
+            transport.draining = True
+            transport.doWrite()  # the socket drained, the producer resumes
+            await queue.join()
+
+        async_to_sync(run)()
+
+        self.assertEqual(self.sent, ["m1-full", "m2", "m3"])
+        queue.close()
+        self.assertIsNone(transport.producer)
+
+    def test_no_backpressure_without_a_daphne_transport(self):
+        self.consumer.base_send = mock.AsyncMock()  # e.g. uvicorn
+        self.assertIsNone(TransportProducer.register(self.consumer, 4))
+
+        self.consumer.base_send = functools.partial(mock.AsyncMock(), SimpleNamespace(transport=object()))
+        self.assertIsNone(TransportProducer.register(self.consumer, 4))
+
+
+class RateLimitTestCase(SimpleTestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.limiter = ConnectionRateLimiter(
+            {"*": "5/second", "GROUP_CHAT": "3/second", "GROUP_CHAT:SEND_MESSAGE": "1/second"},
+            clock=lambda: self.now,
+        )
+
+    def test_parses_drf_style_rates(self):
+        self.assertEqual(parse_rate("10/second"), (10, 10.0))
+        self.assertEqual(parse_rate("60/min"), (60, 1.0))
+
+    def test_most_specific_rule_applies_and_refills(self):
+        self.assertEqual(self.limiter.check("GROUP_CHAT", "SEND_MESSAGE"), 0)
+        self.assertAlmostEqual(self.limiter.check("GROUP_CHAT", "SEND_MESSAGE"), 1.0)
+        # the module bucket is separate from the action's
+        self.assertEqual(self.limiter.check("GROUP_CHAT", "TYPING"), 0)
+
+        self.now = 1.0
+        self.assertEqual(self.limiter.check("GROUP_CHAT", "SEND_MESSAGE"), 0)
+
+    def test_connection_bucket_covers_every_frame(self):
+        results = [self.limiter.check_frame() for _ in range(6)]
+        self.assertEqual(results[:5], [0] * 5)
+        self.assertGreater(results[5], 0)
+        self.assertEqual(self.limiter.check("PRESENCE", "WATCH"), 0)  # no rule of its own
+
+    @override_settings(CHAT_WS_RATE_LIMITS={"*": "1/minute"})
+    def test_malformed_frames_are_limited_too(self):
+        consumer = AppConsumer()
+        consumer.send = mock.AsyncMock()
+
+        for text_data in ("not json", json.dumps({"action": "WS:NOPE:NOPE"})):
+            async_to_sync(consumer.receive)(text_data=text_data)
+
+        codes = [json.loads(call.kwargs["text_data"])["code"] for call in consumer.send.await_args_list]
+        self.assertEqual(codes, [ERR.INVALID_JSON, ERR.RATE_LIMITED])
+
+    @override_settings(CHAT_WS_RATE_LIMITS={"*": "1/minute"})
+    def test_receive_answers_limited_frames_with_an_error(self):
+        consumer = AppConsumer()
+        consumer.send = mock.AsyncMock()
+        consumer.modules = {"GROUP_CHAT": mock.Mock(spec=GroupChatModule)}
+        handler = mock.AsyncMock()
+        route = ACTION_ROUTES["WS:GROUP_CHAT:TYPING"]._replace(handler=handler)
+        text_data = json.dumps({"action": "WS:GROUP_CHAT:TYPING", "payload": {"text": "héllo"}}, ensure_ascii=False)
+
+        with mock.patch.dict(ACTION_ROUTES, {"WS:GROUP_CHAT:TYPING": route}):
+            async_to_sync(consumer.receive)(text_data=text_data)
+            async_to_sync(consumer.receive)(text_data=text_data)
+
+        handler.assert_awaited_once()
+        self.assertEqual(json.loads(consumer.send.call_args.kwargs["text_data"])["code"], ERR.RATE_LIMITED)
+
+
+class ChatMetricsTestCase(SimpleTestCase):
+    def test_receive_times_the_dispatched_action(self):
+        metrics = ChatMetrics(publish_interval=60)
+        consumer = AppConsumer()
+        consumer.send = mock.AsyncMock()
+        consumer.modules = {"GROUP_CHAT": mock.Mock(spec=GroupChatModule)}
+        route = ACTION_ROUTES["WS:GROUP_CHAT:TYPING"]._replace(handler=mock.AsyncMock(side_effect=[None, KeyError]))
+        text_data = json.dumps({"action": "WS:GROUP_CHAT:TYPING", "payload": {}})
+
+        with mock.patch.dict(ACTION_ROUTES, {"WS:GROUP_CHAT:TYPING": route}), \
+                mock.patch("src.chats.consumers.chat_metrics", metrics):
+            async_to_sync(consumer.receive)(text_data=text_data)
+            async_to_sync(consumer.receive)(text_data=text_data)
+
+        stats = metrics.snapshot()["actions"]["WS:GROUP_CHAT:TYPING"]
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual(stats["errors"], 1)
+        self.assertEqual(metrics.frames_in, 2)
+        self.assertEqual(metrics.bytes_in, 2 * len(text_data.encode()))  # bytes, "é" is two
+        self.assertEqual(metrics.frame_errors[ERR.INTERNAL_ERROR], 1)
+        self.assertEqual(metrics.frames_out, 1)
+
+    def test_frames_out_count_bytes_on_the_wire(self):
+        metrics = ChatMetrics(publish_interval=60)
+        consumer = AppConsumer()
+        consumer.send = mock.AsyncMock()
+
+        with mock.patch("src.chats.consumers.chat_metrics", metrics):
+            async_to_sync(consumer.send_json)({"content": "é ✓"})
+
+        self.assertEqual(metrics.bytes_out, len(consumer.send.call_args.kwargs["text_data"].encode()))
+
+    def test_group_joins_gauge_only_counts_joined_groups(self):
+        metrics = ChatMetrics(publish_interval=60)
+        consumer = AppConsumer()
+        consumer.channel_layer = InMemoryChannelLayer()
+        consumer.channel_name = "chan"
+
+        async def run():
+            await consumer.join_broadcast_groups(["group_1"])
+            await consumer.leave_broadcast_groups(["group_1", "group_2"])  # group_2 was never joined
+            self.assertEqual(metrics.group_joins, 0)
+            await consumer.join_broadcast_group("user_me")
+            await consumer.join_broadcast_groups(["group_5"])
+            consumer._count_joins(-consumer.joined_groups)  # what disconnect() does
+
+        with mock.patch("src.chats.consumers.chat_metrics", metrics):
+            async_to_sync(run)()
+
+        self.assertEqual(metrics.group_joins, 0)
+        self.assertEqual(consumer.joined_groups, 0)
+
+    def test_merges_worker_snapshots(self):
+        workers = [ChatMetrics(publish_interval=60) for _ in range(2)]
+        for worker, latency in zip(workers, (0.003, 0.3)):
+            worker.observe_action("WS:SYNC:REQUEST_SYNC", latency)
+            worker.frame_in(10)
+
+        total = merge_snapshots([worker.snapshot() for worker in workers])
+        stats = total["actions"]["WS:SYNC:REQUEST_SYNC"]
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual((stats["p50_ms"], stats["p99_ms"]), (5, 500))
+        self.assertEqual(total["bytes_in"], 20)
+
+
+class DBExecutorTestCase(SimpleTestCase):
+    def test_runs_calls_in_parallel_and_records_queue_wait(self):
+        metrics = ChatMetrics(publish_interval=60)
+        with mock.patch("src.chats.executor.chat_metrics", metrics):
+            executor = DBExecutor(max_workers=2)
+            # both calls must be running at once to get past the barrier
+            barrier = threading.Barrier(2, timeout=5)
+            call = executor.wrap(lambda value: (barrier.wait(), value)[1])
+
+            async def run():
+                return await asyncio.gather(call(1), call(2))
+
+            self.assertEqual(async_to_sync(run)(), [1, 2])
+
+        self.assertEqual(metrics.db_queue_wait.count, 2)
+        self.assertEqual(metrics.db_waiting, 0)
+        self.assertEqual(metrics.snapshot()["db_executor"]["workers"], 2)
+
+    def test_calls_cancelled_while_queued_stop_counting_as_waiting(self):
+        metrics = ChatMetrics(publish_interval=60)
+        with mock.patch("src.chats.executor.chat_metrics", metrics):
+            executor = DBExecutor(max_workers=1)
+            release = threading.Event()
+            block = executor.wrap(lambda: release.wait(5))
+            queued = executor.wrap(lambda: None)
+
+            async def run():
+                running = asyncio.ensure_future(block())
+                waiting = asyncio.ensure_future(queued())
+                await asyncio.sleep(0.05)
+                self.assertEqual(metrics.db_waiting, 1)
+                waiting.cancel()
+                await asyncio.gather(waiting, return_exceptions=True)
+                waiting_after_cancel = metrics.db_waiting
+                release.set()
+                await running
+                return waiting_after_cancel
+
+            self.assertEqual(async_to_sync(run)(), 0)
+
+        self.assertEqual(metrics.db_waiting, 0)
+        self.assertEqual(metrics.db_queue_wait.count, 1)
+
+
+class AsyncDatabaseServicesTestCase(SimpleTestCase):
+    def setUp(self):
+        self.services = AsyncDatabaseServices(consumer=None)
+        self.pipe = mock.Mock(execute=mock.AsyncMock())
+        self.redis = mock.Mock(pipeline=mock.Mock(return_value=self.pipe), smembers=mock.AsyncMock())
+        patcher = mock.patch("src.chats.async_services.get_async_redis", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_async_reads_are_not_wrapped(self):
+        self.assertIsNot(AsyncDatabaseServices.db_get_room_ids, DatabaseServices.db_get_room_ids)
+        self.assertIs(
+            AsyncDatabaseServices.db_get_room_ids.__wrapped__, AsyncChatReadServiceMixin.db_get_room_ids
+        )
+        # everything else is still the thread version
+        self.assertIs(AsyncDatabaseServices.redis_is_user_online, DatabaseServices.redis_is_user_online)
+
+    def test_room_ids_are_one_redis_round_trip(self):
+        self.redis.smembers.return_value = {b"-", b"room"}
+        self.assertEqual(async_to_sync(self.services.db_get_room_ids)("me"), ["room"])
+        self.redis.smembers.assert_awaited_once_with(ChatMembershipIndex._key("me"))
+
+    @mock.patch("src.chats.services.ChatMembershipIndex.get_room_ids", return_value=["room"])
+    def test_room_ids_miss_rebuilds_the_index(self, get_room_ids):
+        self.redis.smembers.return_value = set()
+
+        self.assertEqual(async_to_sync(self.services.db_get_room_ids)("me"), ["room"])
+        get_room_ids.assert_called_once_with("me")
+
+
+class SingleFlightTestCase(SimpleTestCase):
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.calls = []
+
+    def lookup(self, options=SingleFlightOptions(0, None)):
+        async def lookup(services, user_id):
+            self.calls.append(user_id)
+            await asyncio.sleep(0.01)
+            return [user_id]
+
+        return self.flights.wrap(lookup, options)
+
+    def test_concurrent_identical_calls_share_one_call(self):
+        lookup = self.lookup()
+
+        async def run():
+            return await asyncio.gather(lookup(None, 1), lookup(None, 1), lookup(None, 2))
+
+        self.assertEqual(async_to_sync(run)(), [[1], [1], [2]])
+        self.assertEqual(self.calls, [1, 2])
+        self.assertEqual(self.flights.stats(), {"calls": 2, "shared": 1, "memo_hits": 0, "in_flight": 0})
+
+    def test_results_are_kept_for_ttl(self):
+        lookup = self.lookup(SingleFlightOptions(60, lambda services, user_id: user_id))
+
+        async def run():
+            await lookup(None, 1)
+            return await lookup(None, 1)
+
+        self.assertEqual(async_to_sync(run)(), [1])
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(self.flights.stats()["memo_hits"], 1)
+
+    def test_failures_are_shared_but_not_kept(self):
+        calls = []
+
+        async def lookup(services):
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise ConnectionError
+
+        lookup = self.flights.wrap(lookup, SingleFlightOptions(60, None))
+
+        async def run():
+            return await asyncio.gather(lookup(None), lookup(None), return_exceptions=True)
+
+        for _ in range(2):
+            results = async_to_sync(run)()
+            self.assertTrue(all(isinstance(result, ConnectionError) for result in results))
+        self.assertEqual(len(calls), 2)
+
+    def test_mixed_key_dicts_and_unhashable_arguments(self):
+        lookup = self.lookup()
+
+        async def run():
+            return await asyncio.gather(
+                lookup(None, {1: "a", "b": 2}), lookup(None, {"b": 2, 1: "a"}), lookup(None, bytearray(b"x")),
+            )
+
+        self.assertEqual(async_to_sync(run)(), [[{1: "a", "b": 2}], [{1: "a", "b": 2}], [bytearray(b"x")]])
+        self.assertEqual(len(self.calls), 2)  # the dicts share a call, the bytearray isn't coalesced
+        self.assertEqual(self.flights.stats()["shared"], 1)
+
+
+class ChatRoomRolesTestCase(SimpleTestCase):
+    @mock.patch("src.chats.services.ChatParticipant.objects")
+    @mock.patch("src.chats.services.get_redis_connection")
+    def test_fill_is_conditional_on_the_version_read_before_the_query(self, get_connection, objects):
+        calls = []
+        redis = get_connection.return_value
+        redis.get.side_effect = lambda key: calls.append("version") or b"7"
+        objects.filter.return_value.values_list.side_effect = lambda *fields: calls.append("query") or [("me", "me")]
+
+        self.assertEqual(ChatRoomRoles.rebuild("room"), {"me": ChatRoomRoles.ADMIN})
+
+        self.assertEqual(calls, ["version", "query"])
+        args = redis.eval.call_args.args
+        self.assertEqual(args[2:5], (ChatRoomRoles._key("room"), ChatRoomRoles._version_key("room"), "7"))
+        self.assertEqual(args[-2:], ("me", ChatRoomRoles.ADMIN))
+
+    @mock.patch("src.chats.services.get_redis_connection")
+    def test_forget_bumps_the_version(self, get_connection):
+        ChatRoomRoles.forget("room")
+
+        pipe = get_connection.return_value.pipeline.return_value
+        pipe.incr.assert_called_once_with(ChatRoomRoles._version_key("room"))
+        pipe.delete.assert_called_once_with(ChatRoomRoles._key("room"))
+        pipe.execute.assert_called_once()
+
+
+@mock.patch("src.chats.services.ChatRoomRoles.get_role")
+class MembershipRoleCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.roles = MembershipRoleCache(max_size=2, ttl=60)
+        self.layer = InMemoryChannelLayer()
+
+    def run_listening(self, run):
+        async def listening():
+            self.roles.register(self.layer)
+            await asyncio.sleep(0.01)  # joins MEMBERSHIP_CHANGES_GROUP
+            try:
+                return await run()
+            finally:
+                self.roles.unregister()
+
+        return async_to_sync(listening)()
+
+    def test_roles_are_cached_until_a_change_is_published(self, get_role):
+        get_role.return_value = ChatRoomRoles.ADMIN
+
+        async def run():
+            checks = [await self.roles.is_member("room", "me"), await self.roles.is_admin("room", "me")]
+            await self.layer.group_send(
+                MEMBERSHIP_CHANGES_GROUP, {"type": "membership.changed", "room_id": "room", "user_id": "me"}
+            )
+            await asyncio.sleep(0.01)
+            get_role.return_value = None
+            return checks + [await self.roles.is_member("room", "me")]
+
+        self.assertEqual(self.run_listening(run), [True, True, False])
+        self.assertEqual(get_role.call_count, 2)
+
+    def test_least_recently_used_pairs_are_evicted(self, get_role):
+        get_role.return_value = ChatRoomRoles.MEMBER
+
+        async def run():
+            for room_id in ("a", "b", "a", "c"):
+                await self.roles.get_role(room_id, "me")
+            return list(self.roles._roles)
+
+        self.assertEqual(self.run_listening(run), [("a", "me"), ("c", "me")])
+
+    def test_reconnect_during_shutdown_restarts_the_listener(self, get_role):
+        get_role.return_value = ChatRoomRoles.MEMBER
+
+        async def run():
+            self.roles.register(self.layer)
+            await asyncio.sleep(0.01)
+            self.roles.unregister()
+            self.roles.register(self.layer)  # before the old listener saw its cancellation
+            await asyncio.sleep(0.01)
+            listening = self.roles._listening
+            await self.roles.get_role("room", "me")
+            self.roles.unregister()
+            return listening
+
+        self.assertTrue(async_to_sync(run)())
+        self.assertEqual(get_role.call_count, 1)
+
+    def test_nothing_is_cached_without_a_listener(self, get_role):
+        get_role.return_value = ChatRoomRoles.MEMBER
+
+        async def run():
+            return [await self.roles.is_member("room", "me") for _ in range(2)]
+
+        self.assertEqual(async_to_sync(run)(), [True, True])
+        self.assertEqual(get_role.call_count, 2)
+
+
+class OfflineNotifierTestCase(SimpleTestCase):
+    @staticmethod
+    def store(notifications, conflicts=()):
+        """bulk_create stores the notifications, but the `conflicts` ids were stored by another flush first"""
+        rows = {}
+
+        def bulk_create(created, ignore_conflicts=False):
+            for notification in created:
+                rows[notification.id] = "earlier" if notification.id in conflicts else notification.created_at
+
+        notifications.bulk_create.side_effect = bulk_create
+        notifications.filter.return_value.values_list.side_effect = lambda *fields: list(rows.items())
+
+    def test_messages_are_grouped_per_recipient_and_room(self):
+        events = [
+            MessageEvent("room", "a", "hi", None),
+            MessageEvent("room", "b", "hello", None),
+            MessageEvent("dm", "a", "psst", ("c",)),
+        ]
+
+        self.assertEqual(group_events(events, {"room": ["a", "b", "c"]}), {
+            ("b", "room"): (1, "hi"),
+            ("a", "room"): (1, "hello"),
+            ("c", "room"): (2, "hello"),
+            ("c", "dm"): (1, "psst"),
+        })
+
+    @mock.patch("src.chats.notifications.deliver_chat_notifications")
+    @mock.patch("src.chats.notifications.transaction")
+    @mock.patch("src.chats.notifications.ChatChange")
+    @mock.patch("src.chats.notifications.Notification.objects")
+    @mock.patch("src.chats.notifications.cache")
+    @mock.patch("src.chats.notifications.get_presence_many")
+    @mock.patch("src.chats.notifications.ChatParticipant")
+    def test_offline_members_get_one_notification_per_room(
+        self, participants, presence, cache, notifications, changes, transaction, deliver
+    ):
+        notifier = OfflineNotifier(flush_interval=1, merge_window=60)
+        participants.objects.filter.return_value.values_list.return_value = [
+            ("room", "sender"), ("room", "online"), ("room", "away"), ("room", "merged"),
+        ]
+        presence.return_value = [
+            {"user_id": user_id, "is_online": user_id == "online"} for user_id in ("online", "away", "merged")
+        ]
+        open_key = notifier._merge_key("merged", "room")
+        open_id = uuid.uuid4()
+        cache.get_many.return_value = {open_key: {"id": str(open_id), "count": 3, "created_at": None}}
+        cache.lock.return_value.acquire.return_value = True
+        notifications.select_for_update.return_value.filter.return_value.values_list.return_value = [open_id]
+        self.store(notifications)
+
+        notified = notifier.flush([MessageEvent("room", "sender", f"message {i}", None) for i in range(2)])
+
+        self.assertEqual(notified, 2)
+        created = list(notifications.bulk_create.call_args.args[0])
+        self.assertEqual([(str(n.user_id), n.message) for n in created], [("away", "2 new messages")])
+        self.assertTrue(notifications.bulk_create.call_args.kwargs["ignore_conflicts"])
+        updated = notifications.bulk_update.call_args.args[0]
+        self.assertEqual([n.message for n in updated], ["5 new messages"])
+        self.assertEqual(notifications.bulk_update.call_args.args[1], ["message"])
+        self.assertEqual(cache.set_many.call_args.args[0][open_key]["count"], 5)
+        deliver.delay.assert_called_once_with(
+            [{"user_id": "away", "notifications": [{"title": "New message", "message": "2 new messages"}]}]
+        )
+        cache.lock.return_value.release.assert_called_once()
+
+    @mock.patch("src.chats.notifications.deliver_chat_notifications")
+    @mock.patch("src.chats.notifications.transaction")
+    @mock.patch("src.chats.notifications.ChatChange")
+    @mock.patch("src.chats.notifications.Notification.objects")
+    @mock.patch("src.chats.notifications.cache")
+    @mock.patch("src.chats.notifications.get_presence_many", return_value=[{"user_id": "away", "is_online": False}])
+    def test_read_or_deleted_notifications_are_not_merged_into(
+        self, presence, cache, notifications, changes, transaction, deliver
+    ):
+        notifier = OfflineNotifier(flush_interval=1, merge_window=60)
+        state = {"id": str(uuid.uuid4()), "count": 3, "created_at": None}
+        cache.get_many.return_value = {notifier._merge_key("away", "dm"): state}
+        cache.lock.return_value.acquire.return_value = True
+        notifications.select_for_update.return_value.filter.return_value.values_list.return_value = []  # read
+        self.store(notifications)
+
+        notifier.flush([MessageEvent("dm", "sender", "hi", ("away",))])
+
+        created = list(notifications.bulk_create.call_args.args[0])
+        self.assertEqual([(n.id, n.message) for n in created], [(notifier._notification_id("away", "dm", state), "hi")])
+        self.assertEqual(notifications.bulk_update.call_args.args[0], [])
+        # flushes that read the same state create the same row
+        self.assertEqual(notifier._notification_id("away", "dm", state), notifier._notification_id("away", "dm", state))
+        self.assertNotEqual(notifier._notification_id("away", "dm", state), notifier._notification_id("away", "dm", None))
+
+    @mock.patch("src.chats.notifications.deliver_chat_notifications")
+    @mock.patch("src.chats.notifications.transaction")
+    @mock.patch("src.chats.notifications.ChatChange")
+    @mock.patch("src.chats.notifications.Notification.objects")
+    @mock.patch("src.chats.notifications.cache")
+    @mock.patch("src.chats.notifications.get_presence_many", return_value=[{"user_id": "away", "is_online": False}])
+    def test_rows_another_flush_inserted_are_not_delivered_again(
+        self, presence, cache, notifications, changes, transaction, deliver
+    ):
+        notifier = OfflineNotifier(flush_interval=1, merge_window=60)
+        cache.get_many.return_value = {}
+        cache.lock.return_value.acquire.return_value = True
+        self.store(notifications, conflicts=[notifier._notification_id("away", "dm", None)])
+
+        notifier.flush([MessageEvent("dm", "sender", "hi", ("away",))])
+
+        deliver.delay.assert_not_called()
+        self.assertEqual(changes.objects.bulk_create.call_args.args[0], [])
+        self.assertEqual(cache.set_many.call_args.args[0], {})
+
+    @mock.patch("src.chats.tasks.notify")
+    @mock.patch("src.chats.tasks.User.objects")
+    def test_deliveries_go_through_the_notifications_app(self, users, notify):
+        users.filter.return_value.exclude.return_value.only.return_value = [
+            SimpleNamespace(id="away", username="away", email="away@example.com"),
+        ]
+        notifications = [{"title": "New message", "message": "hi"}]
+
+        deliver_chat_notifications([
+            {"user_id": "away", "notifications": notifications},
+            {"user_id": "no-email", "notifications": notifications},
+        ])
+
+        notify.assert_called_once_with(
+            ACTIVITY_CHAT_NEW_MESSAGES,
+            context={"username": "away", "notifications": notifications},
+            email_to=["away@example.com"],
+        )
+
+    @mock.patch("src.chats.notifications.Notification.objects")
+    @mock.patch("src.chats.notifications.cache")
+    @mock.patch("src.chats.notifications.get_presence_many", return_value=[{"user_id": "away", "is_online": False}])
+    def test_flush_waits_for_other_workers_flushes(self, presence, cache, notifications):
+        notifier = OfflineNotifier(flush_interval=0.01, merge_window=60)
+        cache.lock.return_value.acquire.return_value = False
+        event = MessageEvent("dm", "sender", "hi", ("away",))
+
+        self.assertIsNone(notifier.flush([event]))
+        notifications.bulk_create.assert_not_called()
+
+        flushed = []
+
+        async def run():
+            notifier.schedule("dm", "sender", "hi", ["away"])
+            while len(flushed) < 2:
+                await asyncio.sleep(0.005)
+            notifier._flush_task.cancel()
+
+        with mock.patch.object(notifier, "flush", side_effect=lambda events: flushed.append(list(events))):
+            async_to_sync(run)()
+        self.assertEqual(flushed, [[event], [event]])  # kept for the next flush
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+from .codecs import encode_broadcast
+from .enums import BroadCastAction
+
+logger = logging.getLogger(__name__)
+
+
+class TypingCoalescer:
+    """
+    Per-process typing indicator state.
+
+    Typing events no longer turn into one group_send per keystroke. touch() only
+    updates in-memory state. Every `interval` seconds the rooms whose state changed
+    get one broadcast:
+    ```
+    {
+        "group_id": ...,                  # the context given to touch(), if any
+        "typing_user_ids": [...],         # typing for the next `expires_in` seconds
+        "stopped_user_ids": [...],        # stopped or expired since the last broadcast
+        "expires_in": 6,
+    }
+    ```
+    A user who keeps typing is re-announced every `ttl / 2` seconds, and one who
+    goes quiet expires after `ttl` seconds without a "stopped" event from the client.
+
+    Each worker only reports the users connected to it, so clients merge these
+    broadcasts by user id instead of replacing their whole list.
+    """
+
+    def __init__(self, interval: float, ttl: float):
+        self.interval = interval
+        self.ttl = ttl
+        self._typing: Dict[str, Dict[Any, float]] = {}  # group -> {user_id: expires_at}
+        self._stopped: Dict[str, set] = {}  # group -> user ids to announce as stopped
+        self._context: Dict[str, tuple] = {}  # group -> (broadcast action, extra payload)
+        self._announced_at: Dict[str, float] = {}  # group -> loop time of last broadcast
+        self._dirty = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def touch(
+        self,
+        group_name: str,
+        user_id,
+        is_typing: bool,
+        action: BroadCastAction = BroadCastAction.GROUP_TYPING,
+        context: Optional[Dict[str, Any]] = None,
+    ):
+        loop = asyncio.get_running_loop()
+        users = self._typing.setdefault(group_name, {})
+        self._context[group_name] = (action, context or {})
+
+        if is_typing:
+            if user_id not in users:
+                self._dirty.add(group_name)
+                self._stopped.get(group_name, set()).discard(user_id)
+            users[user_id] = loop.time() + self.ttl
+        elif users.pop(user_id, None) is not None:
+            self._stopped.setdefault(group_name, set()).add(user_id)
+            self._dirty.add(group_name)
+
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._typing or self._dirty:
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+
+            for group_name, users in list(self._typing.items()):
+                expired = [user_id for user_id, expires_at in users.items() if expires_at <= now]
+                for user_id in expired:
+                    del users[user_id]
+                    self._stopped.setdefault(group_name, set()).add(user_id)
+                    self._dirty.add(group_name)
+
+                # keep still-typing users alive on the clients
+                if users and now - self._announced_at.get(group_name, 0) >= self.ttl / 2:
+                    self._dirty.add(group_name)
+
+            dirty, self._dirty = self._dirty, set()
+            try:
+                await asyncio.gather(*(self._broadcast(group_name, now) for group_name in dirty))
+            except Exception as e:
+                logger.error(f"Typing broadcast failed: {str(e)}")
+
+            for group_name in [group_name for group_name, users in self._typing.items() if not users]:
+                if group_name not in self._dirty:
+                    del self._typing[group_name]
+                    self._context.pop(group_name, None)
+                    self._announced_at.pop(group_name, None)
+
+    async def _broadcast(self, group_name: str, now: float):
+        self._announced_at[group_name] = now
+        stopped = self._stopped.pop(group_name, set())
+        action, context = self._context[group_name]
+        await get_channel_layer().group_send(
+            group_name,
+            encode_broadcast({
+                "broadcast": True,
+                "action": action.value,
+                "payload": {
+                    **context,
+                    "typing_user_ids": [str(user_id) for user_id in self._typing.get(group_name, {})],
+                    "stopped_user_ids": [str(user_id) for user_id in stopped],
+                    "expires_in": self.ttl,
+                },
+                "timestamp": timezone.now().isoformat(),
+                "sender": None,
+            }, ephemeral=True),
+        )
+
+
+typing_indicators = TypingCoalescer(
+    interval=settings.CHAT_TYPING_BROADCAST_INTERVAL,
+    ttl=settings.CHAT_TYPING_TTL,
+)
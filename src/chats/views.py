@@ -13,12 +13,16 @@ from rest_framework.permissions import AllowAny
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.exceptions import ValidationError
-from rest_framework.permissions import AllowAny
+from rest_framework.exceptions import ValidationError, PermissionDenied
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from django.conf import settings
+from drf_spectacular.utils import extend_schema
 
 from src.common.clients import zeptomail
 from src.common.serializers import EmptySerializer
+from .serializers import MessageSerializer, MessageHistoryQuerySerializer
+from .metrics import chat_metrics, merge_snapshots, read_published
+from .services import ChatHistoryService, ChatMembershipIndex, InvalidCursor, UnreadCounters
 
 
 class ChatViewSet(viewsets.GenericViewSet):
@@ -28,9 +32,13 @@ class ChatViewSet(viewsets.GenericViewSet):
 
     serializers = {
         "default": EmptySerializer,
+        "history": MessageSerializer,
     }
     permissions = {
         "default": (AllowAny,),
+        "history": (IsAuthenticated,),
+        "unread_counts": (IsAuthenticated,),
+        "metrics": (IsAdminUser,),
     }
 
     def get_serializer_class(self):
@@ -48,3 +56,62 @@ class ChatViewSet(viewsets.GenericViewSet):
         Just a test endpoint to verify that the service is up and running
         """
         return Response({"status": "ok"}, status=status.HTTP_200_OK)
+
+    @extend_schema(parameters=[MessageHistoryQuerySerializer])
+    @action(detail=False, methods=["get"])
+    def history(self, request, *args, **kwargs):
+        """
+        Messages of a chat room, newest first.
+        Pass the returned `next_cursor` as `before` to get the next (older) page;
+        it is null once the start of the room is reached.
+        """
+        query = MessageHistoryQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        chatroom_id = query.validated_data["chatroom_id"]
+
+        if str(chatroom_id) not in ChatMembershipIndex.get_room_ids(request.user.id):
+            raise PermissionDenied("You are not a participant of this chat")
+
+        try:
+            messages, next_cursor = ChatHistoryService.get_page(
+                chatroom_id,
+                before=query.validated_data.get("before"),
+                limit=query.validated_data.get("limit"),
+            )
+        except InvalidCursor as e:
+            raise ValidationError({"before": str(e)})
+
+        return Response(
+            {
+                "results": self.get_serializer(messages, many=True).data,
+                "next_cursor": next_cursor,
+            },
+            status=status.HTTP_200_OK,
+        )
+
+    @action(detail=False, methods=["get"])
+    def unread_counts(self, request, *args, **kwargs):
+        """
+        Unread message count of every chat room the user is in, for the chat list.
+        ```
+        {"counts": {"<chatroom id>": 3, ...}}
+        ```
+        """
+        return Response({"counts": UnreadCounters.get_counts(request.user.id)}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=["get"])
+    def metrics(self, request, *args, **kwargs):
+        """
+        WebSocket chat metrics of every daphne worker, plus their total.
+        The worker serving this request reports live numbers, the others what
+        they last published (every CHAT_METRICS_PUBLISH_INTERVAL seconds).
+        """
+        workers = read_published()
+        workers[chat_metrics.worker_id] = chat_metrics.snapshot()
+        return Response(
+            {
+                "total": merge_snapshots(list(workers.values())),
+                "workers": workers,
+            },
+            status=status.HTTP_200_OK,
+        )
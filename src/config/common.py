@@ -157,6 +157,47 @@ else:
         }
     }
 
+# Chats (WebSocket)
+CHAT_HEARTBEAT_INTERVAL = float(os.getenv("CHAT_HEARTBEAT_INTERVAL", 30))  # seconds between pings
+CHAT_HEARTBEAT_SLOTS = int(os.getenv("CHAT_HEARTBEAT_SLOTS", 10))  # timer wheel buckets
+CHAT_HEARTBEAT_MAX_MISSED = int(os.getenv("CHAT_HEARTBEAT_MAX_MISSED", 2))  # then the socket is closed
+CHAT_OUTBOUND_QUEUE_SIZE = int(os.getenv("CHAT_OUTBOUND_QUEUE_SIZE", 256))  # broadcast frames per connection
+CHAT_OUTBOUND_BUFFER_BYTES = int(os.getenv("CHAT_OUTBOUND_BUFFER_BYTES", 256 * 1024))  # unsent bytes per connection (daphne)
+CHAT_PRESENCE_FLUSH_INTERVAL = float(os.getenv("CHAT_PRESENCE_FLUSH_INTERVAL", 10))  # seconds
+CHAT_TYPING_BROADCAST_INTERVAL = float(os.getenv("CHAT_TYPING_BROADCAST_INTERVAL", 1))  # seconds
+CHAT_TYPING_TTL = float(os.getenv("CHAT_TYPING_TTL", 6))  # seconds
+# Broadcast chat messages before they are in Postgres and INSERT them in batches
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "False") == "True"
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("CHAT_WRITE_BEHIND_FLUSH_INTERVAL", 1))  # seconds
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BEHIND_BATCH_SIZE", 500))
+CHAT_READ_WATERMARK_FLUSH_INTERVAL = float(os.getenv("CHAT_READ_WATERMARK_FLUSH_INTERVAL", 5))  # seconds
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", 50))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_MAX_PAGE_SIZE", 100))
+CHAT_SYNC_CHUNK_SIZE = int(os.getenv("CHAT_SYNC_CHUNK_SIZE", 200))
+CHAT_SYNC_MAX_CHUNKS = int(os.getenv("CHAT_SYNC_MAX_CHUNKS", 25))  # per SYNC:REQUEST_SYNC
+CHAT_SYNC_RETENTION = int(os.getenv("CHAT_SYNC_RETENTION", 30 * 24 * 60 * 60))  # seconds, older cursors reset
+CHAT_NOTIFY_FLUSH_INTERVAL = float(os.getenv("CHAT_NOTIFY_FLUSH_INTERVAL", 2))  # seconds, offline notifications
+CHAT_NOTIFY_MERGE_WINDOW = int(os.getenv("CHAT_NOTIFY_MERGE_WINDOW", 300))  # seconds, repeats become "N new messages"
+CHAT_METRICS_PUBLISH_INTERVAL = float(os.getenv("CHAT_METRICS_PUBLISH_INTERVAL", 15))  # seconds
+# "thread": chat reads on the DB pool, "async": Redis reads on the event loop, Postgres on the DB pool
+CHAT_DB_SERVICES = os.getenv("CHAT_DB_SERVICES", "thread")
+# Seconds to reuse presence lookups and the sync head across connections, 0 to only coalesce concurrent calls
+CHAT_SINGLE_FLIGHT_TTL = float(os.getenv("CHAT_SINGLE_FLIGHT_TTL", 1))
+# Per-worker cache of chat roles, used to authorize every chat send (src.chats.membership)
+CHAT_MEMBERSHIP_CACHE_SIZE = int(os.getenv("CHAT_MEMBERSHIP_CACHE_SIZE", 100000))  # (room, user) pairs
+CHAT_MEMBERSHIP_CACHE_TTL = float(os.getenv("CHAT_MEMBERSHIP_CACHE_TTL", 300))  # seconds, in case a change is missed
+# Threads per worker for the chat consumer's DB calls, 0 for the shared thread_sensitive thread
+CHAT_DB_EXECUTOR_WORKERS = int(os.getenv("CHAT_DB_EXECUTOR_WORKERS", 8))
+# Token buckets per connection, keyed "MODULE:ACTION", "MODULE" or "*" (every frame)
+CHAT_WS_RATE_LIMITS = {
+    "*": "30/second",
+    "GROUP_CHAT:SEND_MESSAGE": "10/second",
+    "DIRECT_CHAT:SEND_MESSAGE": "10/second",
+    "GROUP_CHAT:CREATE": "10/minute",
+}
+# Shared by all of a user's connections, kept in Redis, e.g. "60/second"
+CHAT_WS_USER_RATE_LIMIT = os.getenv("CHAT_WS_USER_RATE_LIMIT") or None
+
 
 COUNTRIES_PLUS_COUNTRY_HEADER = (
     "HTTP_CF_COUNTRY"  # Cloudflare’s header for country code
@@ -252,6 +293,9 @@ CELERY_ACCEPT_CONTENT = ["application/json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "UTC"
+CELERY_BEAT_SCHEDULE = {
+    "prune-chat-changes": {"task": "PruneChatChangesTask", "schedule": 60 * 60},  # seconds
+}
 
 # Postgres
 # DATABASES = {
@@ -308,6 +352,9 @@ else:
             "HOST": os.getenv("DB_HOST", "db"),
             "PORT": os.getenv("DB_PORT"),
             # 'CONN_MAX_AGE': 300, # this was a bad idea
+            # with the chat DB pool (CHAT_DB_EXECUTOR_WORKERS) this keeps one connection per pool thread
+            "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", 0)),
+            "CONN_HEALTH_CHECKS": True,
             "OPTIONS": OPTIONS,
         }
     }
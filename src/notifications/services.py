@@ -6,6 +6,7 @@ from src.notifications.channels.email import EmailChannel
 logger = logging.getLogger(__name__)
 
 ACTIVITY_USER_RESETS_PASS = 'started password reset process'
+ACTIVITY_CHAT_NEW_MESSAGES = 'got chat messages while offline'
 
 NOTIFICATIONS = {
     ACTIVITY_USER_RESETS_PASS: {
@@ -13,7 +14,13 @@ NOTIFICATIONS = {
             'email_subject': 'Password Reset',
             'email_html_template': 'emails/user_reset_password.html',
         }
-    }
+    },
+    ACTIVITY_CHAT_NEW_MESSAGES: {
+        'email': {
+            'email_subject': 'New messages',
+            'email_html_template': 'chats/emails/new_messages.html',
+        }
+    },
 }
 
 
@@ -0,0 +1,308 @@
+"""Load test for the chat WebSocket consumer (src.chats.consumers.AppConsumer).
+
+Drives AppConsumer with thousands of simulated, authenticated clients through
+channels' WebsocketCommunicator, on the in-memory or the Redis channel layer,
+and writes the results as JSON:
+
+    python tests/bench_chat_consumer.py --layer memory --clients 2000 --output bench.json
+    python tests/bench_chat_consumer.py --layer redis --clients 2000 --baseline bench.json
+
+Reported:
+- connect_ms: connect() until the "connected" frame arrives
+- fanout_ms: GROUP_CHAT:SEND_MESSAGE sent until each room member got the broadcast
+- memory.per_connection_bytes: traced allocations while connecting the last
+  --memory-sample clients, per client (this includes the test client's own
+  queues). Their connect times are left out, tracemalloc slows them down.
+- server: the consumer's own action metrics (src.chats.metrics)
+
+Only the consumer and the channel layer are measured. Room membership comes
+from an in-memory map, the message INSERT is replaced by building the message
+dict, and the cache is LocMemCache, so neither Postgres nor the Redis cache is
+needed (the Redis layer needs Redis, of course).
+
+With --baseline, exits with status 1 if a p95 or the memory per connection got
+worse than the baseline by more than --tolerance.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import uuid
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "src.config.local")
+
+import django  # noqa: E402
+
+django.setup()
+
+from channels.layers import channel_layers  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.test import override_settings  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from src.chats import consumer_modules, services  # noqa: E402
+from src.chats.consumers import AppConsumer  # noqa: E402
+from src.chats.metrics import chat_metrics, merge_snapshots  # noqa: E402
+from src.users.models import User  # noqa: E402
+
+WS_PATH = "/api/v1/ws/"
+MESSAGE_PREFIX = "bench:"
+
+# metrics and regressions are checked against, (section, key)
+REGRESSION_KEYS = (
+    ("connect_ms", "p95"),
+    ("fanout_ms", "p95"),
+    ("memory", "per_connection_bytes"),
+)
+
+
+def channel_layer_settings(layer: str, redis_url: str) -> dict:
+    if layer == "memory":
+        return {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+    return {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [redis_url], "capacity": 10000},
+        }
+    }
+
+
+def summarize(samples: list) -> dict:
+    """Percentiles of a list of millisecond samples"""
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def at(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))], 3)
+
+    return {
+        "count": len(samples),
+        "p50": at(0.5),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": round(samples[-1], 3),
+        "mean": round(sum(samples) / len(samples), 3),
+    }
+
+
+class SimulatedClient:
+    def __init__(self, application, user, room_id):
+        self.user = user
+        self.room_id = room_id
+        self.communicator = WebsocketCommunicator(application, WS_PATH)
+        self.communicator.scope["user"] = user
+        self.fanout_ms = []
+        self.received = 0
+
+    async def connect(self) -> float:
+        started = time.perf_counter()
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f"Client {self.user.username} was rejected")
+        frame = await self.communicator.receive_json_from(timeout=30)
+        assert frame["type"] == "connected", frame
+        return (time.perf_counter() - started) * 1000
+
+    async def send_message(self):
+        await self.communicator.send_json_to({
+            "action": "WS:GROUP_CHAT:SEND_MESSAGE",
+            "payload": {"group_id": self.room_id, "message": f"{MESSAGE_PREFIX}{time.perf_counter()}"},
+        })
+
+    async def listen(self, delivered: asyncio.Event, expected: dict):
+        while True:
+            frame = json.loads(await self.communicator.receive_from(timeout=3600))
+            if frame.get("action") != "send.message":
+                continue
+            content = frame["payload"]["message"]["content"]
+            self.fanout_ms.append((time.perf_counter() - float(content[len(MESSAGE_PREFIX):])) * 1000)
+            self.received += 1
+            expected["remaining"] -= 1
+            if not expected["remaining"]:
+                delivered.set()
+
+    async def disconnect(self):
+        await self.communicator.disconnect()
+
+
+@contextlib.contextmanager
+def isolated_consumer(layer: str, redis_url: str, rooms_of_user: dict):
+    """Point the consumer at the chosen channel layer and keep Postgres out of the way"""
+
+    async def save_group_message(module, group_id, message, msg_type, reply_to):
+        return {
+            "id": str(uuid.uuid4()),
+            "chatroom_id": str(group_id),
+            "sender_id": str(module.user.id),
+            "content": message,
+            "created_at": timezone.now().isoformat(),
+            "message_type": msg_type,
+            "reply_to": reply_to,
+        }
+
+    async def trigger_group_notifications(module, group_id, message):
+        pass
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(override_settings(
+            CHANNEL_LAYERS=channel_layer_settings(layer, redis_url),
+            CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+            CHAT_WS_RATE_LIMITS={},  # measure the consumer, not the limiter
+            CHAT_WRITE_BEHIND=False,
+        ))
+        stack.enter_context(mock.patch.object(
+            services.ChatMembershipIndex, "get_room_ids", side_effect=lambda user_id: rooms_of_user[user_id]
+        ))
+        stack.enter_context(mock.patch.object(
+            services.ChatRoomRoles, "get_role", side_effect=lambda room_id, user_id: (
+                services.ChatRoomRoles.MEMBER if room_id in rooms_of_user[uuid.UUID(user_id)] else None
+            )
+        ))
+        stack.enter_context(mock.patch.object(
+            consumer_modules.GroupChatModule, "_save_group_message", save_group_message
+        ))
+        stack.enter_context(mock.patch.object(
+            consumer_modules.GroupChatModule, "_trigger_group_notifications", trigger_group_notifications
+        ))
+        stack.enter_context(mock.patch.object(chat_metrics, "publish"))
+        channel_layers.backends.clear()
+        try:
+            yield
+        finally:
+            channel_layers.backends.clear()
+
+
+async def run(args) -> dict:
+    room_ids = [str(uuid.uuid4()) for _ in range(args.rooms)]
+    users = [
+        User(id=uuid.uuid4(), username=f"bench{i}", email=f"bench{i}@example.com", first_name="Bench")
+        for i in range(args.clients)
+    ]
+    rooms_of_user = {user.id: [room_ids[i % args.rooms]] for i, user in enumerate(users)}
+    room_size = {room_id: 0 for room_id in room_ids}
+    for rooms in rooms_of_user.values():
+        room_size[rooms[0]] += 1
+
+    with isolated_consumer(args.layer, args.redis_url, rooms_of_user):
+        application = AppConsumer.as_asgi()
+        clients = [SimulatedClient(application, user, rooms_of_user[user.id][0]) for user in users]
+
+        sampled = min(args.memory_sample, len(clients))
+        timed, traced = clients[:len(clients) - sampled], clients[len(clients) - sampled:]
+
+        connect_ms = []
+        started = time.perf_counter()
+        for i in range(0, len(timed), args.concurrency):
+            connect_ms += await asyncio.gather(*(c.connect() for c in timed[i:i + args.concurrency]))
+        connect_seconds = time.perf_counter() - started
+
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        for i in range(0, len(traced), args.concurrency):
+            await asyncio.gather(*(c.connect() for c in traced[i:i + args.concurrency]))
+        memory_after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        # fan out, every sender's room receives each of its messages
+        senders = clients[:args.senders]
+        expected = {"remaining": sum(room_size[c.room_id] for c in senders) * args.messages}
+        delivered = asyncio.Event()
+        listeners = [asyncio.ensure_future(c.listen(delivered, expected)) for c in clients]
+
+        started = time.perf_counter()
+        for _ in range(args.messages):
+            await asyncio.gather(*(c.send_message() for c in senders))
+            await asyncio.sleep(args.interval)
+        timed_out = False
+        try:
+            await asyncio.wait_for(delivered.wait(), timeout=args.timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+        fanout_seconds = time.perf_counter() - started
+
+        for listener in listeners:
+            listener.cancel()
+        await asyncio.gather(*listeners, return_exceptions=True)
+        await asyncio.gather(*(c.disconnect() for c in clients), return_exceptions=True)
+
+    fanout_ms = [sample for c in clients for sample in c.fanout_ms]
+    delivered_count = sum(c.received for c in clients)
+    return {
+        "layer": args.layer,
+        "python": platform.python_version(),
+        "created_at": timezone.now().isoformat(),
+        "config": {
+            "clients": args.clients,
+            "rooms": args.rooms,
+            "senders": len(senders),
+            "messages_per_sender": args.messages,
+        },
+        "connect_ms": summarize(connect_ms),
+        "connects_per_second": round(len(timed) / connect_seconds, 1) if timed else None,
+        "fanout_ms": summarize(fanout_ms),
+        "deliveries": {
+            "expected": delivered_count + expected["remaining"],
+            "delivered": delivered_count,
+            "per_second": round(delivered_count / fanout_seconds, 1),
+            "timed_out": timed_out,
+        },
+        "memory": {
+            "per_connection_bytes": round((memory_after - memory_before) / sampled) if sampled else None,
+            "sampled_connections": sampled,
+        },
+        "server": merge_snapshots([chat_metrics.snapshot()]),
+    }
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for section, key in REGRESSION_KEYS:
+        old, new = baseline.get(section, {}).get(key), results[section].get(key)
+        if old and new and new > old * (1 + tolerance):
+            regressions.append(f"{section}.{key}: {old} -> {new}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--layer", choices=("memory", "redis"), default="memory")
+    parser.add_argument("--redis-url", default=f"redis://{os.getenv('REDIS_DOMAIN_DEV', '127.0.0.1')}:6379/2")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=50, help="clients are spread evenly over the rooms")
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=10, help="messages per sender")
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds between rounds of sends")
+    parser.add_argument("--concurrency", type=int, default=200, help="clients connecting at once")
+    parser.add_argument("--memory-sample", type=int, default=200, help="clients connected under tracemalloc")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for every delivery")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    dump = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(dump)
+    print(dump)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Compare the thread and async chat DB services (CHAT_DB_SERVICES).
+
+Runs the reads the chat modules make (the user's room ids, read seq
+lookup, delta sync) through DatabaseServices ("thread") and
+AsyncDatabaseServices ("async"), `--concurrency` calls at a time as a busy
+daphne worker would, against the configured Postgres and Redis:
+
+    python tests/bench_chat_db_services.py --user-id <uuid> --room-id <uuid> --output db-services.json
+
+The user should be a participant of the room. Latencies are in ms, per call.
+
+The calls of a round have equal arguments, so they go around single_flight
+(which would otherwise make them one call): every call does its own read.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "src.config.local")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.utils import timezone  # noqa: E402
+
+from src.chats.consumers import DATABASE_SERVICES  # noqa: E402
+from src.chats.executor import db_executor  # noqa: E402
+
+
+def summarize(samples: list) -> dict:
+    samples = sorted(samples)
+
+    def at(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))], 3)
+
+    return {"count": len(samples), "p50": at(0.5), "p95": at(0.95), "p99": at(0.99), "max": round(samples[-1], 3)}
+
+
+def uncoalesced(services, name: str):
+    """The service method as single_flight wraps it (every bench call is a coalesced method)"""
+    return functools.partial(getattr(type(services), name).__wrapped__, services)
+
+
+async def timed(call, samples: list):
+    started = time.perf_counter()
+    await call()
+    samples.append((time.perf_counter() - started) * 1000)
+
+
+async def bench_mode(mode: str, args) -> dict:
+    services = DATABASE_SERVICES[mode](consumer=None)
+    get_room_ids = uncoalesced(services, "db_get_room_ids")
+    resolve_read_seq = uncoalesced(services, "db_resolve_read_seq")
+    get_changes = uncoalesced(services, "db_get_changes")
+    calls = {
+        "get_room_ids": lambda: get_room_ids(args.user_id),
+        "resolve_read_seq": lambda: resolve_read_seq(args.room_id, {"message_id": args.message_id}),
+        "get_changes": lambda: get_changes(args.user_id, 0, 50),
+    }
+    if not args.message_id:
+        del calls["resolve_read_seq"]
+
+    results = {}
+    for name, call in calls.items():
+        await call()  # warm up connections and caches
+        samples = []
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            await asyncio.gather(*(timed(call, samples) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        results[name] = {**summarize(samples), "calls_per_second": round(len(samples) / elapsed, 1)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-id", required=True)
+    parser.add_argument("--room-id", required=True)
+    parser.add_argument("--message-id", help="a message of the room, for the read seq lookup")
+    parser.add_argument("--concurrency", type=int, default=50, help="calls in flight at once")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {
+        "created_at": timezone.now().isoformat(),
+        "db_executor_workers": db_executor.max_workers,
+        "concurrency": args.concurrency,
+        "modes": {mode: asyncio.run(bench_mode(mode, args)) for mode in ("thread", "async")},
+    }
+    dump = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(dump)
+    print(dump)
+
+
+if __name__ == "__main__":
+    main()